@@ -1 +1,16 @@
-from cellpose.version import version, version_str
+from cellpose.version import version, version_str
+
+import importlib
+
+_SUBMODULES = ["core", "denoise", "dynamics", "io", "metrics", "models", "pipeline", "plot",
+               "resnet_torch", "train", "transforms", "utils"]
+
+
+def __getattr__(name):
+    """ import the submodules when they are first used (e.g. cellpose.models), 
+    so that import cellpose does not import torch, numba, ... """
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    if name == "warmup":
+        return importlib.import_module(f"{__name__}.models").warmup
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,28 +2,14 @@
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
 
-import sys, os, glob, pathlib, time
-import numpy as np
-from natsort import natsorted
-from tqdm import tqdm
-from cellpose import utils, models, io, version_str, train, denoise
-from cellpose.cli import get_arg_parser
-
-try:
-    from cellpose.gui import gui3d, gui
-    GUI_ENABLED = True
-except ImportError as err:
-    GUI_ERROR = err
-    GUI_ENABLED = False
-    GUI_IMPORT = True
-except Exception as err:
-    GUI_ENABLED = False
-    GUI_ERROR = err
-    GUI_IMPORT = False
-    raise
-
+import sys, os, glob, pathlib, time, functools
 import logging
 
+# the heavy modules (torch, numba, ...) are imported in main once the arguments are parsed,
+# so that --help and --version return quickly
+from cellpose import version_str
+from cellpose.cli import get_arg_parser, save_outputs, segment_files, image_chunks
+
 
 # settings re-grouped a bit
 def main():
@@ -37,6 +23,10 @@ def main():
         print(version_str)
         return
 
+    import numpy as np
+    from tqdm import tqdm
+    from cellpose import utils, models, io, train, denoise, pipeline, core
+
     if args.check_mkl:
         mkl_enabled = models.check_mkl()
     else:
@@ -45,14 +35,17 @@ def main():
     if len(args.dir) == 0 and len(args.image_path) == 0:
         if args.add_model:
             io.add_model(args.add_model)
+        elif args.warmup:
+            print("numba kernels compiled or loaded from the cache in %0.2f sec" % models.warmup())
         else:
-            if not GUI_ENABLED:
-                print("GUI ERROR: %s" % GUI_ERROR)
-                if GUI_IMPORT:
-                    print(
-                        "GUI FAILED: GUI dependencies may not be installed, to install, run"
-                    )
-                    print("     pip install 'cellpose[gui]'")
+            try:
+                from cellpose.gui import gui3d, gui
+            except ImportError as err:
+                print("GUI ERROR: %s" % err)
+                print(
+                    "GUI FAILED: GUI dependencies may not be installed, to install, run"
+                )
+                print("     pip install 'cellpose[gui]'")
             else:
                 if args.Zstack:
                     gui3d.run()
@@ -78,10 +71,6 @@ def main():
         else:
             imf = None
 
-        # Check with user if they REALLY mean to run without saving anything
-        if not (args.train or args.train_size):
-            saving_something = args.save_png or args.save_tif or args.save_flows or args.save_txt
-
         device, gpu = models.assign_device(use_torch=True, gpu=args.use_gpu,
                                            device=args.gpu_device)
 
@@ -168,6 +157,11 @@ def main():
                                                          restore_type=restore_type,
                                                          chan2_restore=args.chan2_restore)
 
+            if args.runtime_mode is not None:
+                getattr(model, "cp", model).net.runtime_mode = args.runtime_mode
+            if args.warmup:
+                models.warmup(model)
+
             # handle diameters
             if args.diameter == 0:
                 if builtin_size:
@@ -190,46 +184,48 @@ def main():
 
             tqdm_out = utils.TqdmToLogger(logger, level=logging.INFO)
 
-            for image_name in tqdm(image_names, file=tqdm_out):
-                image = io.imread(image_name)
-                out = model.eval(
-                    image, channels=channels, diameter=diameter, do_3D=args.do_3D,
+            if args.pipeline and restore_type is None and not args.do_3D and args.stitch_threshold == 0:
+                # read, network, masks and saving run at the same time on different images
+                pipeline.run_pipeline(
+                    model, image_names, channels=channels, diameter=diameter,
                     augment=args.augment, resample=(not args.no_resample),
                     flow_threshold=args.flow_threshold,
-                    cellprob_threshold=args.cellprob_threshold,
-                    stitch_threshold=args.stitch_threshold, min_size=args.min_size,
+                    cellprob_threshold=args.cellprob_threshold, min_size=args.min_size,
                     invert=args.invert, batch_size=args.batch_size,
                     interp=(not args.no_interp), normalize=(not args.no_norm),
-                    channel_axis=args.channel_axis, z_axis=args.z_axis,
-                    anisotropy=args.anisotropy, niter=args.niter)
-                masks, flows = out[:2]
-                if len(out) > 3 and restore_type is None:
-                    diams = out[-1]
-                else:
-                    diams = diameter
-                ratio = 1.
-                if restore_type is not None:
-                    imgs_dn = out[-1]
-                    ratio = diams / model.dn.diam_mean if "upsample" in restore_type else 1.
-                    diams = model.dn.diam_mean if "upsample" in restore_type and model.dn.diam_mean > diams else diams
+                    channel_axis=args.channel_axis, z_axis=args.z_axis, niter=args.niter,
+                    nworkers=args.pipeline_workers,
+                    save=lambda image, masks, flows, styles, diams, image_name:
+                    save_outputs(args, channels, restore_type, image, masks, flows, diams,
+                                 image_name))
+            else:
+                segment = functools.partial(segment_files, model=model, args=args, channels=channels,
+                                            diameter=diameter, restore_type=restore_type)
+                if args.workers > 1 and getattr(model, "cp", model).device.type == "cpu":
+                    # choose the runtime mode of the networks once instead of in each worker
+                    nets = [getattr(model, "cp", model).net]
+                    if hasattr(model, "dn"):
+                        nets.append(model.dn.net)
+                    for net in nets:
+                        if net.runtime_mode is None:
+                            net.runtime_mode = core.get_runtime(net).mode
+                    # each process segments one image at a time with a few threads
+                    pipeline.run_workers(segment, [[image_name] for image_name in image_names],
+                                         nworkers=args.workers,
+                                         nthreads=args.worker_threads or None)
                 else:
-                    imgs_dn = None
-                if args.exclude_on_edges:
-                    masks = utils.remove_edge_masks(masks)
-                if not args.no_npy:
-                    io.masks_flows_to_seg(image, masks, flows, image_name, imgs_restore=imgs_dn, 
-                                          channels=channels, diams=diams, 
-                                          restore_type=restore_type, ratio=1.)
-                if saving_something:
-                    io.save_masks(image, masks, flows, image_name, 
-                                  png=args.save_png,
-                                  tif=args.save_tif, save_flows=args.save_flows,
-                                  save_outlines=args.save_outlines,
-                                  dir_above=args.dir_above, savedir=args.savedir,
-                                  save_txt=args.save_txt, in_folders=args.in_folders,
-                                  save_mpl=args.save_mpl)
-                if args.save_rois:
-                    io.save_rois(masks, image_name)
+                    if args.workers > 1:
+                        logger.warning("--workers is only used on the CPU, running in a single process")
+                    # small 2D images are loaded and segmented in chunks, batching their tiles in the network
+                    max_images = (max(0, args.nimg_batch) if restore_type is None and
+                                  not args.do_3D and args.stitch_threshold == 0 else 1)
+                    rescale = (getattr(model, "cp", model).diam_mean / diameter
+                               if diameter is not None and diameter > 0 else 1.)
+                    chunks = image_chunks(image_names, batch_size=args.batch_size,
+                                          rescale=rescale, augment=args.augment,
+                                          max_images=max_images)
+                    for names, images in tqdm(chunks, file=tqdm_out):
+                        segment(names, images=images)
             logger.info(">>>> completed in %0.3f sec" % (time.time() - tic))
         else:
 
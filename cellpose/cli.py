@@ -32,6 +32,13 @@ def get_arg_parser():
         help="which gpu device to use, use an integer for torch, or mps for M1")
     hardware_args.add_argument("--check_mkl", action="store_true",
                                help="check if mkl working")
+    hardware_args.add_argument(
+        "--runtime_mode", default=None, type=str,
+        choices=["float32", "mkldnn", "channels_last", "bf16", "fused"],
+        help="run the network in this mode on the CPU instead of the fastest mode in a short benchmark, fused folds the batchnorms of the network. Default: %(default)s")
+    hardware_args.add_argument(
+        "--warmup", action="store_true",
+        help="compile the numba kernels (or load them from the on-disk cache) and prepare the network before processing images, without --dir or --image_path only compile the kernels, e.g. to fill the cache when building a container")
 
     # settings for locating and formatting images
     input_img_args = parser.add_argument_group("Input Image Arguments")
@@ -124,6 +131,22 @@ def get_arg_parser():
         "--augment", action="store_true",
         help="tiles image with overlapping tiles and flips overlapped regions to augment"
     )
+    algorithm_args.add_argument(
+        "--pipeline", action="store_true",
+        help="run image reading, network, mask computation and saving at the same time in pools of threads (2D only), and report the utilization of each stage")
+    algorithm_args.add_argument(
+        "--pipeline_workers", default=[2, 1, 2, 1], type=int, nargs=4,
+        help="number of threads for the reading, network, masks and saving stages with --pipeline. Default: %(default)s")
+    algorithm_args.add_argument(
+        "--nimg_batch", default=0, type=int,
+        help="maximum number of 2D images to load and run through the network together; consecutive images are grouped while their total number of tiles is at most --batch_size, and images with more tiles are segmented one at a time. 0 means no maximum. Default: %(default)s"
+    )
+    algorithm_args.add_argument(
+        "--workers", default=1, type=int,
+        help="number of processes segmenting the images on the CPU, each loading one image at a time. The runtime mode of the network (see --runtime_mode) is chosen once, the processes share the network weights in float32 mode and make their own converted copy of the weights in the other modes. Default: %(default)s")
+    algorithm_args.add_argument(
+        "--worker_threads", default=0, type=int,
+        help="number of torch and numba threads in each process with --workers, 0 means the number of CPUs divided by the number of workers. Default: %(default)s")
 
     # output settings
     output_args = parser.add_argument_group("Output Arguments")
@@ -211,3 +234,82 @@ def get_arg_parser():
         "Model is saved in the folder specified by --dir in models subfolder.")
 
     return parser
+
+
+def save_outputs(args, channels, restore_type, image, masks, flows, diams, image_name,
+                 imgs_dn=None):
+    """ save the outputs of an image with the output settings of the command line """
+    from cellpose import io, utils
+    if args.exclude_on_edges:
+        masks = utils.remove_edge_masks(masks)
+    if not args.no_npy:
+        io.masks_flows_to_seg(image, masks, flows, image_name, imgs_restore=imgs_dn, 
+                              channels=channels, diams=diams, 
+                              restore_type=restore_type, ratio=1.)
+    saving_something = args.save_png or args.save_tif or args.save_flows or args.save_txt
+    if saving_something:
+        io.save_masks(image, masks, flows, image_name, 
+                      png=args.save_png,
+                      tif=args.save_tif, save_flows=args.save_flows,
+                      save_outlines=args.save_outlines,
+                      dir_above=args.dir_above, savedir=args.savedir,
+                      save_txt=args.save_txt, in_folders=args.in_folders,
+                      save_mpl=args.save_mpl)
+    if args.save_rois:
+        io.save_rois(masks, image_name)
+
+
+def image_chunks(image_names, batch_size=8, rescale=1., augment=False, max_images=0):
+    """ read the images and group consecutive images with at most batch_size tiles in total, 
+    images with more tiles are yielded on their own (at most max_images per group if > 0) """
+    from cellpose import io, transforms
+    names, images, ntiles = [], [], 0
+    for image_name in image_names:
+        image = io.imread(image_name)
+        # the two largest axes are Y and X
+        Ly, Lx = sorted(image.shape)[-2:]
+        n = transforms.tile_count(int(Ly * rescale), int(Lx * rescale), augment=augment)
+        if names and (ntiles + n > batch_size or len(names) == max_images):
+            yield names, images
+            names, images, ntiles = [], [], 0
+        names.append(image_name)
+        images.append(image)
+        ntiles += n
+    if names:
+        yield names, images
+
+
+def segment_files(names, model, args, channels, diameter, restore_type, images=None):
+    """ segment the images in names together and save their outputs with the settings of
+    the command line (defined here so that it can be run in the worker processes of --workers) """
+    import numpy as np
+    from cellpose import io
+    if images is None:
+        images = [io.imread(image_name) for image_name in names]
+    outs = model.eval(
+        images if len(names) > 1 else images[0], channels=channels,
+        diameter=diameter, do_3D=args.do_3D,
+        augment=args.augment, resample=(not args.no_resample),
+        flow_threshold=args.flow_threshold,
+        cellprob_threshold=args.cellprob_threshold,
+        stitch_threshold=args.stitch_threshold, min_size=args.min_size,
+        invert=args.invert, batch_size=args.batch_size,
+        interp=(not args.no_interp), normalize=(not args.no_norm),
+        channel_axis=args.channel_axis, z_axis=args.z_axis,
+        anisotropy=args.anisotropy, niter=args.niter)
+    for i, (image_name, image) in enumerate(zip(names, images)):
+        out = outs
+        if len(names) > 1:
+            out = [o[i] if isinstance(o, (list, np.ndarray)) else o for o in outs]
+        masks, flows = out[:2]
+        if len(out) > 3 and restore_type is None:
+            diams = out[-1]
+        else:
+            diams = diameter
+        if restore_type is not None:
+            imgs_dn = out[-1]
+            diams = model.dn.diam_mean if "upsample" in restore_type and model.dn.diam_mean > diams else diams
+        else:
+            imgs_dn = None
+        save_outputs(args, channels, restore_type, image, masks, flows, diams, image_name,
+                     imgs_dn=imgs_dn)
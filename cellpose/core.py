@@ -3,6 +3,7 @@ Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer a
 """
 
 import os, sys, time, shutil, tempfile, datetime, pathlib, subprocess
+import copy, threading, weakref, inspect, io
 import logging
 import numpy as np
 from tqdm import trange, tqdm
@@ -19,9 +20,18 @@ from torch.utils import mkldnn as mkldnn_utils
 
 TORCH_ENABLED = True
 
+try:
+    import onnxruntime
+    ONNX_ENABLED = True
+except ImportError:
+    ONNX_ENABLED = False
+
 core_logger = logging.getLogger(__name__)
 tqdm_out = utils.TqdmToLogger(core_logger, level=logging.INFO)
 
+# cell probability output of tiles skipped as background (skip_background in run_net)
+BACKGROUND_CELLPROB = -10.
+
 def use_gpu(gpu_number=0, use_torch=True):
     """ 
     Check if GPU is available for use.
@@ -52,6 +62,10 @@ def _use_gpu_torch(gpu_number=0):
     Returns:
         bool: True if CUDA is available and working, False otherwise.
     """
+    if not torch.cuda.is_available():
+        # checked without creating a CUDA context
+        core_logger.info("TORCH CUDA version not installed/working.")
+        return False
     try:
         device = torch.device("cuda:" + str(gpu_number))
         _ = torch.zeros([1, 2, 3]).to(device)
@@ -158,9 +172,357 @@ def _from_device(X):
     return x
 
 
+class InferenceRuntime():
+    """Network prepared once for inference.
+
+    On the CPU, the network is run either as is (float32), converted to mkldnn (if net.mkldnn), 
+    in channels_last memory format, or with bfloat16 autocast (if net.bf16 is set and the CPU 
+    supports it), whichever is fastest in a short benchmark when the runtime is created (best 
+    of three timings per mode). The "fused" mode runs the copy of the network with the batchnorms 
+    folded (see CPnet.fuse_for_inference), it is only used if asked for and its outputs are 
+    checked against the network when the runtime is created. The mode can be set with the 
+    mode argument or the runtime_mode attribute of the network, instead of the benchmark. 
+    The converted copy of the network is kept, so the weights are converted only once (float32 
+    runs the weights of the network without copies). 
+    On the GPU the network is run as is. All modes run in torch.inference_mode.
+
+    Use get_runtime(net) to get the runtime of a network, which is recreated if the weights change.
+
+    Args:
+        net (torch.nn.Module): The network model.
+        benchmark (bool, optional): Benchmark the modes available on the CPU. Defaults to True 
+            (if False, mkldnn is used if net.mkldnn, otherwise the network is run as is).
+        mode (str, optional): Mode to use, defaults to net.runtime_mode if set, otherwise 
+            the mode is chosen by the benchmark. Defaults to None.
+
+    Attributes:
+        mode (str): "float32", "mkldnn", "channels_last", "bf16" or "fused".
+
+    Raises:
+        ValueError: If mode is not available for the network.
+    """
+
+    def __init__(self, net, benchmark=True, mode=None):
+        self._net = weakref.ref(net)
+        self.key = _runtime_key(net)
+        self.device = net.device
+        mode = mode if mode is not None else getattr(net, "runtime_mode", None)
+        modes = ["float32"]
+        if self.device.type == "cpu" and isinstance(net, resnet_torch.CPnet):
+            if net.mkldnn:
+                modes.insert(0, "mkldnn")
+            if (benchmark or mode is not None) and not net.conv_3D:
+                modes.append("channels_last")
+                if getattr(net, "bf16", False) and torch.ops.mkldnn._is_mkldnn_bf16_supported():
+                    modes.append("bf16")
+        if mode is not None:
+            # fused is opt-in, it is not part of the benchmark
+            available = modes + ["fused"] if isinstance(net, resnet_torch.CPnet) else modes
+            if mode not in available:
+                raise ValueError(f"runtime mode {mode} not available for this network, "
+                                 f"available modes: {available}")
+            self.mode = mode
+        elif benchmark and len(modes) > 1:
+            times = {}
+            X = torch.randn(2, net.nbase[0], 128, 128, device=self.device)
+            for mode in modes:
+                self._prepare(mode)
+                self(X)
+                times[mode] = np.inf
+                for _ in range(3):
+                    tic = time.time()
+                    self(X)
+                    times[mode] = min(times[mode], time.time() - tic)
+            self.mode = min(times, key=times.get)
+            core_logger.info("network runtime benchmark: " + 
+                             ", ".join([f"{mode} {t:0.3f}s" for mode, t in times.items()]) +
+                             f", using {self.mode}")
+        else:
+            self.mode = modes[0]
+        self._prepare(self.mode)
+
+    def _prepare(self, mode):
+        """ make the copy of the network used in mode (None to use the network as is) """
+        self.mode = mode
+        net = self._net()
+        if mode == "fused":
+            self.net = net.fuse_for_inference(verify=True)
+            return
+        elif mode == "float32":
+            if getattr(net, "mkldnn", False):
+                # shallow copy sharing the weights, run without mkldnn
+                self.net = copy.copy(net).eval()
+                self.net.mkldnn = False
+            else:
+                self.net = None
+            return
+        self.net = copy.deepcopy(net).eval()
+        if mode == "mkldnn":
+            self.net.mkldnn = True
+            self.net = mkldnn_utils.to_mkldnn(self.net)
+        else:
+            self.net.mkldnn = False
+            if mode in ["channels_last", "bf16"]:
+                self.net = self.net.to(memory_format=torch.channels_last)
+
+    def __call__(self, X):
+        """Runs the network on the torch tensor X.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: The output predictions and style features (float32).
+        """
+        y, style = self._run(X, lambda net, X: net(X)[:2])
+        return y, style
+
+    def style(self, X):
+        """Runs the downsampling half of the network on the torch tensor X (see CPnet.forward_style).
+
+        Returns:
+            torch.Tensor: The style features (float32).
+        """
+        return self._run(X, lambda net, X: (net.forward_style(X),))[0]
+
+    def _run(self, X, func):
+        """ runs func(net, X) in the mode of the runtime, returns outputs as float32 """
+        net = self.net
+        if net is None:
+            net = self._net()
+            net.eval()
+        with torch.inference_mode():
+            if self.mode in ["channels_last", "bf16"]:
+                X = X.contiguous(memory_format=torch.channels_last)
+            if self.mode == "bf16":
+                with torch.autocast("cpu", dtype=torch.bfloat16):
+                    outputs = func(net, X)
+                outputs = [out.float() for out in outputs]
+            else:
+                outputs = func(net, X)
+        return outputs
+
+
+def _runtime_key(net):
+    """ key changing when the weights, device, mkldnn or runtime settings of net change """
+    return (getattr(net, "mkldnn", False), getattr(net, "bf16", False),
+            getattr(net, "runtime_mode", None),
+            tuple((id(t), t._version) for t in net.parameters()),
+            tuple((id(t), t._version) for t in net.buffers()))
+
+
+_runtimes = weakref.WeakKeyDictionary()
+_runtimes_lock = threading.Lock()
+
+
+def get_runtime(net):
+    """Get the InferenceRuntime of the network, created at the first call and 
+    recreated when the weights of the network change.
+
+    Args:
+        net (torch.nn.Module): The network model.
+
+    Returns:
+        InferenceRuntime: runtime to run the network for inference.
+    """
+    with _runtimes_lock:
+        runtime = _runtimes.get(net)
+        if runtime is None or runtime.key != _runtime_key(net):
+            runtime = InferenceRuntime(net)
+            _runtimes[net] = runtime
+    return runtime
+
+
+class _OutputsNet(nn.Module):
+    """ network returning only the output and the style, for export """
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        return self.net(x)[:2]
+
+
+def export_onnx(net, filename, opset_version=17):
+    """Export the network to ONNX, with dynamic batch and spatial axes.
+
+    The exported network has input "x" [batch x nchan x Ly x Lx] (Ly and Lx divisible by 16) 
+    and outputs "y" [batch x nout x Ly x Lx] and "style" [batch x nstyle].
+
+    Args:
+        net (CPnet): The network model.
+        filename (str or file-like object): File to save the ONNX network to.
+        opset_version (int, optional): ONNX opset version. Defaults to 17.
+    """
+    net = copy.deepcopy(net).cpu().eval()
+    net.mkldnn = False
+    X = torch.zeros((1, net.nbase[0], 224, 224))
+    # use TorchScript exporter in torch>=2.5 (dynamo exporter requires onnxscript)
+    kwargs = {"dynamo": False} if "dynamo" in inspect.signature(
+        torch.onnx.export).parameters else {}
+    spatial_axes = {0: "batch", 2: "Ly", 3: "Lx"}
+    torch.onnx.export(_OutputsNet(net).eval(), X, filename, input_names=["x"],
+                      output_names=["y", "style"],
+                      dynamic_axes={"x": spatial_axes, "y": spatial_axes,
+                                    "style": {0: "batch"}},
+                      opset_version=opset_version, **kwargs)
+
+
+class OnnxNet():
+    """Network run with onnxruntime on the CPU, used in place of the torch network 
+    in run_net and run_3D (backend="onnx").
+
+    Args:
+        model (str or bytes): ONNX network file (see export_onnx) or its contents.
+        nthreads (int, optional): Number of threads used by onnxruntime. Defaults to None (all cores).
+
+    Attributes:
+        session (onnxruntime.InferenceSession): onnxruntime session with all graph optimizations.
+        nout (int): Number of output channels.
+        nstyle (int): Size of the style vector.
+    """
+
+    def __init__(self, model, nthreads=None):
+        if not ONNX_ENABLED:
+            raise ImportError("onnxruntime is not installed, install with pip install onnxruntime")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if nthreads is not None:
+            options.intra_op_num_threads = nthreads
+        self.session = onnxruntime.InferenceSession(model, sess_options=options,
+                                                    providers=["CPUExecutionProvider"])
+        self.nout = self.session.get_outputs()[0].shape[1]
+        self.nstyle = self.session.get_outputs()[1].shape[1]
+        self.device = torch.device("cpu")
+
+    def __call__(self, x):
+        """Runs the network on the images x [batch x nchan x Ly x Lx].
+
+        Returns:
+            Tuple[numpy.ndarray, numpy.ndarray]: The output predictions and style features.
+        """
+        y, style = self.session.run(None, {"x": np.ascontiguousarray(x, dtype=np.float32)})
+        return y, style
+
+
+def make_calibration_tiles(imgs, bsize=224, ntiles=32, tile_overlap=0.1, seed=0):
+    """Sample tiles from images to calibrate the quantization of the network.
+
+    Args:
+        imgs (list of np.ndarray): Normalized (and rescaled) images of size [Ly x Lx x nchan].
+        bsize (int, optional): Size of tiles in pixels. Defaults to 224.
+        ntiles (int, optional): Maximum number of tiles. Defaults to 32.
+        tile_overlap (float, optional): Fraction of overlap of tiles. Defaults to 0.1.
+        seed (int, optional): Seed of the random sampling of tiles. Defaults to 0.
+
+    Returns:
+        np.ndarray: Tiles of size [ntiles x nchan x bsize x bsize] (or smaller if the images are smaller).
+    """
+    tiles = []
+    for img in imgs:
+        img = img[np.newaxis] if img.ndim == 2 else np.transpose(img, (2, 0, 1))
+        img = transforms.pad_image_ND(img)[0]
+        IMG = transforms.make_tiles(img, bsize=bsize, tile_overlap=tile_overlap)[0]
+        tiles.append(IMG.reshape(-1, *IMG.shape[-3:]))
+    # tiles of the most common size
+    shapes = [t.shape[1:] for t in tiles]
+    shape = max(set(shapes), key=shapes.count)
+    tiles = np.concatenate([t for t in tiles if t.shape[1:] == shape], axis=0)
+    if len(tiles) > ntiles:
+        rng = np.random.default_rng(seed)
+        tiles = tiles[np.sort(rng.choice(len(tiles), ntiles, replace=False))]
+    return tiles.astype(np.float32)
+
+
+def quantize_onnx(net, tiles, filename=None, batch_size=8, nthreads=None):
+    """Post-training static INT8 quantization of the network with onnxruntime.
+
+    The network is exported to ONNX and its convolutions are quantized (int8 weights per channel, 
+    uint8 activations in QDQ format), with the activation ranges calibrated on the tiles.
+
+    Args:
+        net (CPnet): The network model.
+        tiles (np.ndarray): Calibration tiles [ntiles x nchan x ly x lx], normalized as network input 
+            (see make_calibration_tiles).
+        filename (str, optional): File to save the quantized ONNX network to. Defaults to None.
+        batch_size (int, optional): Number of tiles per calibration batch. Defaults to 8.
+        nthreads (int, optional): Number of threads used by onnxruntime. Defaults to None.
+
+    Returns:
+        OnnxNet: quantized network run with onnxruntime.
+    """
+    if not ONNX_ENABLED:
+        raise ImportError("onnxruntime is not installed, install with pip install onnxruntime")
+    from onnxruntime import quantization
+
+    class CalibrationTiles(quantization.CalibrationDataReader):
+
+        def __init__(self):
+            self.batches = iter(range(0, len(tiles), batch_size))
+
+        def get_next(self):
+            k = next(self.batches, None)
+            return None if k is None else {"x": tiles[k:k + batch_size]}
+
+    tic = time.time()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fp32_file = os.path.join(tmpdir, "net.onnx")
+        pre_file = os.path.join(tmpdir, "net_pre.onnx")
+        int8_file = os.path.join(tmpdir, "net_int8.onnx")
+        export_onnx(net, fp32_file)
+        # symbolic shape inference does not support the dynamic spatial axes
+        quantization.quant_pre_process(fp32_file, pre_file, skip_symbolic_shape=True)
+        quantization.quantize_static(pre_file, int8_file, CalibrationTiles(),
+                                     quant_format=quantization.QuantFormat.QDQ,
+                                     op_types_to_quantize=["Conv"], per_channel=True,
+                                     activation_type=quantization.QuantType.QUInt8,
+                                     weight_type=quantization.QuantType.QInt8)
+        if filename is not None:
+            shutil.copyfile(int8_file, filename)
+        with open(int8_file, "rb") as f:
+            onnx_net = OnnxNet(f.read(), nthreads=nthreads)
+    core_logger.info(f"network quantized to int8 with {len(tiles)} calibration tiles "
+                     f"in {time.time() - tic:0.2f}s")
+    return onnx_net
+
+
+_onnx_nets = weakref.WeakKeyDictionary()
+
+
+def get_onnx_net(net):
+    """Get the network exported to ONNX and loaded in onnxruntime, exported at the first call
+    and again when the weights of the network change.
+
+    Args:
+        net (CPnet or OnnxNet): The network model.
+
+    Returns:
+        OnnxNet: network run with onnxruntime.
+    """
+    if isinstance(net, OnnxNet):
+        return net
+    with _runtimes_lock:
+        key, onnx_net = _onnx_nets.get(net, (None, None))
+        if onnx_net is None or key != _runtime_key(net):
+            f = io.BytesIO()
+            export_onnx(net, f)
+            onnx_net = OnnxNet(f.getvalue())
+            _onnx_nets[net] = (_runtime_key(net), onnx_net)
+    return onnx_net
+
+
+def _get_net(net, backend):
+    """ network to run for backend "torch" or "onnx" """
+    if backend == "onnx":
+        return get_onnx_net(net)
+    elif backend != "torch":
+        raise ValueError(f"backend must be 'torch' or 'onnx', not {backend}")
+    return net
+
+
 def _forward(net, x):
     """Converts images to torch tensors, runs the network model, and returns numpy arrays.
 
+    The network is run with its InferenceRuntime (see get_runtime), or with onnxruntime if it is an OnnxNet.
+
     Args:
         net (torch.nn.Module): The network model.
         x (numpy.ndarray): The input images.
@@ -168,20 +530,217 @@ def _forward(net, x):
     Returns:
         Tuple[numpy.ndarray, numpy.ndarray]: The output predictions (flows and cellprob) and style features.
     """
-    X = _to_device(x, net.device)
-    net.eval()
-    if net.mkldnn:
-        net = mkldnn_utils.to_mkldnn(net)
-    with torch.no_grad():
-        y, style = net(X)[:2]
+    if isinstance(net, OnnxNet):
+        return net(x)
+    runtime = get_runtime(net)
+    X = _to_device(x, runtime.device)
+    y, style = runtime(X)
     del X
     y = _from_device(y)
     style = _from_device(style)
     return y, style
 
 
+def tile_memory(net, bsize=224):
+    """Estimate the memory needed to run one [bsize x bsize] tile through the network.
+
+    Counts the activations of each level of the network (kept for the skip connections 
+    and the upsample path), with a margin for the temporary tensors within each block.
+
+    Args:
+        net (torch.nn.Module): The network model.
+        bsize (int, optional): Size of tiles in pixels. Defaults to 224.
+
+    Returns:
+        int: Estimated memory in bytes.
+    """
+    nbase = net.nbase[1:] if hasattr(net, "nbase") else [32, 64, 128, 256]
+    nvals = sum(nb * (bsize // 2**k)**2 for k, nb in enumerate(nbase))
+    # float32, about 8 tensors of each size alive at once (downsample + upsample paths)
+    return 4 * 8 * nvals
+
+
+def available_memory(device):
+    """Free memory on the device (CUDA) or available RAM (CPU) in bytes, or None if unknown.
+
+    Args:
+        device (torch.device): The device.
+
+    Returns:
+        int or None: Available memory in bytes.
+    """
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_batch_size(net, bsize=224, memory_budget=None):
+    """Largest number of [bsize x bsize] tiles to run in a batch within the memory budget.
+
+    Args:
+        net (torch.nn.Module): The network model.
+        bsize (int, optional): Size of tiles in pixels. Defaults to 224.
+        memory_budget (float, optional): Memory budget in GB. Defaults to None 
+            (half of the available memory on the device, or 8 tiles if unknown).
+
+    Returns:
+        int: Batch size.
+    """
+    if memory_budget is None:
+        free = available_memory(net.device)
+        if free is None:
+            return 8
+        budget = free / 2
+    else:
+        budget = memory_budget * 1e9
+    batch_size = max(1, int(budget // tile_memory(net, bsize)))
+    core_logger.info(f"batch_size set to {batch_size} for memory budget {budget / 1e9:.1f}GB")
+    return batch_size
+
+
+def _is_oom(error):
+    """Check if an error raised by torch is an out-of-memory error."""
+    return isinstance(error, MemoryError) or (isinstance(error, RuntimeError) and
+                                              ("out of memory" in str(error) or
+                                               "can't allocate memory" in str(error)))
+
+
+def _forward_style(net, x):
+    """Converts images to torch tensors, runs the downsampling half of the network 
+    and returns the style features (see CPnet.forward_style).
+
+    Args:
+        net (torch.nn.Module): The network model.
+        x (numpy.ndarray): The input images.
+
+    Returns:
+        numpy.ndarray: The style features.
+    """
+    if isinstance(net, OnnxNet) or not hasattr(net, "forward_style"):
+        return _forward(net, x)[1]
+    runtime = get_runtime(net)
+    X = _to_device(x, runtime.device)
+    style = runtime.style(X)
+    del X
+    return _from_device(style)
+
+
+def _forward_batched(net, x, batch_size=8, backoff=False, style_only=False):
+    """Runs the network on the images x in batches of batch_size.
+
+    Args:
+        net (torch.nn.Module): The network model.
+        x (numpy.ndarray): The input images.
+        batch_size (int, optional): Number of images to run in a batch. Defaults to 8.
+        backoff (bool, optional): Halve the batch size and retry if a batch runs out of memory. Defaults to False.
+        style_only (bool, optional): Only compute the style features (output predictions are None). Defaults to False.
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray, int]: The output predictions, the style features 
+            of each image, and the batch size used for the last batch.
+    """
+    y, style = [], []
+    k = 0
+    while k < x.shape[0]:
+        try:
+            if style_only:
+                y0, style0 = None, _forward_style(net, x[k:k + batch_size])
+            else:
+                y0, style0 = _forward(net, x[k:k + batch_size])
+        except (RuntimeError, MemoryError) as error:
+            if not backoff or batch_size == 1 or not _is_oom(error):
+                raise
+            batch_size = batch_size // 2
+            core_logger.warning(f"out of memory, reducing batch_size to {batch_size}")
+            if net.device.type == "cuda":
+                torch.cuda.empty_cache()
+            continue
+        y.append(y0)
+        style.append(style0)
+        k += len(style0)
+    y = None if style_only else np.concatenate(y, axis=0)
+    return y, np.concatenate(style, axis=0), batch_size
+
+
+def _run_tiles(net, IMG, tilings, batch_size=8, backoff=False, augment=False,
+               skip_background=None):
+    """Runs the network on the tiles of one or more images in batches, adding the tapered 
+    outputs of each batch to the averaged outputs of the images as soon as the batch is done, 
+    so that memory does not grow with the number of tiles.
+
+    Args:
+        net (torch.nn.Module): The network model.
+        IMG (numpy.ndarray): Tiles of the images [ntiles x nchan x ly x lx], the tiles of each image consecutive.
+        tilings (list): (ysub, xsub, Ly, Lx, nx) of each image, as returned by make_tiles (nx tiles in X).
+        batch_size (int, optional): Number of tiles to run in a batch. Defaults to 8.
+        backoff (bool, optional): Halve the batch size if a batch runs out of memory. Defaults to False.
+        augment (bool, optional): Tiles were made with augment=True and are unaugmented. Defaults to False.
+        skip_background (float, optional): Tiles found to be background with this threshold 
+            (see transforms.background_tiles) are not run and get the background output 
+            (zero flows, cell probability BACKGROUND_CELLPROB). Defaults to None (all tiles are run).
+
+    Returns:
+        Tuple[list, list, int]: The outputs of each image averaged over tiles [nout x Ly x Lx], 
+            the normalized style of each image, and the batch size used for the last batch.
+    """
+    starts = np.cumsum([0] + [len(tiling[0]) for tiling in tilings])
+    yf = [np.zeros((net.nout, Ly, Lx), np.float32) for (_, _, Ly, Lx, _) in tilings]
+    styles = [0] * len(tilings)
+    nrun = np.zeros(len(tilings), "int")
+
+    def add_tile(t, y):
+        # add output y of tile t to the output of its image
+        i = np.searchsorted(starts, t, side="right") - 1
+        ysub, xsub, Ly, Lx, nx = tilings[i]
+        l = t - starts[i]
+        if augment:
+            transforms.unaugment_tile(y, l // nx, l % nx)
+        transforms.accumulate_tiles(yf[i], y[np.newaxis], ysub[l:l + 1], xsub[l:l + 1])
+        return i
+
+    if skip_background is not None:
+        if net.nout < 3:
+            raise ValueError("skip_background needs a network with flows and cellprob outputs")
+        background = transforms.background_tiles(IMG, threshold=skip_background)
+        ybg = np.zeros((net.nout, *IMG.shape[-2:]), np.float32)
+        ybg[2] = BACKGROUND_CELLPROB
+        for t in np.nonzero(background)[0]:
+            add_tile(t, ybg)
+        core_logger.info(f"skipped {background.sum()} of {len(IMG)} tiles as background")
+        inds = np.nonzero(~background)[0]
+    else:
+        inds = np.arange(len(IMG))
+
+    k = 0
+    while k < len(inds):
+        if len(inds) == len(IMG):
+            x = IMG[k:k + batch_size]
+        else:
+            x = IMG[inds[k:k + batch_size]]
+        y, style, batch_size = _forward_batched(net, x, batch_size=batch_size,
+                                                backoff=backoff)
+        for j in range(len(y)):
+            i = add_tile(inds[k + j], y[j])
+            styles[i] = styles[i] + style[j]
+            nrun[i] += 1
+        k += len(y)
+    for i, (ysub, xsub, Ly, Lx, _) in enumerate(tilings):
+        yf[i] /= transforms.tile_weights(ysub, xsub, Ly, Lx)
+        if nrun[i] > 0:
+            styles[i] = styles[i] / nrun[i]
+            styles[i] /= (styles[i]**2).sum()**0.5
+        else:
+            # all tiles are background
+            styles[i] = np.zeros(net.nbase[-1] if hasattr(net, "nbase") else net.nstyle,
+                                 np.float32)
+    return yf, styles, batch_size
+
+
 def run_net(net, imgs, batch_size=8, augment=False, tile=True, tile_overlap=0.1, 
-            bsize=224):
+            bsize=224, memory_budget=None, backend="torch", skip_background=None):
     """ 
     Run network on image or stack of images.
     
@@ -190,18 +749,31 @@ def run_net(net, imgs, batch_size=8, augment=False, tile=True, tile_overlap=0.1,
     Args:
         net (class): cellpose network (model.net)
         imgs (np.ndarray): The input image or stack of images of size [Ly x Lx x nchan] or [Lz x Ly x Lx x nchan].
-        batch_size (int, optional): Number of tiles to run in a batch. Defaults to 8.
-        rsz (float, optional): Resize coefficient(s) for image. Defaults to 1.0.
+        batch_size (int or str, optional): Number of tiles to run in a batch, or "auto" to use the largest 
+            batch that fits in memory_budget (reduced if a batch runs out of memory). Defaults to 8.
         augment (bool, optional): Tiles image with overlapping tiles and flips overlapped regions to augment. Defaults to False.
         tile (bool, optional): Tiles image to ensure GPU/CPU memory usage limited (recommended); cannot be turned off for 3D segmentation. Defaults to True.
         tile_overlap (float, optional): Fraction of overlap of tiles when computing flows. Defaults to 0.1.
         bsize (int, optional): Size of tiles to use in pixels [bsize x bsize]. Defaults to 224.
+        memory_budget (float, optional): Memory budget in GB for batch_size="auto". Defaults to None 
+            (half of the available memory, see get_batch_size).
+        backend (str, optional): "torch", or "onnx" to run the network exported to ONNX with onnxruntime 
+            on the CPU (see get_onnx_net). Defaults to "torch".
+        skip_background (float, optional): If not None, tiles whose normalized intensity is below this 
+            threshold (see transforms.background_tiles) are not run through the network and get zero 
+            flows and cell probability BACKGROUND_CELLPROB; faster on sparse images (e.g. 0.1). 
+            The number of skipped tiles is logged. Defaults to None.
 
     Returns:
         y (np.ndarray): output of network, if tiled it is averaged in tile overlaps. Size of [Ly x Lx x 3] or [Lz x Ly x Lx x 3].
             y[...,0] is Y flow; y[...,1] is X flow; y[...,2] is cell probability.
         style (np.ndarray): 1D array of size 256 summarizing the style of the image, if tiled it is averaged over tiles.
     """
+    net = _get_net(net, backend)
+    backoff = batch_size == "auto"
+    if backoff:
+        batch_size = get_batch_size(net, bsize=bsize, memory_budget=memory_budget)
+
     if imgs.ndim == 4:
         # make image Lz x nchan x Ly x Lx for net
         imgs = np.transpose(imgs, (0, 3, 1, 2))
@@ -227,12 +799,14 @@ def run_net(net, imgs, batch_size=8, augment=False, tile=True, tile_overlap=0.1,
     # run network
     if tile or augment or imgs.ndim == 4:
         y, style = _run_tiled(net, imgs, augment=augment, bsize=bsize, 
-                              batch_size=batch_size, tile_overlap=tile_overlap)
+                              batch_size=batch_size, tile_overlap=tile_overlap,
+                              backoff=backoff, skip_background=skip_background)
     else:
         imgs = np.expand_dims(imgs, axis=0)
         y, style = _forward(net, imgs)
         y, style = y[0], style[0]
-    style /= (style**2).sum()**0.5
+    if (style**2).sum() > 0:
+        style /= (style**2).sum()**0.5
 
     # slice out padding
     y = y[slc]
@@ -241,18 +815,147 @@ def run_net(net, imgs, batch_size=8, augment=False, tile=True, tile_overlap=0.1,
 
     return y, style
 
-def _run_tiled(net, imgi, batch_size=8, augment=False, bsize=224, tile_overlap=0.1):
+def run_net_batch(net, imgs, batch_size=8, augment=False, tile=True, tile_overlap=0.1,
+                  bsize=224, memory_budget=None, backend="torch", skip_background=None):
+    """ 
+    Run network on a list of 2D images, batching tiles across images.
+
+    The tiles of all images are run through the network together in full batches, 
+    so small images (with only a few tiles each) do not run with mostly empty batches. 
+    Same outputs as running run_net on each image.
+
+    Args:
+        net (class): cellpose network (model.net)
+        imgs (list of np.ndarray): The input images, each of size [Ly x Lx x nchan] or [Ly x Lx].
+        batch_size (int or str, optional): Number of tiles to run in a batch, or "auto" (see run_net). Defaults to 8.
+        augment (bool, optional): Tiles image with overlapping tiles and flips overlapped regions to augment. Defaults to False.
+        tile (bool, optional): Tiles image to ensure GPU/CPU memory usage limited (recommended). 
+            If False, each image is run on its own with run_net. Defaults to True.
+        tile_overlap (float, optional): Fraction of overlap of tiles when computing flows. Defaults to 0.1.
+        bsize (int, optional): Size of tiles to use in pixels [bsize x bsize]. Defaults to 224.
+        memory_budget (float, optional): Memory budget in GB for batch_size="auto". Defaults to None.
+        backend (str, optional): "torch" or "onnx" (see run_net). Defaults to "torch".
+        skip_background (float, optional): Threshold to skip background tiles (see run_net). Defaults to None.
+
+    Returns:
+        y (list of np.ndarray): output of network for each image, of size [Ly x Lx x 3].
+        style (list of np.ndarray): 1D array of size 256 summarizing the style of each image.
+    """
+    net = _get_net(net, backend)
+    if not (tile or augment):
+        outputs = [run_net(net, img, batch_size=batch_size, augment=augment, tile=tile,
+                           tile_overlap=tile_overlap, bsize=bsize,
+                           memory_budget=memory_budget,
+                           skip_background=skip_background) for img in imgs]
+        return [out[0] for out in outputs], [out[1] for out in outputs]
+
+    backoff = batch_size == "auto"
+    if backoff:
+        batch_size = get_batch_size(net, bsize=bsize, memory_budget=memory_budget)
+
+    tiles, tiling = [], []
+    for img in imgs:
+        img = img[np.newaxis] if img.ndim == 2 else np.transpose(img, (2, 0, 1))
+        img, ysub, xsub = transforms.pad_image_ND(img)
+        IMG, ysubt, xsubt, Ly, Lx = transforms.make_tiles(img, bsize=bsize,
+                                                          augment=augment,
+                                                          tile_overlap=tile_overlap)
+        ny, nx, nchan, ly, lx = IMG.shape
+        tiles.append(np.reshape(IMG, (ny * nx, nchan, ly, lx)))
+        tiling.append((ysubt, xsubt, Ly, Lx, nx, img.shape[1:],
+                       slice(ysub[0], ysub[-1] + 1), slice(xsub[0], xsub[-1] + 1)))
+
+    # images smaller than bsize have smaller tiles, run tiles of the same size together
+    groups = {}
+    for i, IMG in enumerate(tiles):
+        groups.setdefault(IMG.shape[1:], []).append(i)
+    y, style = [None] * len(tiles), [None] * len(tiles)
+    for inds in groups.values():
+        yfs, styles, batch_size = _run_tiles(
+            net, np.concatenate([tiles[i] for i in inds], axis=0),
+            [tiling[i][:5] for i in inds], batch_size=batch_size, backoff=backoff,
+            augment=augment, skip_background=skip_background)
+        for i, yf, stylei in zip(inds, yfs, styles):
+            shape, slcy, slcx = tiling[i][5:]
+            yf = yf[:3, :shape[0], :shape[1]][:, slcy, slcx]
+            y[i] = np.transpose(yf, (1, 2, 0))
+            style[i] = stylei
+    return y, style
+
+
+def run_style(net, imgs, batch_size=8, augment=False, tile=True, tile_overlap=0.1,
+              bsize=224, memory_budget=None, backend="torch"):
+    """ 
+    Compute the style of a list of 2D images, running only the downsampling half of the network.
+
+    The images are tiled as in run_net_batch and the tiles of all images are run together, 
+    but without the upsample pass and the averaging of outputs over tiles. 
+    Same styles as run_net_batch.
+
+    Args:
+        net (class): cellpose network (model.net)
+        imgs (list of np.ndarray): The input images, each of size [Ly x Lx x nchan] or [Ly x Lx].
+        batch_size (int or str, optional): Number of tiles to run in a batch, or "auto" (see run_net). Defaults to 8.
+        augment (bool, optional): Tiles image with overlapping tiles and flips overlapped regions to augment. Defaults to False.
+        tile (bool, optional): Tiles image to ensure GPU/CPU memory usage limited (recommended). Defaults to True.
+        tile_overlap (float, optional): Fraction of overlap of tiles. Defaults to 0.1.
+        bsize (int, optional): Size of tiles to use in pixels [bsize x bsize]. Defaults to 224.
+        memory_budget (float, optional): Memory budget in GB for batch_size="auto". Defaults to None.
+        backend (str, optional): "torch" or "onnx" (see run_net, the full network is run with onnx). 
+            Defaults to "torch".
+
+    Returns:
+        style (list of np.ndarray): 1D array of size 256 summarizing the style of each image.
+    """
+    net = _get_net(net, backend)
+    backoff = batch_size == "auto"
+    if backoff:
+        batch_size = get_batch_size(net, bsize=bsize, memory_budget=memory_budget)
+
+    tiles = []
+    for img in imgs:
+        img = img[np.newaxis] if img.ndim == 2 else np.transpose(img, (2, 0, 1))
+        img = transforms.pad_image_ND(img)[0]
+        if tile or augment:
+            IMG = transforms.make_tiles(img, bsize=bsize, augment=augment,
+                                        tile_overlap=tile_overlap)[0]
+            tiles.append(IMG.reshape(-1, *IMG.shape[-3:]))
+        else:
+            tiles.append(img[np.newaxis].astype(np.float32))
+
+    groups = {}
+    for i, IMG in enumerate(tiles):
+        groups.setdefault(IMG.shape[1:], []).append(i)
+    style = [None] * len(tiles)
+    for inds in groups.values():
+        stylea = _forward_batched(net, np.concatenate([tiles[i] for i in inds], axis=0),
+                                  batch_size=batch_size, backoff=backoff,
+                                  style_only=True)[1]
+        starts = np.cumsum([0] + [len(tiles[i]) for i in inds])
+        for j, i in enumerate(inds):
+            stylei = stylea[starts[j]:starts[j + 1]].sum(axis=0) / (starts[j + 1] - starts[j])
+            stylei /= (stylei**2).sum()**0.5
+            style[i] = stylei
+    return style
+
+
+def _run_tiled(net, imgi, batch_size=8, augment=False, bsize=224, tile_overlap=0.1,
+               backoff=False, skip_background=None):
     """ 
     Run network on tiles of size [bsize x bsize]
     
     (faster if augment is False)
 
+    The outputs of each batch of tiles are averaged into the output as soon as the batch is done.
+
     Args:
         imgs (np.ndarray): The input image or stack of images of size [Ly x Lx x nchan] or [Lz x Ly x Lx x nchan].
         batch_size (int, optional): Number of tiles to run in a batch. Defaults to 8.
         augment (bool, optional): Tiles image with overlapping tiles and flips overlapped regions to augment. Defaults to False.
         tile_overlap (float, optional): Fraction of overlap of tiles when computing flows. Defaults to 0.1.
         bsize (int, optional): Size of tiles to use in pixels [bsize x bsize]. Defaults to 224.
+        backoff (bool, optional): Halve the batch size if a batch runs out of memory. Defaults to False.
+        skip_background (float, optional): Threshold to skip background tiles (see run_net). Defaults to None.
 
     Returns:
         y (np.ndarray): output of network, if tiled it is averaged in tile overlaps. Size of [Ly x Lx x 3] or [Lz x Ly x Lx x 3].
@@ -266,20 +969,22 @@ def _run_tiled(net, imgi, batch_size=8, augment=False, bsize=224, tile_overlap=0
                                                         augment=augment,
                                                         tile_overlap=tile_overlap)
         ny, nx, nchan, ly, lx = IMG.shape
-        batch_size *= max(4, (bsize**2 // (ly * lx))**0.5)
+        batch_size_planes = batch_size * max(4, (bsize**2 // (ly * lx))**0.5)
         yf = np.zeros((Lz, nout, imgi.shape[-2], imgi.shape[-1]), np.float32)
         styles = []
-        if ny * nx > batch_size:
+        if ny * nx > batch_size_planes:
             ziterator = trange(Lz, file=tqdm_out)
             for i in ziterator:
-                yfi, stylei = _run_tiled(net, imgi[i], augment=augment, bsize=bsize,
-                                         tile_overlap=tile_overlap)
+                yfi, stylei = _run_tiled(net, imgi[i], batch_size=batch_size,
+                                         augment=augment, bsize=bsize,
+                                         tile_overlap=tile_overlap, backoff=backoff,
+                                         skip_background=skip_background)
                 yf[i] = yfi
                 styles.append(stylei)
         else:
             # run multiple slices at the same time
             ntiles = ny * nx
-            nimgs = max(2, int(np.round(batch_size / ntiles)))
+            nimgs = max(2, int(np.round(batch_size_planes / ntiles)))
             niter = int(np.ceil(Lz / nimgs))
             ziterator = trange(niter, file=tqdm_out)
             for k in ziterator:
@@ -290,19 +995,15 @@ def _run_tiled(net, imgi, batch_size=8, augment=False, bsize=224, tile_overlap=0
                         tile_overlap=tile_overlap)
                     IMGa[i * ntiles:(i + 1) * ntiles] = np.reshape(
                         IMG, (ny * nx, nchan, ly, lx))
-                ya, stylea = _forward(net, IMGa)
-                for i in range(min(Lz - k * nimgs, nimgs)):
-                    y = ya[i * ntiles:(i + 1) * ntiles]
-                    if augment:
-                        y = np.reshape(y, (ny, nx, 3, ly, lx))
-                        y = transforms.unaugment_tiles(y)
-                        y = np.reshape(y, (-1, 3, ly, lx))
-                    yfi = transforms.average_tiles(y, ysub, xsub, Ly, Lx)
-                    yfi = yfi[:, :imgi.shape[2], :imgi.shape[3]]
-                    yf[k * nimgs + i] = yfi
-                    stylei = stylea[i * ntiles:(i + 1) * ntiles].sum(axis=0)
-                    stylei /= (stylei**2).sum()**0.5
-                    styles.append(stylei)
+                nplanes = min(Lz - k * nimgs, nimgs)
+                yfs, stylea, nbatch = _run_tiles(net, IMGa[:nplanes * ntiles],
+                                                 [(ysub, xsub, Ly, Lx, nx)] * nplanes,
+                                                 batch_size=len(IMGa), backoff=backoff,
+                                                 augment=augment,
+                                                 skip_background=skip_background)
+                for i in range(nplanes):
+                    yf[k * nimgs + i] = yfs[i][:, :imgi.shape[2], :imgi.shape[3]]
+                    styles.append(stylea[i])
         return yf, np.array(styles)
     else:
         IMG, ysub, xsub, Ly, Lx = transforms.make_tiles(imgi, bsize=bsize,
@@ -310,33 +1011,18 @@ def _run_tiled(net, imgi, batch_size=8, augment=False, bsize=224, tile_overlap=0
                                                         tile_overlap=tile_overlap)
         ny, nx, nchan, ly, lx = IMG.shape
         IMG = np.reshape(IMG, (ny * nx, nchan, ly, lx))
-        niter = int(np.ceil(IMG.shape[0] / batch_size))
-        y = np.zeros((IMG.shape[0], nout, ly, lx))
-        for k in range(niter):
-            irange = slice(batch_size * k, min(IMG.shape[0],
-                                               batch_size * k + batch_size))
-            y0, style = _forward(net, IMG[irange])
-            y[irange] = y0.reshape(irange.stop - irange.start, y0.shape[-3],
-                                   y0.shape[-2], y0.shape[-1])
-            # check size models!
-            if k == 0:
-                styles = style.sum(axis=0)
-            else:
-                styles += style.sum(axis=0)
-        styles /= IMG.shape[0]
-        if augment:
-            y = np.reshape(y, (ny, nx, nout, bsize, bsize))
-            y = transforms.unaugment_tiles(y)
-            y = np.reshape(y, (-1, nout, bsize, bsize))
-
-        yf = transforms.average_tiles(y, ysub, xsub, Ly, Lx)
+        yf, styles, batch_size = _run_tiles(net, IMG, [(ysub, xsub, Ly, Lx, nx)],
+                                            batch_size=batch_size, backoff=backoff,
+                                            augment=augment,
+                                            skip_background=skip_background)
+        yf, styles = yf[0], styles[0]
         yf = yf[:, :imgi.shape[1], :imgi.shape[2]]
-        styles /= (styles**2).sum()**0.5
         return yf, styles
 
 
 def run_3D(net, imgs, batch_size=8, rsz=1.0, anisotropy=None, augment=False, tile=True,
-           tile_overlap=0.1, bsize=224, progress=None):
+           tile_overlap=0.1, bsize=224, progress=None, memory_budget=None, backend="torch",
+           skip_background=None):
     """ 
     Run network on image z-stack.
     
@@ -344,7 +1030,7 @@ def run_3D(net, imgs, batch_size=8, rsz=1.0, anisotropy=None, augment=False, til
 
     Args:
         imgs (np.ndarray): The input image stack of size [Lz x Ly x Lx x nchan].
-        batch_size (int, optional): Number of tiles to run in a batch. Defaults to 8.
+        batch_size (int or str, optional): Number of tiles to run in a batch, or "auto" (see run_net). Defaults to 8.
         rsz (float, optional): Resize coefficient(s) for image. Defaults to 1.0.
         anisotropy (float, optional): for 3D segmentation, optional rescaling factor (e.g. set to 2.0 if Z is sampled half as dense as X or Y). Defaults to None.
         augment (bool, optional): Tiles image with overlapping tiles and flips overlapped regions to augment. Defaults to False.
@@ -352,6 +1038,9 @@ def run_3D(net, imgs, batch_size=8, rsz=1.0, anisotropy=None, augment=False, til
         tile_overlap (float, optional): Fraction of overlap of tiles when computing flows. Defaults to 0.1.
         bsize (int, optional): Size of tiles to use in pixels [bsize x bsize]. Defaults to 224.
         progress (QProgressBar, optional): pyqt progress bar. Defaults to None.
+        memory_budget (float, optional): Memory budget in GB for batch_size="auto". Defaults to None.
+        backend (str, optional): "torch" or "onnx" (see run_net). Defaults to "torch".
+        skip_background (float, optional): Threshold to skip background tiles (see run_net). Defaults to None.
 
     Returns:
         y (np.ndarray): output of network, if tiled it is averaged in tile overlaps. Size of [Ly x Lx x 3] or [Lz x Ly x Lx x 3].
@@ -365,6 +1054,7 @@ def run_3D(net, imgs, batch_size=8, rsz=1.0, anisotropy=None, augment=False, til
         rescaling = [rsz] * 3
     pm = [(0, 1, 2, 3), (1, 0, 2, 3), (2, 0, 1, 3)]
     ipm = [(3, 0, 1, 2), (3, 1, 0, 2), (3, 1, 2, 0)]
+    net = _get_net(net, backend)
     nout = net.nout
     yf = np.zeros((3, nout, imgs.shape[0], imgs.shape[1], imgs.shape[2]), np.float32)
     for p in range(3):
@@ -376,7 +1066,8 @@ def run_3D(net, imgs, batch_size=8, rsz=1.0, anisotropy=None, augment=False, til
         core_logger.info("running %s: %d planes of size (%d, %d)" %
                          (sstr[p], shape[0], shape[1], shape[2]))
         y, style = run_net(net, xsl, batch_size=batch_size, augment=augment, tile=tile, 
-                            bsize=bsize, tile_overlap=tile_overlap)
+                            bsize=bsize, tile_overlap=tile_overlap,
+                            memory_budget=memory_budget, skip_background=skip_background)
         y = transforms.resize_image(y, shape[1], shape[2])
         yf[p] = y.transpose(ipm[p])
         if progress is not None:
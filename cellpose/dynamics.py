@@ -2,12 +2,16 @@
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
 
-import time, os
-from scipy.ndimage import maximum_filter1d, find_objects, center_of_mass
+import time, os, itertools
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import maximum_filter1d, find_objects, center_of_mass, label
+from scipy.sparse import csr_matrix, identity
+from scipy.sparse.linalg import splu, cg
 import torch
 import numpy as np
 import tifffile
 from tqdm import trange
+import numba
 from numba import njit, prange, float32, int32, vectorize
 import cv2
 import fastremap
@@ -28,7 +32,7 @@ torch_GPU = torch.device("cuda")
 torch_CPU = torch.device("cpu")
 
 
-@njit("(float64[:], int32[:], int32[:], int32, int32, int32, int32)", nogil=True)
+@njit("(float64[:], int32[:], int32[:], int32, int32, int32, int32)", nogil=True, cache=True)
 def _extend_centers(T, y, x, ymed, xmed, Lx, niter):
     """Run diffusion from the center of the mask on the mask pixels.
 
@@ -99,7 +103,7 @@ def _extend_centers_gpu(neighbors, meds, isneighbor, shape, n_iter=200,
             (dz.cpu().squeeze(0), dy.cpu().squeeze(0), dx.cpu().squeeze(0)), axis=-2)
     return mu_torch
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
 def get_centers(masks, slices):
     """
     Get the centers of the masks and their extents.
@@ -265,6 +269,116 @@ def masks_to_flows_gpu_3d(masks, device=None):
     return mu0, mu_c
 
 
+@njit(nogil=True, parallel=True, cache=True)
+def _extend_centers_cells(mu, ypix, xpix, starts, bbox, tstarts, niters, T, Tnew, lidx,
+                          meds):
+    """Run diffusion from the center of each mask on the mask pixels, for all masks in parallel.
+
+    Masks are packed into flat pixel lists (sorted by mask) and processed in parallel 
+    (numba prange). Each mask runs the same diffusion as _extend_centers on its own 
+    section of the scratch buffers T, Tnew and lidx.
+
+    Args:
+        mu (numpy.ndarray): Output flows of shape (2, npixels), for each pixel in ypix / xpix.
+        ypix (numpy.ndarray): y-coordinates of the mask pixels, sorted by mask.
+        xpix (numpy.ndarray): x-coordinates of the mask pixels, sorted by mask.
+        starts (numpy.ndarray): Start of each mask in ypix / xpix, of length nmasks + 1.
+        bbox (numpy.ndarray): Array of shape (nmasks, 4) with ymin, xmin, ly, lx of each mask 
+            (ly and lx include a padding of 1 pixel on each side).
+        tstarts (numpy.ndarray): Start of each mask in T, of length nmasks + 1.
+        niters (numpy.ndarray): Number of iterations to run diffusion for each mask.
+        T (numpy.ndarray): Zero-initialized scratch buffer of size sum(ly * lx).
+        Tnew (numpy.ndarray): Scratch buffer of the same size as ypix.
+        lidx (numpy.ndarray): Scratch buffer of the same size as ypix.
+        meds (numpy.ndarray): Output array of shape (nmasks, 2) for the centers of the masks.
+
+    Returns:
+        None
+    """
+    for c in prange(len(starts) - 1):
+        i0, i1 = starts[c], starts[c + 1]
+        ymin, xmin, ly, lx = bbox[c, 0], bbox[c, 1], bbox[c, 2], bbox[c, 3]
+        Tc = T[tstarts[c]:tstarts[c + 1]]
+
+        ### get center-of-mass within cell
+        ysum, xsum = 0, 0
+        for k in range(i0, i1):
+            ysum += ypix[k] - ymin + 1
+            xsum += xpix[k] - xmin + 1
+        ymean = ysum / (i1 - i0)
+        xmean = xsum / (i1 - i0)
+        imin, dmin = i0, np.inf
+        for k in range(i0, i1):
+            d = ((xpix[k] - xmin + 1) - xmean)**2 + ((ypix[k] - ymin + 1) - ymean)**2
+            if d < dmin:
+                imin, dmin = k, d
+        ymed = ypix[imin] - ymin + 1
+        xmed = xpix[imin] - xmin + 1
+        meds[c, 0] = ymed - 1
+        meds[c, 1] = xmed - 1
+
+        ### run diffusion
+        for k in range(i0, i1):
+            lidx[k] = (ypix[k] - ymin + 1) * lx + (xpix[k] - xmin + 1)
+        for t in range(niters[c]):
+            Tc[ymed * lx + xmed] += 1
+            for k in range(i0, i1):
+                i = lidx[k]
+                Tnew[k] = 1 / 9. * (Tc[i] + Tc[i - lx] + Tc[i + lx] + Tc[i - 1] +
+                                    Tc[i + 1] + Tc[i - lx - 1] + Tc[i - lx + 1] +
+                                    Tc[i + lx - 1] + Tc[i + lx + 1])
+            for k in range(i0, i1):
+                Tc[lidx[k]] = Tnew[k]
+
+        ### gradients of diffused density
+        for k in range(i0, i1):
+            i = lidx[k]
+            mu[0, k] = Tc[i + lx] - Tc[i - lx]
+            mu[1, k] = Tc[i + 1] - Tc[i - 1]
+
+
+def masks_to_flows_pixels(ypix, xpix, starts, niter=None):
+    """Convert masks given as lists of pixels to flows using diffusion from center pixel.
+
+    Each mask is diffused in its own bounding box, so the result does not depend on 
+    the other masks, and memory scales with the number of pixels (see masks_to_flows_cpu).
+
+    Args:
+        ypix (int32, 1D array): y-coordinates of the mask pixels, sorted by mask.
+        xpix (int32, 1D array): x-coordinates of the mask pixels, sorted by mask.
+        starts (int, 1D array): Start of each mask in ypix / xpix.
+        niter (int, optional): Number of iterations of diffusion. Defaults to None 
+            (2 * (ly + lx) for each mask).
+
+    Returns:
+        tuple containing
+            - mu (float, 2D array): Flows in Y = mu[0], flows in X = mu[1] of each pixel, 
+                size [2 x npixels].
+            - meds (int, 2D array): cell centers (in the bounding box of each mask)
+    """
+    # bounding boxes of masks, padded by 1 pixel on each side
+    ymin = np.minimum.reduceat(ypix, starts)
+    xmin = np.minimum.reduceat(xpix, starts)
+    ly = np.maximum.reduceat(ypix, starts) - ymin + 3
+    lx = np.maximum.reduceat(xpix, starts) - xmin + 3
+    bbox = np.stack((ymin, xmin, ly, lx), axis=1).astype(np.int32)
+    tstarts = np.concatenate(([0], np.cumsum(ly.astype(np.int64) * lx)))
+    niters = 2 * (ly + lx) if niter is None else np.full(len(starts), niter)
+    starts = np.append(starts, ypix.size)
+
+    mu = np.zeros((2, ypix.size), np.float64)
+    meds = np.zeros((len(bbox), 2), np.int32)
+    _extend_centers_cells(mu, ypix, xpix, starts, bbox, tstarts, niters.astype(np.int32),
+                          np.zeros(tstarts[-1], np.float64),
+                          np.zeros(ypix.size, np.float64),
+                          np.zeros(ypix.size, np.int64), meds)
+
+    # new normalization
+    mu /= (1e-60 + (mu**2).sum(axis=0)**0.5)
+
+    return mu, meds
+
+
 def masks_to_flows_cpu(masks, device=None, niter=None):
     """Convert masks to flows using diffusion from center pixel.
 
@@ -283,30 +397,149 @@ def masks_to_flows_cpu(masks, device=None, niter=None):
     Ly, Lx = masks.shape
     mu = np.zeros((2, Ly, Lx), np.float64)
 
-    slices = find_objects(masks)
-    meds = []
-    for i in prange(len(slices)):
-        si = slices[i]
-        if si is not None:
-            sr, sc = si
-            ly, lx = sr.stop - sr.start + 2, sc.stop - sc.start + 2
-            ### get center-of-mass within cell
-            y, x = np.nonzero(masks[sr, sc] == (i + 1))
-            y = y.astype(np.int32) + 1
-            x = x.astype(np.int32) + 1
-            ymed = y.mean()
-            xmed = x.mean()
-            imin = ((x - xmed)**2 + (y - ymed)**2).argmin()
-            xmed = x[imin]
-            ymed = y[imin]
-
-            n_iter = 2 * np.int32(ly + lx) if niter is None else niter
-            T = np.zeros((ly) * (lx), np.float64)
-            T = _extend_centers(T, y, x, ymed, xmed, np.int32(lx), np.int32(n_iter))
-            dy = T[(y + 1) * lx + x] - T[(y - 1) * lx + x]
-            dx = T[y * lx + x + 1] - T[y * lx + x - 1]
-            mu[:, sr.start + y - 1, sc.start + x - 1] = np.stack((dy, dx))
-            meds.append([ymed - 1, xmed - 1])
+    # flat list of mask pixels, sorted by mask (and in C-order within each mask)
+    ipix = np.flatnonzero(masks)
+    if ipix.size == 0:
+        return mu, np.zeros((0, 2), np.int32)
+    labels = masks.ravel()[ipix]
+    isort = np.argsort(labels, kind="stable")
+    ipix, labels = ipix[isort], labels[isort]
+    ypix, xpix = np.divmod(ipix, Lx)
+    ypix, xpix = ypix.astype(np.int32), xpix.astype(np.int32)
+    starts = np.nonzero(np.diff(labels, prepend=labels[0] - 1))[0]
+
+    mu[:, ypix, xpix], meds = masks_to_flows_pixels(ypix, xpix, starts, niter=niter)
+
+    return mu, meds
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def _extend_centers_cells_3d(mu, zpix, ypix, xpix, starts, bbox, tstarts, niters, T, Tnew,
+                             lidx, meds):
+    """Run 3D diffusion from the center of each mask on the mask voxels, for all masks in parallel.
+
+    Same as _extend_centers_cells, but each voxel is averaged over its 27-neighborhood.
+
+    Args:
+        mu (numpy.ndarray): Output flows of shape (3, Lz, Ly, Lx), filled in-place at the mask voxels.
+        zpix (numpy.ndarray): z-coordinates of the mask voxels, sorted by mask.
+        ypix (numpy.ndarray): y-coordinates of the mask voxels, sorted by mask.
+        xpix (numpy.ndarray): x-coordinates of the mask voxels, sorted by mask.
+        starts (numpy.ndarray): Start of each mask in zpix / ypix / xpix, of length nmasks + 1.
+        bbox (numpy.ndarray): Array of shape (nmasks, 6) with zmin, ymin, xmin, lz, ly, lx of each mask 
+            (lz, ly and lx include a padding of 1 voxel on each side).
+        tstarts (numpy.ndarray): Start of each mask in T, of length nmasks + 1.
+        niters (numpy.ndarray): Number of iterations to run diffusion for each mask.
+        T (numpy.ndarray): Zero-initialized scratch buffer of size sum(lz * ly * lx).
+        Tnew (numpy.ndarray): Scratch buffer of the same size as zpix.
+        lidx (numpy.ndarray): Scratch buffer of the same size as zpix.
+        meds (numpy.ndarray): Output array of shape (nmasks, 3) for the centers of the masks.
+
+    Returns:
+        None
+    """
+    for c in prange(len(starts) - 1):
+        i0, i1 = starts[c], starts[c + 1]
+        zmin, ymin, xmin = bbox[c, 0], bbox[c, 1], bbox[c, 2]
+        ly, lx = bbox[c, 4], bbox[c, 5]
+        lyx = ly * lx
+        Tc = T[tstarts[c]:tstarts[c + 1]]
+
+        ### get center-of-mass within cell
+        zsum, ysum, xsum = 0, 0, 0
+        for k in range(i0, i1):
+            zsum += zpix[k] - zmin + 1
+            ysum += ypix[k] - ymin + 1
+            xsum += xpix[k] - xmin + 1
+        zmean = zsum / (i1 - i0)
+        ymean = ysum / (i1 - i0)
+        xmean = xsum / (i1 - i0)
+        imin, dmin = i0, np.inf
+        for k in range(i0, i1):
+            d = (((zpix[k] - zmin + 1) - zmean)**2 + ((ypix[k] - ymin + 1) - ymean)**2 +
+                 ((xpix[k] - xmin + 1) - xmean)**2)
+            if d < dmin:
+                imin, dmin = k, d
+        zmed = zpix[imin] - zmin + 1
+        ymed = ypix[imin] - ymin + 1
+        xmed = xpix[imin] - xmin + 1
+        meds[c, 0] = zmed - 1
+        meds[c, 1] = ymed - 1
+        meds[c, 2] = xmed - 1
+
+        ### run diffusion
+        for k in range(i0, i1):
+            lidx[k] = ((zpix[k] - zmin + 1) * lyx + (ypix[k] - ymin + 1) * lx +
+                       (xpix[k] - xmin + 1))
+        for t in range(niters[c]):
+            Tc[zmed * lyx + ymed * lx + xmed] += 1
+            for k in range(i0, i1):
+                i = lidx[k]
+                Tsum = 0.
+                for dz in range(-1, 2):
+                    for dy in range(-1, 2):
+                        j = i + dz * lyx + dy * lx
+                        Tsum += Tc[j - 1] + Tc[j] + Tc[j + 1]
+                Tnew[k] = 1 / 27. * Tsum
+            for k in range(i0, i1):
+                Tc[lidx[k]] = Tnew[k]
+
+        ### gradients of diffused density
+        for k in range(i0, i1):
+            i = lidx[k]
+            mu[0, zpix[k], ypix[k], xpix[k]] = Tc[i + lyx] - Tc[i - lyx]
+            mu[1, zpix[k], ypix[k], xpix[k]] = Tc[i + lx] - Tc[i - lx]
+            mu[2, zpix[k], ypix[k], xpix[k]] = Tc[i + 1] - Tc[i - 1]
+
+
+def masks_to_flows_cpu_3d(masks, device=None, niter=None):
+    """Convert 3D masks to flows using 3D diffusion from center voxel.
+
+    Each mask is diffused once in 3D (27-neighborhood), instead of diffusing every 
+    2D cross-section of the mask along each axis.
+
+    Args:
+        masks (int, 3D array): Labelled masks 0=NO masks; 1,2,...=mask labels
+        device (torch.device, optional): Not used, diffusion runs on CPU.
+        niter (int, optional): Number of iterations of diffusion. Defaults to None 
+            (2 * (lz + ly + lx) for each mask).
+
+    Returns:
+        tuple containing
+            - mu (float, 4D array): Flows in Z = mu[0], flows in Y = mu[1], flows in X = mu[2].
+            - meds (int, 2D array): cell centers
+    """
+    Lz, Ly, Lx = masks.shape
+    mu = np.zeros((3, Lz, Ly, Lx), np.float64)
+
+    # flat list of mask voxels, sorted by mask (and in C-order within each mask)
+    ipix = np.flatnonzero(masks)
+    if ipix.size == 0:
+        return mu, np.zeros((0, 3), np.int32)
+    labels = masks.ravel()[ipix]
+    isort = np.argsort(labels, kind="stable")
+    ipix, labels = ipix[isort], labels[isort]
+    zpix, ypix, xpix = [
+        pix.astype(np.int32) for pix in np.unravel_index(ipix, masks.shape)
+    ]
+    starts = np.nonzero(np.diff(labels, prepend=labels[0] - 1))[0]
+
+    # bounding boxes of masks, padded by 1 voxel on each side
+    pmin = [np.minimum.reduceat(pix, starts) for pix in (zpix, ypix, xpix)]
+    lpad = [
+        np.maximum.reduceat(pix, starts) - pm + 3
+        for pix, pm in zip((zpix, ypix, xpix), pmin)
+    ]
+    bbox = np.stack((*pmin, *lpad), axis=1).astype(np.int32)
+    tstarts = np.concatenate(([0], np.cumsum(np.prod(bbox[:, 3:].astype(np.int64), axis=1))))
+    niters = 2 * bbox[:, 3:].sum(axis=1) if niter is None else np.full(len(starts), niter)
+    starts = np.append(starts, ipix.size)
+
+    meds = np.zeros((len(bbox), 3), np.int32)
+    _extend_centers_cells_3d(mu, zpix, ypix, xpix, starts, bbox, tstarts,
+                             niters.astype(np.int32), np.zeros(tstarts[-1], np.float64),
+                             np.zeros(ipix.size, np.float64),
+                             np.zeros(ipix.size, np.int64), meds)
 
     # new normalization
     mu /= (1e-60 + (mu**2).sum(axis=0)**0.5)
@@ -314,14 +547,133 @@ def masks_to_flows_cpu(masks, device=None, niter=None):
     return mu, meds
 
 
-def masks_to_flows(masks, device=None, niter=None):
+def _mask_centers_3d(masks):
+    """ closest voxel to the mean of the voxels of each mask (as in masks_to_flows_cpu_3d) """
+    ipix = np.flatnonzero(masks)
+    labels = masks.ravel()[ipix]
+    isort = np.argsort(labels, kind="stable")
+    ipix, labels = ipix[isort], labels[isort]
+    pix = np.array(np.unravel_index(ipix, masks.shape))
+    starts = np.nonzero(np.diff(labels, prepend=labels[0] - 1))[0]
+    npix = np.diff(np.append(starts, ipix.size))
+    pmean = np.add.reduceat(pix, starts, axis=1) / npix
+    d = ((pix - np.repeat(pmean, npix, axis=1))**2).sum(axis=0)
+    # first voxel at the minimum distance of each mask
+    dmin = np.repeat(np.minimum.reduceat(d, starts), npix)
+    imin = np.nonzero(d == dmin)[0]
+    imin = imin[np.unique(labels[imin], return_index=True)[1]]
+    return pix[:, imin].T.astype(np.int32)
+
+
+def masks_to_flows_direct(masks, device=None, niter=None):
+    """Convert 2D or 3D masks to flows using the steady state of diffusion from center pixel.
+
+    Instead of running niter iterations of diffusion, the steady state of the diffusion 
+    T = A (T + e_center) is computed directly by solving the sparse linear system 
+    (I - A) T = A e_center on the pixel graph of all masks at once (each mask is an 
+    independent block of the system), with a sparse LU factorization in 2D and conjugate 
+    gradients in 3D. A averages each pixel over its 3x3 neighbors 
+    (3x3x3 in 3D) within the same mask. Center of masks is the same as in masks_to_flows_cpu 
+    (masks_to_flows_cpu_3d in 3D).
+
+    Args:
+        masks (int, 2D or 3D array): Labelled masks 0=NO masks; 1,2,...=mask labels
+        device (torch.device, optional): Not used, solver runs on CPU.
+        niter (int, optional): Not used, steady state is computed directly.
+
+    Returns:
+        tuple containing
+            - mu (float, 3D or 4D array): Flows in Y = mu[-2], flows in X = mu[-1]. 
+                If masks are 3D, flows in Z = mu[0].
+            - meds (int, 2D array): cell centers
+    """
+    ndim = masks.ndim
+    mu = np.zeros((ndim, *masks.shape), np.float64)
+
+    masks_padded = np.pad(masks, 1)
+    pix = np.nonzero(masks_padded)
+    npix = pix[0].size
+    if npix == 0:
+        return mu, np.zeros((0, ndim), np.int32)
+    ipix = np.full(masks_padded.shape, -1, np.int64)
+    ipix[pix] = np.arange(npix)
+    lab = masks_padded[pix]
+
+    ### get center-of-mass within cell
+    if ndim == 2:
+        slices = find_objects(masks)
+        slices = np.array([
+            np.array([i, si[0].start, si[0].stop, si[1].start, si[1].stop])
+            for i, si in enumerate(slices)
+            if si is not None
+        ])
+        centers, ext = get_centers(masks, slices)
+    else:
+        centers = _mask_centers_3d(masks)
+
+    def shifted(d):
+        # coordinates of the neighbors at offset d of the mask pixels
+        return tuple(p + di for p, di in zip(pix, d))
+
+    ### averaging over 3x3 (3x3x3) neighbors within the same mask
+    rows, cols = [], []
+    for d in itertools.product([-1, 0, 1], repeat=ndim):
+        pixn = shifted(d)
+        same = masks_padded[pixn] == lab
+        rows.append(np.nonzero(same)[0])
+        cols.append(ipix[pixn][same])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    A = csr_matrix((np.full(rows.size, 1 / 3.**ndim), (rows, cols)), shape=(npix, npix))
+    e = np.zeros(npix, np.float64)
+    e[ipix[tuple(centers.T + 1)]] = 1
+
+    ### steady state of T = A (T + e), I - A is symmetric positive definite
+    if ndim == 2:
+        lu = splu((identity(npix, format="csr") - A).tocsc(),
+                  permc_spec="MMD_AT_PLUS_A", diag_pivot_thresh=0.,
+                  options=dict(SymmetricMode=True))
+        T = lu.solve(A @ e)
+    else:
+        # the LU factors of the 3D system fill in too much, use conjugate gradients
+        T, info = cg(identity(npix, format="csr") - A, A @ e, rtol=1e-10,
+                     maxiter=10 * npix)
+        if info != 0:
+            raise RuntimeError("conjugate gradients did not converge")
+
+    # gradients of diffused density, zero outside of the mask
+    def Tn(d):
+        pixn = shifted(d)
+        Tn = T[ipix[pixn]]
+        Tn[masks_padded[pixn] != lab] = 0
+        return Tn
+
+    pix0 = tuple(p - 1 for p in pix)
+    for axis in range(ndim):
+        d = np.eye(ndim, dtype=int)[axis]
+        mu[(axis, *pix0)] = Tn(d) - Tn(-d)
+
+    # new normalization
+    mu /= (1e-60 + (mu**2).sum(axis=0)**0.5)
+
+    return mu, centers
+
+
+def masks_to_flows(masks, device=None, niter=None, method="diffusion"):
     """Convert masks to flows using diffusion from center pixel.
 
     Center of masks where diffusion starts is defined to be the closest pixel to the mean of all pixels that is inside the mask.
     Result of diffusion is converted into flows by computing the gradients of the diffusion density map.
+    On the CPU and with method="direct", 3D masks are diffused in 3D (see masks_to_flows_cpu_3d 
+    and masks_to_flows_direct). On the GPU, flows of 3D masks are the sum of the 2D flows of the 
+    cross-sections along each axis, normalized to unit length like the 3D flows.
 
     Args:
         masks (int, 2D or 3D array): Labelled masks 0=NO masks; 1,2,...=mask labels
+        device (torch.device, optional): Device to run diffusion on. Defaults to None (CPU).
+        niter (int, optional): Number of iterations of diffusion. Defaults to None (set by mask size).
+        method (str, optional): "diffusion" runs niter iterations of diffusion (on CPU or GPU), 
+            "direct" computes the steady state of the diffusion with a sparse solver on the CPU
+            (faster for large masks). Defaults to "diffusion".
 
     Returns:
         mu (float, 3D or 4D array): Flows in Y = mu[-2], flows in X = mu[-1].
@@ -331,7 +683,11 @@ def masks_to_flows(masks, device=None, niter=None):
         dynamics_logger.warning("empty masks!")
         return np.zeros((2, *masks.shape), "float32")
 
-    if device is not None:
+    if method == "direct":
+        masks_to_flows_device = masks_to_flows_direct
+    elif method != "diffusion":
+        raise ValueError(f"method must be 'diffusion' or 'direct', not {method}")
+    elif device is not None:
         if device.type == "cuda" or device.type == "mps":
             masks_to_flows_device = masks_to_flows_gpu
         else:
@@ -339,7 +695,13 @@ def masks_to_flows(masks, device=None, niter=None):
     else:
         masks_to_flows_device = masks_to_flows_cpu
 
-    if masks.ndim == 3:
+    if masks.ndim == 3 and masks_to_flows_device is masks_to_flows_cpu:
+        mu, meds = masks_to_flows_cpu_3d(masks, niter=niter)
+        return mu.astype(np.float32)
+    elif masks.ndim == 3 and masks_to_flows_device is masks_to_flows_direct:
+        mu, meds = masks_to_flows_direct(masks)
+        return mu.astype(np.float32)
+    elif masks.ndim == 3:
         Lz, Ly, Lx = masks.shape
         mu = np.zeros((3, Lz, Ly, Lx), np.float32)
         for z in range(Lz):
@@ -351,6 +713,8 @@ def masks_to_flows(masks, device=None, niter=None):
         for x in range(Lx):
             mu0 = masks_to_flows_device(masks[:, :, x], device=device, niter=niter)[0]
             mu[[0, 1], :, :, x] += mu0
+        # same normalization as the 3D flows
+        mu /= (1e-20 + (mu**2).sum(axis=0)**0.5)
         return mu
     elif masks.ndim == 2:
         mu, mu_c = masks_to_flows_device(masks, device=device, niter=niter)
@@ -361,7 +725,7 @@ def masks_to_flows(masks, device=None, niter=None):
 
 
 def labels_to_flows(labels, files=None, device=None, 
-                    redo_flows=False, niter=None, return_flows=True):
+                    redo_flows=False, niter=None, return_flows=True, method="diffusion"):
     """Converts labels (list of masks or flows) to flows for training model.
 
     Args:
@@ -373,6 +737,7 @@ def labels_to_flows(labels, files=None, device=None,
         device (str, optional): The device to use for computation. Defaults to None.
         redo_flows (bool, optional): Whether to recompute the flows. Defaults to False.
         niter (int, optional): The number of iterations for computing flows. Defaults to None.
+        method (str, optional): Method for computing flows, "diffusion" or "direct" (see masks_to_flows). Defaults to "diffusion".
 
     Returns:
         list of [4 x Ly x Lx] arrays: The flows for training the model. flows[k][0] is labels[k], 
@@ -394,7 +759,8 @@ def labels_to_flows(labels, files=None, device=None,
         iterator = trange if nimg > 1 else range
         for n in iterator(nimg):
             labels[n][0] = fastremap.renumber(labels[n][0], in_place=True)[0]
-            vecn = masks_to_flows(labels[n][0].astype(int), device=device, niter=niter)
+            vecn = masks_to_flows(labels[n][0].astype(int), device=device, niter=niter,
+                                  method=method)
                 
             # concatenate labels, distance transform, vector flows, heat (boundary and mask are computed in augmentations)
             flow = np.concatenate((labels[n], labels[n] > 0.5, vecn),
@@ -447,6 +813,48 @@ def map_coordinates(I, yc, xc, Y):
                        np.float32(I[c, yf1, xf1]) * y * x)
 
 
+@njit("(float32[:,:], float32[:,:,:], int32)", parallel=True, nogil=True, cache=True)
+def _steps2D_interp_cpu(p, dP, niter):
+    """Euler integration of interpolated flows on CPU, in-place on p.
+
+    Bilinear sampling of dP, the step and the clamping to the image are fused
+    into one loop per pixel, and pixels are split across threads (numba prange).
+
+    Args:
+        p (numpy.ndarray): Array of shape (2, n_points) with the pixel locations, updated in-place.
+        dP (numpy.ndarray): Array of shape (2, Ly, Lx) representing the flow field.
+        niter (int): Number of iterations to perform.
+
+    Returns:
+        None
+    """
+    Ly, Lx = dP.shape[1], dP.shape[2]
+    ymax = np.float32(Ly - 1)
+    xmax = np.float32(Lx - 1)
+    for j in prange(p.shape[1]):
+        yc = p[0, j]
+        xc = p[1, j]
+        for t in range(niter):
+            yc_floor = np.int32(yc)
+            xc_floor = np.int32(xc)
+            y = yc - np.float32(yc_floor)
+            x = xc - np.float32(xc_floor)
+            yf = min(Ly - 1, max(0, yc_floor))
+            xf = min(Lx - 1, max(0, xc_floor))
+            yf1 = min(Ly - 1, yf + 1)
+            xf1 = min(Lx - 1, xf + 1)
+            dy = np.float32(dP[0, yf, xf] * (1 - y) * (1 - x) +
+                            dP[0, yf, xf1] * (1 - y) * x +
+                            dP[0, yf1, xf] * y * (1 - x) + dP[0, yf1, xf1] * y * x)
+            dx = np.float32(dP[1, yf, xf] * (1 - y) * (1 - x) +
+                            dP[1, yf, xf1] * (1 - y) * x +
+                            dP[1, yf1, xf] * y * (1 - x) + dP[1, yf1, xf1] * y * x)
+            yc = min(ymax, max(np.float32(0), yc + dy))
+            xc = min(xmax, max(np.float32(0), xc + dx))
+        p[0, j] = yc
+        p[1, j] = xc
+
+
 def steps2D_interp(p, dP, niter, device=None):
     """ Run dynamics of pixels to recover masks in 2D, with interpolation between pixel values.
 
@@ -499,16 +907,13 @@ def steps2D_interp(p, dP, niter, device=None):
         return p
 
     else:
-        dPt = np.zeros(p.shape, np.float32)
-
-        for t in range(niter):
-            map_coordinates(dP.astype(np.float32), p[0], p[1], dPt)
-            for k in range(len(p)):
-                p[k] = np.minimum(shape[k] - 1, np.maximum(0, p[k] + dPt[k]))
+        p = np.ascontiguousarray(p, dtype=np.float32)
+        dP = np.ascontiguousarray(dP, dtype=np.float32)
+        _steps2D_interp_cpu(p, dP, np.int32(niter))
         return p
 
 
-@njit("(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32)", nogil=True)
+@njit("(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32)", nogil=True, cache=True)
 def steps3D(p, dP, inds, niter):
     """ Run dynamics of pixels to recover masks in 3D.
 
@@ -537,7 +942,7 @@ def steps3D(p, dP, inds, niter):
     return p
 
 
-@njit("(float32[:,:,:], float32[:,:,:], int32[:,:], int32)", nogil=True)
+@njit("(float32[:,:,:], float32[:,:,:], int32[:,:], int32)", nogil=True, cache=True)
 def steps2D(p, dP, inds, niter):
     """Run dynamics of pixels to recover masks in 2D.
 
@@ -565,7 +970,138 @@ def steps2D(p, dP, inds, niter):
     return p
 
 
-def follow_flows(dP, mask=None, niter=200, interp=True, device=None):
+@njit("(float32[:,:], float32[:,:,:,:], boolean[:,:,:], int32, boolean, float32, float32, int32)",
+      parallel=True, nogil=True, cache=True)
+def _steps3D_sparse(p, dP, iscell, niter, interp, scale, converge_tol, nblock):
+    """Euler integration of 3D flows on CPU for a list of pixels, in-place on p.
+
+    The flows are dP * iscell / scale, which is computed on the fly at the sampled 
+    voxels instead of for the whole volume. Pixels whose initial step is smaller than 1e-3
+    are not moved (as in follow_flows).
+
+    Args:
+        p (numpy.ndarray): Array of shape (3, n_points) with the pixel locations, updated in-place.
+        dP (numpy.ndarray): Array of shape (3, Lz, Ly, Lx) representing the flow field.
+        iscell (numpy.ndarray): Boolean array of shape (Lz, Ly, Lx), flows are zero outside of it.
+        niter (int): Number of iterations to perform.
+        interp (bool): Trilinear interpolation of the flows if True, otherwise flows at the 
+            voxel containing each pixel (as in steps3D).
+        scale (float): Flows are divided by scale.
+        converge_tol (float): If > 0, a pixel stops once it moves less than converge_tol 
+            pixels over nblock iterations.
+        nblock (int): Number of iterations between convergence checks.
+
+    Returns:
+        None
+    """
+    Lz, Ly, Lx = iscell.shape
+    zmax, ymax, xmax = np.float32(Lz - 1), np.float32(Ly - 1), np.float32(Lx - 1)
+    one, zero = np.float32(1), np.float32(0)
+    tol2 = converge_tol * converge_tol
+    for j in prange(p.shape[1]):
+        zc, yc, xc = p[0, j], p[1, j], p[2, j]
+        zb, yb, xb = zc, yc, xc
+        for t in range(niter):
+            zc_floor, yc_floor, xc_floor = np.int32(zc), np.int32(yc), np.int32(xc)
+            if interp:
+                z = zc - np.float32(zc_floor)
+                y = yc - np.float32(yc_floor)
+                x = xc - np.float32(xc_floor)
+            else:
+                z, y, x = zero, zero, zero
+            zf = min(Lz - 1, max(0, zc_floor))
+            yf = min(Ly - 1, max(0, yc_floor))
+            xf = min(Lx - 1, max(0, xc_floor))
+            dz, dy, dx = zero, zero, zero
+            # trilinear weights of the 8 voxels around the pixel, skipping zero weights
+            for iz in range(2):
+                wz = z if iz else one - z
+                if wz == 0:
+                    continue
+                zi = min(Lz - 1, zf + iz)
+                for iy in range(2):
+                    wy = y if iy else one - y
+                    if wy == 0:
+                        continue
+                    yi = min(Ly - 1, yf + iy)
+                    for ix in range(2):
+                        wx = x if ix else one - x
+                        xi = min(Lx - 1, xf + ix)
+                        if wx == 0 or not iscell[zi, yi, xi]:
+                            continue
+                        w = wz * wy * wx
+                        dz += np.float32(w * dP[0, zi, yi, xi])
+                        dy += np.float32(w * dP[1, zi, yi, xi])
+                        dx += np.float32(w * dP[2, zi, yi, xi])
+            dz = np.float32(dz / scale)
+            dy = np.float32(dy / scale)
+            dx = np.float32(dx / scale)
+            if t == 0 and max(abs(dz), abs(dy), abs(dx)) <= np.float32(1e-3):
+                break
+            zc = min(zmax, max(zero, zc + dz))
+            yc = min(ymax, max(zero, yc + dy))
+            xc = min(xmax, max(zero, xc + dx))
+            if converge_tol > 0 and (t + 1) % nblock == 0:
+                if (zc - zb)**2 + (yc - yb)**2 + (xc - xb)**2 <= tol2:
+                    break
+                zb, yb, xb = zc, yc, xc
+        p[0, j] = zc
+        p[1, j] = yc
+        p[2, j] = xc
+
+
+def steps_converge(p, dP, inds, niter, converge_tol=0.1, interp=False, device=None,
+                   nblock=10, min_active=1e-3):
+    """Run dynamics of pixels, dropping pixels that have converged from the active set.
+
+    Euler integration of dynamics dP for at most niter steps, run in blocks of nblock steps.
+    After each block, pixels which moved less than converge_tol pixels during the block
+    are considered converged and are no longer integrated. Dynamics stop once fewer than
+    min_active (fraction) of the pixels are still moving.
+
+    Args:
+        p (np.ndarray): Pixel locations, [axis x Ly x Lx] or [axis x Lz x Ly x Lx] meshgrid
+            if interp is False, or [axis x npixels] (pixels in inds) if interp is True.
+        dP (np.ndarray): Flows [axis x Ly x Lx] or [axis x Lz x Ly x Lx].
+        inds (np.ndarray): Non-zero pixels to run dynamics on [npixels x ndim].
+        niter (int): Maximum number of iterations of dynamics to run.
+        converge_tol (float, optional): Displacement in pixels over a block below which a pixel
+            is considered converged. Defaults to 0.1.
+        interp (bool, optional): Interpolate during 2D dynamics (not available in 3D). Defaults to False.
+        device (torch.device, optional): Device to use for interpolated dynamics. Defaults to None.
+        nblock (int, optional): Number of iterations between convergence checks. Defaults to 10.
+        min_active (float, optional): Fraction of moving pixels below which dynamics stop. Defaults to 1e-3.
+
+    Returns:
+        tuple containing:
+            - p (np.ndarray): Final locations of each pixel after dynamics.
+            - niter_run (int): Number of iterations actually run.
+    """
+    npix = inds.shape[0]
+    active = np.arange(npix)
+    tol2 = converge_tol**2
+    dP = dP.astype(np.float32, copy=False)
+    steps = steps3D if inds.shape[1] == 3 else steps2D
+    niter_run = 0
+    while niter_run < niter:
+        nb = min(nblock, niter - niter_run)
+        if interp:
+            pa = p[:, active]
+            pb = steps2D_interp(pa.copy(), dP, nb, device=device)
+            p[:, active] = pb
+        else:
+            ia = inds[active]
+            pa = p[(slice(None),) + tuple(ia.T)]
+            p = steps(p, dP, ia, np.int32(nb))
+            pb = p[(slice(None),) + tuple(ia.T)]
+        niter_run += nb
+        active = active[((pb - pa)**2).sum(axis=0) > tol2]
+        if active.size <= min_active * npix:
+            break
+    return p, niter_run
+
+
+def follow_flows(dP, mask=None, niter=200, interp=True, device=None, converge_tol=0.):
     """ Run dynamics to recover masks in 2D or 3D.
 
     Pixels are represented as a meshgrid. Only pixels with non-zero cell-probability
@@ -577,6 +1113,9 @@ def follow_flows(dP, mask=None, niter=200, interp=True, device=None):
         niter (int, optional): Number of iterations of dynamics to run. Default is 200.
         interp (bool, optional): Interpolate during 2D dynamics (not available in 3D). Default is True.
         use_gpu (bool, optional): Use GPU to run interpolated dynamics (faster than CPU). Default is False.
+        converge_tol (float, optional): If > 0, pixels that move less than converge_tol pixels
+            over 10 iterations stop being integrated, and dynamics end early once nearly all 
+            pixels have converged (see steps_converge). Default is 0 (always run niter iterations).
 
     Returns:
         tuple containing:
@@ -585,13 +1124,17 @@ def follow_flows(dP, mask=None, niter=200, interp=True, device=None):
     """
     shape = np.array(dP.shape[1:]).astype(np.int32)
     niter = np.uint32(niter)
+    niter_run = niter
     if len(shape) > 2:
         p = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), np.arange(shape[2]),
                         indexing="ij")
         p = np.array(p).astype(np.float32)
         # run dynamics on subset of pixels
         inds = np.array(np.nonzero(np.abs(dP).max(axis=0) > 1e-3)).astype(np.int32).T
-        p = steps3D(p, dP, inds, niter)
+        if converge_tol > 0:
+            p, niter_run = steps_converge(p, dP, inds, niter, converge_tol=converge_tol)
+        else:
+            p = steps3D(p, dP, inds, niter)
     else:
         p = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
         p = np.array(p).astype(np.float32)
@@ -603,11 +1146,51 @@ def follow_flows(dP, mask=None, niter=200, interp=True, device=None):
             return p, None
 
         if not interp:
-            p = steps2D(p, dP.astype(np.float32), inds, niter)
+            if converge_tol > 0:
+                p, niter_run = steps_converge(p, dP, inds, niter,
+                                              converge_tol=converge_tol)
+            else:
+                p = steps2D(p, dP.astype(np.float32), inds, niter)
         else:
-            p_interp = steps2D_interp(p[:, inds[:, 0], inds[:, 1]], dP, niter,
-                                      device=device)
+            p_interp = p[:, inds[:, 0], inds[:, 1]]
+            if converge_tol > 0:
+                p_interp, niter_run = steps_converge(p_interp, dP, inds, niter,
+                                                     converge_tol=converge_tol,
+                                                     interp=True, device=device)
+            else:
+                p_interp = steps2D_interp(p_interp, dP, niter, device=device)
             p[:, inds[:, 0], inds[:, 1]] = p_interp
+    if converge_tol > 0:
+        dynamics_logger.info(f"dynamics run for {niter_run} of {niter} iterations")
+    return p, inds
+
+
+def follow_flows_sparse(dP, iscell, niter=200, interp=True, converge_tol=0.):
+    """Run dynamics to recover masks in 3D, only for the pixels in iscell.
+
+    Pixels are represented as a list of coordinates [3 x npixels] instead of a meshgrid of 
+    the whole volume, and the flows are masked by iscell and divided by 5 on the fly, 
+    so memory scales with the number of pixels in iscell.
+
+    Args:
+        dP (np.ndarray): Flows [axis x Lz x Ly x Lx] (not divided by 5, as output by the network).
+        iscell (np.ndarray): Boolean array [Lz x Ly x Lx] of the pixels to run dynamics on.
+        niter (int, optional): Number of iterations of dynamics to run. Default is 200.
+        interp (bool, optional): Trilinear interpolation of the flows. Default is True.
+        converge_tol (float, optional): If > 0, pixels that move less than converge_tol pixels
+            over 10 iterations stop being integrated. Default is 0.
+
+    Returns:
+        tuple containing:
+            - p (np.ndarray): Final locations of each pixel after dynamics; [axis x npixels].
+            - inds (np.ndarray): Coordinates of the pixels used for dynamics; [npixels x axis].
+    """
+    iscell = np.ascontiguousarray(iscell, dtype=bool)
+    inds = np.array(np.nonzero(iscell), dtype=np.int32).T
+    p = np.ascontiguousarray(inds.T, dtype=np.float32)
+    _steps3D_sparse(p, np.ascontiguousarray(dP, dtype=np.float32), iscell,
+                    np.int32(niter), interp, np.float32(5.), np.float32(converge_tol),
+                    np.int32(10))
     return p, inds
 
 
@@ -616,7 +1199,9 @@ def remove_bad_flow_masks(masks, flows, threshold=0.4, device=None):
 
     Uses metrics.flow_error to compute flows from predicted masks 
     and compare flows to predicted flows from the network. Discards 
-    masks with flow errors greater than the threshold.
+    masks with flow errors greater than the threshold. On the CPU, 
+    2D flow errors are computed in the bounding box of each mask 
+    (metrics.flow_error_local).
 
     Args:
         masks (int, 2D or 3D array): Labelled masks, 0=NO masks; 1,2,...=mask labels,
@@ -653,13 +1238,81 @@ def remove_bad_flow_masks(masks, flows, threshold=0.4, device=None):
             dynamics_logger.info("turn off QC step with flow_threshold=0 if too slow")
             device0 = None
 
-    merrors, _ = metrics.flow_error(masks, flows, device0)
+    if masks.ndim == 2 and (device0 is None or device0.type == "cpu"):
+        # flows from masks computed per mask bounding box, on CPU threads
+        merrors = metrics.flow_error_local(masks, flows)
+    else:
+        merrors, _ = metrics.flow_error(masks, flows, device0)
     badi = 1 + (merrors > threshold).nonzero()[0]
     masks[np.isin(masks, badi)] = 0
     return masks
 
 
-def get_masks(p, iscell=None, rpad=20):
+def _bin_neighbors(keys, shape_pad, ind, size):
+    """Find the histogram bins in a window around bins ind.
+
+    Args:
+        keys (np.ndarray): Sorted linear indices of the non-empty bins in the padded histogram.
+        shape_pad (tuple): Shape of the padded histogram.
+        ind (np.ndarray): Indices into keys of the bins at the window centers.
+        size (int): Size of the window in each dimension (odd).
+
+    Returns:
+        np.ndarray: Array of shape [len(ind) x size**ndim] with indices into keys of
+            the bins in each window, or len(keys) if the bin is empty.
+    """
+    r = size // 2
+    offsets = np.array(np.meshgrid(*[np.arange(-r, r + 1)] * len(shape_pad),
+                                   indexing="ij")).reshape(len(shape_pad), -1)
+    strides = np.cumprod((1,) + tuple(shape_pad[::-1]))[:-1][::-1]
+    nkeys = keys[ind, np.newaxis] + (strides @ offsets)[np.newaxis, :]
+    nind = np.minimum(np.searchsorted(keys, nkeys), len(keys) - 1)
+    nind[keys[nind] != nkeys] = len(keys)
+    return nind
+
+
+def get_seeds_and_grow(ibins, counts, shape, niter=5):
+    """Find seeds at peaks of the histogram of final pixel locations and grow masks.
+
+    Works on the sparse histogram of bins with more than 2 pixels. Seeds are 
+    local maxima in a 5 x 5 (x 5) window with more than 10 pixels. All seeds are 
+    grown at the same time for niter steps into neighboring bins with more than 2 pixels; 
+    where masks overlap, the seed with the fewest pixels is kept.
+
+    Args:
+        ibins (np.ndarray): Sorted linear indices (in shape) of the bins with more than 2 pixels.
+        counts (np.ndarray): Number of pixels in each bin in ibins.
+        shape (tuple): Shape of the histogram [Ly x Lx] or [Lz x Ly x Lx].
+        niter (int, optional): Number of steps to grow the seeds. Defaults to 5.
+
+    Returns:
+        np.ndarray: Mask label of each bin in ibins, 0=NO masks; 1,2,...=mask labels.
+    """
+    nbins = len(ibins)
+    if nbins == 0:
+        return np.zeros(0, np.uint32)
+    # linear indices in histogram padded by 2, so that windows do not wrap around edges
+    shape_pad = tuple(s + 4 for s in shape)
+    coords = np.unravel_index(ibins, shape)
+    keys = np.ravel_multi_index(tuple(c + 2 for c in coords), shape_pad)
+    counts_ext = np.append(counts, 0)
+
+    # seeds are local maxima of the histogram with more than 10 pixels
+    cand = np.nonzero(counts > 10)[0]
+    hmax = counts_ext[_bin_neighbors(keys, shape_pad, cand, 5)].max(axis=1)
+    seeds = cand[counts[cand] >= hmax]
+    isort = np.argsort(counts[seeds])[::-1]
+
+    # grow all seeds at once, larger labels (seeds with fewer pixels) take precedence
+    labels = np.zeros(nbins + 1, np.uint32)
+    labels[seeds[isort]] = np.arange(1, len(seeds) + 1, dtype=np.uint32)
+    neighbors = _bin_neighbors(keys, shape_pad, np.arange(nbins), 3)
+    for i in range(niter):
+        labels[:-1] = labels[neighbors].max(axis=1)
+    return labels[:-1]
+
+
+def get_masks(p, iscell=None, rpad=20, max_size_fraction=0.4):
     """Create masks using pixel convergence after running dynamics.
 
     Makes a histogram of final pixel locations p, initializes masks 
@@ -672,14 +1325,15 @@ def get_masks(p, iscell=None, rpad=20):
             size [axis x Ly x Lx] or [axis x Lz x Ly x Lx].
         iscell (bool, 2D or 3D array): If iscell is not None, set pixels that are 
             iscell False to stay in their original location.
-        rpad (int, optional): Histogram edge padding. Default is 20.
+        rpad (int, optional): Histogram edge padding, not used anymore (seeds are 
+            found in a sparse histogram). Default is 20.
+        max_size_fraction (float, optional): Masks larger than max_size_fraction of
+            total image size are removed. Default is 0.4.
 
     Returns:
         M0 (int, 2D or 3D array): Masks with inconsistent flow masks removed, 
             0=NO masks; 1,2,...=mask labels, size [Ly x Lx] or [Lz x Ly x Lx].
     """
-    pflows = []
-    edges = []
     shape0 = p.shape[1:]
     dims = len(p)
     if iscell is not None:
@@ -692,61 +1346,19 @@ def get_masks(p, iscell=None, rpad=20):
         for i in range(dims):
             p[i, ~iscell] = inds[i][~iscell]
 
-    for i in range(dims):
-        pflows.append(p[i].flatten().astype("int32"))
-        edges.append(np.arange(-.5 - rpad, shape0[i] + .5 + rpad, 1))
-
-    h, _ = np.histogramdd(tuple(pflows), bins=edges)
-    hmax = h.copy()
-    for i in range(dims):
-        hmax = maximum_filter1d(hmax, 5, axis=i)
+    pflows = tuple(p[i].flatten().astype("int32") for i in range(dims))
+    ipix = np.ravel_multi_index(pflows, shape0)
+    h = np.bincount(ipix, minlength=np.prod(shape0))
 
-    seeds = np.nonzero(np.logical_and(h - hmax > -1e-6, h > 10))
-    Nmax = h[seeds]
-    isort = np.argsort(Nmax)[::-1]
-    for s in seeds:
-        s[:] = s[isort]
-
-    pix = list(np.array(seeds).T)
-
-    shape = h.shape
-    if dims == 3:
-        expand = np.nonzero(np.ones((3, 3, 3)))
-    else:
-        expand = np.nonzero(np.ones((3, 3)))
-
-    for iter in range(5):
-        for k in range(len(pix)):
-            if iter == 0:
-                pix[k] = list(pix[k])
-            newpix = []
-            iin = []
-            for i, e in enumerate(expand):
-                epix = e[:, np.newaxis] + np.expand_dims(pix[k][i], 0) - 1
-                epix = epix.flatten()
-                iin.append(np.logical_and(epix >= 0, epix < shape[i]))
-                newpix.append(epix)
-            iin = np.all(tuple(iin), axis=0)
-            for p in newpix:
-                p = p[iin]
-            newpix = tuple(newpix)
-            igood = h[newpix] > 2
-            for i in range(dims):
-                pix[k][i] = newpix[i][igood]
-            if iter == 4:
-                pix[k] = tuple(pix[k])
-
-    M = np.zeros(h.shape, np.uint32)
-    for k in range(len(pix)):
-        M[pix[k]] = 1 + k
-
-    for i in range(dims):
-        pflows[i] = pflows[i] + rpad
-    M0 = M[tuple(pflows)]
+    # only bins with more than 2 pixels can be part of masks
+    ibins = np.nonzero(h > 2)[0]
+    M = np.zeros(h.size, np.uint32)
+    M[ibins] = get_seeds_and_grow(ibins, h[ibins], shape0)
+    M0 = M[ipix]
 
     # remove big masks
     uniq, counts = fastremap.unique(M0, return_counts=True)
-    big = np.prod(shape0) * 0.4
+    big = np.prod(shape0) * max_size_fraction
     bigc = uniq[counts > big]
     if len(bigc) > 0 and (len(bigc) > 1 or bigc[0] != 0):
         M0 = fastremap.mask(M0, bigc)
@@ -754,9 +1366,177 @@ def get_masks(p, iscell=None, rpad=20):
     M0 = np.reshape(M0, shape0)
     return M0
 
+def get_masks_sparse(p, inds, iscell):
+    """Create masks using pixel convergence after running dynamics on a list of pixels.
+
+    Same as get_masks, but the histogram of final pixel locations is only computed 
+    at the locations reached by the pixels in inds, so memory scales with the number 
+    of pixels in iscell (besides the output masks).
+
+    Args:
+        p (float32, 2D array): Final locations of each pixel after dynamics, size [axis x npixels].
+        inds (int, 2D array): Coordinates of the pixels in p, size [npixels x axis].
+        iscell (bool, 2D or 3D array): Pixels that dynamics were run on, other pixels 
+            stay in their original location.
+
+    Returns:
+        M0 (int, 2D or 3D array): Masks, 0=NO masks; 1,2,...=mask labels, size of iscell.
+    """
+    shape0 = iscell.shape
+    npix = np.prod(shape0)
+    ipix = np.ravel_multi_index(tuple(p.astype("int32")), shape0)
+    bins, ibin, counts = np.unique(ipix, return_inverse=True, return_counts=True)
+    del ipix
+    # pixels outside of iscell stay in place, and add one to the count of their bin
+    notcell = ~iscell.ravel()[bins]
+    counts += notcell
+
+    # only bins with more than 2 pixels can be part of masks
+    sel = counts > 2
+    labels = np.zeros(len(bins), np.uint32)
+    labels[sel] = get_seeds_and_grow(bins[sel], counts[sel], shape0)
+
+    # remove big masks
+    nlabel = (np.bincount(labels[ibin], minlength=labels.max() + 1) +
+              np.bincount(labels[notcell], minlength=labels.max() + 1))
+    big = npix * 0.4
+    bigc = np.nonzero(nlabel > big)[0]
+    bigc = bigc[bigc > 0]
+    if len(bigc) > 0:
+        labels[np.isin(labels, bigc)] = 0
+
+    M0 = np.zeros(shape0, np.uint32)
+    M0[tuple(inds.T)] = labels[ibin]
+    M0.ravel()[bins[notcell]] = labels[notcell]
+    fastremap.renumber(M0, in_place=True)  #convenient to guarantee non-skipped labels
+    return M0
+
+
+def parallel_kernels_threadsafe():
+    """Check if parallel numba kernels can be launched from several threads at once.
+
+    The workqueue threading layer of numba does not support concurrent parallel kernels
+    (the tbb and omp layers do).
+
+    Returns:
+        bool: False if numba uses the workqueue threading layer.
+    """
+    # the threading layer is chosen at the first launch of a parallel kernel
+    steps2D_interp(np.zeros((2, 1), np.float32), np.zeros((2, 1, 1), np.float32), 1)
+    return numba.threading_layer() != "workqueue"
+
+
+def get_work_units(cp_mask, nunits, pad=2):
+    """Group the connected components of cp_mask into work units for mask computation.
+
+    Components are sorted by the start of their bounding box and split into nunits groups 
+    with a similar number of pixels. Each group is processed in the bounding box around all 
+    of its components (padded by pad pixels).
+
+    Args:
+        cp_mask (bool, 2D or 3D array): Pixels above the cellprob threshold.
+        nunits (int): Number of work units.
+        pad (int, optional): Padding of the bounding boxes. Defaults to 2.
+
+    Returns:
+        tuple containing:
+            - lab (int, 2D or 3D array): Connected components of cp_mask.
+            - units (list): List of (slices, component labels) for each work unit.
+    """
+    lab, ncomp = label(cp_mask, structure=np.ones((3,) * cp_mask.ndim))
+    if ncomp == 0:
+        return lab, []
+    slices = find_objects(lab)
+    starts = np.array([[sl.start for sl in si] for si in slices])
+    stops = np.array([[sl.stop for sl in si] for si in slices])
+    npix = np.bincount(lab.ravel(), minlength=ncomp + 1)[1:]
+    isort = np.lexsort(starts.T[::-1])
+    unit = (np.cumsum(npix[isort]) - 1) * nunits // npix.sum()
+
+    units = []
+    for u in np.unique(unit):
+        icomp = isort[unit == u]
+        start = np.maximum(0, starts[icomp].min(axis=0) - pad)
+        stop = np.minimum(cp_mask.shape, stops[icomp].max(axis=0) + pad)
+        units.append((tuple(slice(a, b) for a, b in zip(start, stop)), icomp + 1))
+    return lab, units
+
+
+def _compute_masks_unit(dP, lab, slc, icomp, niter, interp, device, converge_tol):
+    """Run dynamics and create masks in one work unit (see get_work_units)."""
+    cp_unit = np.isin(lab[slc], icomp)
+    p, inds = follow_flows(dP[(slice(None),) + slc] * cp_unit / 5., niter=niter,
+                           interp=interp, device=device, converge_tol=converge_tol)
+    if inds is None:
+        return cp_unit, np.zeros(cp_unit.shape, np.uint32), p
+    # big masks are removed over the whole image after merging
+    mask = get_masks(p, iscell=cp_unit, max_size_fraction=1.)
+    return cp_unit, mask, p
+
+
+def compute_masks_partitioned(dP, cp_mask, niter=200, interp=True, device=None,
+                              converge_tol=0., max_size_fraction=0.4, nthreads=None):
+    """Run dynamics and create masks separately in groups of connected components of cp_mask.
+
+    Flows are zero outside of cp_mask, so pixels stay in their connected component of cp_mask. 
+    The components are grouped into work units (see get_work_units), which are run 
+    concurrently in a thread pool, and the masks of the units are merged into one image.
+
+    Args:
+        dP (float32, 3D or 4D array): Flows [axis x Ly x Lx] or [axis x Lz x Ly x Lx].
+        cp_mask (bool, 2D or 3D array): Pixels above the cellprob threshold.
+        niter (int, optional): Number of iterations of dynamics to run. Defaults to 200.
+        interp (bool, optional): Interpolate during 2D dynamics. Defaults to True.
+        device (torch.device, optional): Device to use for interpolated dynamics. Defaults to None.
+        converge_tol (float, optional): If > 0, stop dynamics of pixels once converged (see follow_flows). Defaults to 0.
+        max_size_fraction (float, optional): Masks larger than max_size_fraction of
+            total image size are removed. Defaults to 0.4.
+        nthreads (int, optional): Number of threads. Defaults to None (number of CPUs).
+
+    Returns:
+        tuple containing:
+            - M0 (int, 2D or 3D array): Masks, 0=NO masks; 1,2,...=mask labels.
+            - p (float32, 3D or 4D array): Final locations of each pixel after dynamics.
+    """
+    shape = cp_mask.shape
+    nthreads = os.cpu_count() if nthreads is None else nthreads
+    lab, units = get_work_units(cp_mask, 4 * nthreads)
+
+    if not parallel_kernels_threadsafe():
+        nthreads = 1
+
+    p = np.array(np.meshgrid(*[np.arange(s) for s in shape], indexing="ij"),
+                 dtype=np.float32)
+    M0 = np.zeros(shape, np.uint32)
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        futures = [
+            executor.submit(_compute_masks_unit, dP, lab, slc, icomp, niter, interp,
+                            device, converge_tol) for slc, icomp in units
+        ]
+        nmasks = 0
+        for (slc, icomp), future in zip(units, futures):
+            cp_unit, mask, p_unit = future.result()
+            # pixels of other units keep their own labels
+            write = (mask > 0) & (cp_unit | ~cp_mask[slc])
+            M0[slc][write] = mask[write] + nmasks
+            nmasks += mask.max()
+            offset = np.array([sl.start for sl in slc], np.float32)
+            p[(slice(None),) + slc][:, cp_unit] = (p_unit[:, cp_unit] +
+                                                   offset[:, np.newaxis])
+
+    # remove big masks
+    uniq, counts = fastremap.unique(M0, return_counts=True)
+    bigc = uniq[(counts > np.prod(shape) * max_size_fraction) & (uniq > 0)]
+    if len(bigc) > 0:
+        M0 = fastremap.mask(M0, bigc)
+    fastremap.renumber(M0, in_place=True)
+    return M0, p
+
+
 def resize_and_compute_masks(dP, cellprob, p=None, niter=200, cellprob_threshold=0.0,
                              flow_threshold=0.4, interp=True, do_3D=False, min_size=15,
-                             resize=None, device=None):
+                             resize=None, device=None, converge_tol=0., sparse=False,
+                             partition=False):
     """Compute masks using dynamics from dP and cellprob, and resizes masks if resize is not None.
 
     Args:
@@ -771,6 +1551,9 @@ def resize_and_compute_masks(dP, cellprob, p=None, niter=200, cellprob_threshold
         min_size (int, optional): The minimum size of the masks. Defaults to 15.
         resize (tuple, optional): The desired size for resizing the masks. Defaults to None.
         device (str, optional): The torch device to use for computation. Defaults to None.
+        converge_tol (float, optional): If > 0, stop dynamics of pixels once converged (see follow_flows). Defaults to 0.
+        sparse (bool, optional): In 3D, run dynamics and make masks only on the pixels above cellprob_threshold (see compute_masks). Defaults to False.
+        partition (bool, optional): Run dynamics and make masks in parallel over groups of connected components of the cellprob mask (see compute_masks). Defaults to False.
 
     Returns:
         tuple: A tuple containing the computed masks and the final pixel locations.
@@ -778,7 +1561,9 @@ def resize_and_compute_masks(dP, cellprob, p=None, niter=200, cellprob_threshold
     mask, p = compute_masks(dP, cellprob, p=p, niter=niter,
                             cellprob_threshold=cellprob_threshold,
                             flow_threshold=flow_threshold, interp=interp, do_3D=do_3D,
-                            min_size=min_size, device=device)
+                            min_size=min_size, device=device,
+                            converge_tol=converge_tol, sparse=sparse,
+                            partition=partition)
 
     if resize is not None:
         mask = transforms.resize_image(mask, resize[0], resize[1],
@@ -793,7 +1578,7 @@ def resize_and_compute_masks(dP, cellprob, p=None, niter=200, cellprob_threshold
 
 def compute_masks(dP, cellprob, p=None, niter=200, cellprob_threshold=0.0,
                   flow_threshold=0.4, interp=True, do_3D=False, min_size=15,
-                  device=None):
+                  device=None, converge_tol=0., sparse=False, partition=False):
     """Compute masks using dynamics from dP and cellprob.
 
     Args:
@@ -807,6 +1592,15 @@ def compute_masks(dP, cellprob, p=None, niter=200, cellprob_threshold=0.0,
         do_3D (bool, optional): Whether to perform mask computation in 3D. Defaults to False.
         min_size (int, optional): The minimum size of the masks. Defaults to 15.
         device (str, optional): The torch device to use for computation. Defaults to None.
+        converge_tol (float, optional): If > 0, stop dynamics of pixels once converged (see follow_flows). Defaults to 0.
+        sparse (bool, optional): In 3D, run dynamics (with trilinear interpolation if interp is True) 
+            and make masks only on the pixels above cellprob_threshold, so that memory scales with the 
+            number of these pixels instead of with the volume (see follow_flows_sparse). The final pixel 
+            locations are then returned as [axis x npixels], for the pixels in np.nonzero(cellprob > cellprob_threshold). 
+            Defaults to False.
+        partition (bool, optional): Run dynamics and make masks separately for groups of connected 
+            components of the cellprob mask, in parallel with a thread pool (see compute_masks_partitioned).
+            Not used if sparse is True. Defaults to False.
 
     Returns:
         tuple: A tuple containing the computed masks and the final pixel locations.
@@ -814,19 +1608,29 @@ def compute_masks(dP, cellprob, p=None, niter=200, cellprob_threshold=0.0,
     cp_mask = cellprob > cellprob_threshold
 
     if np.any(cp_mask):  #mask at this point is a cell cluster binary map, not labels
-        # follow flows
-        if p is None:
-            p, inds = follow_flows(dP * cp_mask / 5., niter=niter, interp=interp,
-                                   device=device)
-            if inds is None:
-                dynamics_logger.info("No cell pixels found.")
-                shape = cellprob.shape
-                mask = np.zeros(shape, np.uint16)
-                p = np.zeros((len(shape), *shape), np.uint16)
-                return mask, p
-
-        #calculate masks
-        mask = get_masks(p, iscell=cp_mask)
+        if sparse and p is None and cp_mask.ndim == 3:
+            p, inds = follow_flows_sparse(dP, cp_mask, niter=niter, interp=interp,
+                                          converge_tol=converge_tol)
+            mask = get_masks_sparse(p, inds, iscell=cp_mask)
+            del inds
+        elif partition and p is None:
+            mask, p = compute_masks_partitioned(dP, cp_mask, niter=niter, interp=interp,
+                                                device=device,
+                                                converge_tol=converge_tol)
+        else:
+            # follow flows
+            if p is None:
+                p, inds = follow_flows(dP * cp_mask / 5., niter=niter, interp=interp,
+                                       device=device, converge_tol=converge_tol)
+                if inds is None:
+                    dynamics_logger.info("No cell pixels found.")
+                    shape = cellprob.shape
+                    mask = np.zeros(shape, np.uint16)
+                    p = np.zeros((len(shape), *shape), np.uint16)
+                    return mask, p
+
+            #calculate masks
+            mask = get_masks(p, iscell=cp_mask)
 
         # flow thresholding factored out of get_masks
         if not do_3D:
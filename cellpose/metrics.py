@@ -1,11 +1,13 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from . import utils, dynamics
 from numba import jit
 from scipy.optimize import linear_sum_assignment
-from scipy.ndimage import convolve, mean
+from scipy.ndimage import convolve, mean, find_objects
 
 
 def mask_ious(masks_true, masks_pred):
@@ -136,7 +138,7 @@ def average_precision(masks_true, masks_pred, threshold=[0.5, 0.75, 0.9]):
     return ap, tp, fp, fn
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def _label_overlap(x, y):
     """Fast function to get pixel overlaps between masks in x and y.
 
@@ -262,3 +264,72 @@ def flow_error(maski, dP_net, device=None):
                                             maski.max() + 1))
 
     return flow_errors, dP_masks
+
+
+def _flow_error_unit(maski, dP_net, slices, labels):
+    """Flow errors of the masks in labels, with flows computed in their bounding boxes."""
+    ypix, xpix, npix = [], [], np.zeros(len(labels), np.int64)
+    for j, i in enumerate(labels):
+        si = slices[i - 1]
+        if si is not None:
+            yi, xi = np.nonzero(maski[si] == i)
+            ypix.append(yi + si[0].start)
+            xpix.append(xi + si[1].start)
+            npix[j] = len(yi)
+    flow_errors = np.zeros(len(labels))
+    if npix.sum() == 0:
+        return flow_errors
+    ypix = np.concatenate(ypix).astype(np.int32)
+    xpix = np.concatenate(xpix).astype(np.int32)
+    inonempty = np.nonzero(npix)[0]
+    starts = np.concatenate(([0], np.cumsum(npix[inonempty])[:-1]))
+    mu, _ = dynamics.masks_to_flows_pixels(ypix, xpix, starts)
+    err = ((mu - dP_net[:, ypix, xpix] / 5.)**2).sum(axis=0)
+    imask = np.repeat(np.arange(len(inonempty)), npix[inonempty])
+    flow_errors[inonempty] = np.bincount(imask, weights=err) / npix[inonempty]
+    return flow_errors
+
+
+def flow_error_local(maski, dP_net, nthreads=None, max_unit_pixels=2**20):
+    """Error in flows from predicted masks vs flows predicted by network, computed per mask.
+
+    Same errors as flow_error, but the flows from the masks are only computed in the bounding box 
+    of each mask, and the mean squared error of each mask is accumulated with np.bincount. Masks are 
+    grouped into work units of at most max_unit_pixels bounding box pixels (or one mask), which are 
+    run in a thread pool, so memory scales with the size of the units and not with the image.
+
+    Args:
+        maski (np.ndarray, int): 2D masks produced from running dynamics on dP_net, where 0=NO masks; 1,2... are mask labels.
+        dP_net (np.ndarray, float): 2D flows where dP_net.shape[1:] = maski.shape.
+        nthreads (int, optional): Number of threads. Defaults to None (number of CPUs).
+        max_unit_pixels (int, optional): Maximum number of bounding box pixels in a work unit. Defaults to 2**20.
+
+    Returns:
+        flow_errors (np.ndarray, float): Mean squared error between predicted flows and flows from masks.
+
+    Raises:
+        ValueError: If dP_net is not the same size as maski.
+    """
+    if dP_net.shape[1:] != maski.shape:
+        raise ValueError(f"net flow of shape {dP_net.shape[1:]} is not same size as "
+                         f"predicted masks of shape {maski.shape}")
+
+    slices = find_objects(maski)
+    nthreads = os.cpu_count() if nthreads is None else nthreads
+    if not dynamics.parallel_kernels_threadsafe():
+        nthreads = 1
+
+    # split masks into work units with similar bounding box sizes
+    area = np.array([0 if si is None else
+                     (si[0].stop - si[0].start) * (si[1].stop - si[1].start)
+                     for si in slices])
+    unit_pixels = min(max_unit_pixels, max(1, area.sum() // nthreads))
+    unit = np.cumsum(area) // unit_pixels
+    breaks = np.nonzero(np.diff(unit))[0] + 1
+    units = np.split(np.arange(1, len(slices) + 1), breaks)
+
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        flow_errors = list(
+            executor.map(lambda labels: _flow_error_unit(maski, dP_net, slices, labels),
+                         units))
+    return np.concatenate(flow_errors)
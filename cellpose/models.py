@@ -13,9 +13,10 @@ import logging
 
 models_logger = logging.getLogger(__name__)
 
-from . import transforms, dynamics, utils, plot
+from . import transforms, dynamics, utils, plot, metrics
 from .resnet_torch import CPnet
-from .core import assign_device, check_mkl, run_net, run_3D
+from .core import (assign_device, check_mkl, run_net, run_net_batch, run_3D, run_style,
+                   get_batch_size, export_onnx, make_calibration_tiles, quantize_onnx)
 
 _MODEL_URL = "https://www.cellpose.org/models"
 _MODEL_DIR_ENV = os.environ.get("CELLPOSE_LOCAL_MODELS_PATH")
@@ -31,6 +32,13 @@ MODEL_NAMES = [
 
 MODEL_LIST_PATH = os.fspath(MODEL_DIR.joinpath("gui_models.txt"))
 
+# arguments of CellposeModel.eval used only to compute masks from the network outputs
+_COMPUTE_MASKS_KWARGS = {
+    "niter", "cellprob_threshold", "flow_threshold", "min_size", "interp", "resample",
+    "converge_tol", "partition"
+}
+_MASK_KWARGS = _COMPUTE_MASKS_KWARGS | {"progress", "batch_images", "memory_budget"}
+
 normalize_default = {
     "lowhigh": None,
     "percentile": None,
@@ -137,7 +145,8 @@ class Cellpose():
         self.sz.model_type = model_type
 
     def eval(self, x, batch_size=8, channels=[0,0], channel_axis=None, invert=False,
-             normalize=True, diameter=30., do_3D=False, find_masks=True, **kwargs):
+             normalize=True, diameter=30., do_3D=False, find_masks=True, reuse_tol=0.05,
+             **kwargs):
         """Run cellpose size model and mask model and get masks.
 
         Args:
@@ -149,6 +158,12 @@ class Cellpose():
             normalize (bool, optional): If True, normalize data so 0.0=1st percentile and 1.0=99th percentile of image intensities in each channel; can also pass dictionary of parameters (see CellposeModel for details). Defaults to True.
             diameter (float, optional): If set to None, then diameter is automatically estimated if size model is loaded. Defaults to 30..
             do_3D (bool, optional): Set to True to run 3D segmentation on 4D image input. Defaults to False.
+            reuse_tol (float, optional): If the diameter is estimated, the network outputs of the size model 
+                (computed at rescale diam_mean / diameter from style) are reused for the masks if the final 
+                rescale (diam_mean / estimated diameter) is within this relative tolerance of it, instead of 
+                running the network again; set to 0 to always run the network again. Reuse is off if kwargs 
+                change the network outputs (e.g. augment, tile_overlap). Defaults to 0.05.
+            **kwargs: Other arguments of CellposeModel.eval.
 
         Returns:
             tuple containing
@@ -169,13 +184,16 @@ class Cellpose():
         diam0 = diameter[0] if isinstance(diameter, (np.ndarray, list)) else diameter
         estimate_size = True if (diameter is None or diam0 == 0) else False
 
+        reuse = reuse_tol > 0 and set(kwargs) <= _MASK_KWARGS
+        outputs = None
         if estimate_size and self.pretrained_size is not None and not do_3D and x[
                 0].ndim < 4:
             tic = time.time()
             models_logger.info("~~~ ESTIMATING CELL DIAMETER(S) ~~~")
             diams, _ = self.sz.eval(x, channels=channels, channel_axis=channel_axis,
                                     batch_size=batch_size, normalize=normalize,
-                                    invert=invert)
+                                    invert=invert, keep_outputs=reuse)
+            outputs, self.sz.outputs = self.sz.outputs, None
             diameter = None
             models_logger.info("estimated cell diameter(s) in %0.2f sec" %
                                (time.time() - tic))
@@ -196,15 +214,63 @@ class Cellpose():
             diams = diameter
 
         models_logger.info("~~~ FINDING MASKS ~~~")
-        masks, flows, styles = self.cp.eval(x, channels=channels,
-                                            channel_axis=channel_axis,
-                                            batch_size=batch_size, normalize=normalize,
-                                            invert=invert, diameter=diams, do_3D=do_3D,
-                                            **kwargs)
+        if outputs is not None:
+            masks, flows, styles = self._eval_reuse(x, diams, outputs, reuse_tol,
+                                                    batch_size=batch_size,
+                                                    channels=channels,
+                                                    channel_axis=channel_axis,
+                                                    normalize=normalize, invert=invert,
+                                                    **kwargs)
+        else:
+            masks, flows, styles = self.cp.eval(x, channels=channels,
+                                                channel_axis=channel_axis,
+                                                batch_size=batch_size,
+                                                normalize=normalize, invert=invert,
+                                                diameter=diams, do_3D=do_3D, **kwargs)
         models_logger.info(">>>> TOTAL TIME %0.2f sec" % (time.time() - tic0))
 
         return masks, flows, styles, diams
 
+    def _eval_reuse(self, x, diams, outputs, reuse_tol, channels=None, channel_axis=None,
+                    **kwargs):
+        """ masks of 2D images x with diameters diams, computed from the network outputs of 
+        the size model when the rescale is within reuse_tol of the size model rescale, 
+        otherwise with cp.eval (see eval for args) """
+        xs = x if isinstance(x, list) else [x]
+        diams = diams if isinstance(x, list) else [diams]
+        mask_kwargs = {k: v for k, v in kwargs.items() if k in _COMPUTE_MASKS_KWARGS}
+        resample = kwargs.get("resample", True)
+        masks, flows, styles = [], [], []
+        nreuse = 0
+        for i, (xi, diam, out) in enumerate(zip(xs, diams, outputs)):
+            chan = channels[i] if (channels is not None and len(channels) == len(xs) and
+                                   isinstance(channels[i], (list, np.ndarray)) and
+                                   len(channels[i]) == 2) else channels
+            rescale = self.cp.diam_mean / diam
+            shape = transforms.convert_image(xi, chan, channel_axis=channel_axis,
+                                             do_3D=False, nchan=self.cp.nchan).shape
+            if (out is not None and len(shape) == 3 and out["dP"].ndim == 3 and
+                    abs(rescale / out["rescale"] - 1) <= reuse_tol):
+                shape = (1, *shape)
+                dP, cellprob = self.cp._resize_net_outputs(out["dP"], out["cellprob"],
+                                                           shape, rescale=rescale,
+                                                           resample=resample)
+                maski, dP, cellprob, p = self.cp._compute_masks(
+                    shape, dP, cellprob, rescale=rescale, **mask_kwargs)
+                flowi, stylei = [plot.dx_to_circ(dP), dP, cellprob, p], out["styles"]
+                nreuse += 1
+            else:
+                maski, flowi, stylei = self.cp.eval(xi, channels=chan,
+                                                    channel_axis=channel_axis,
+                                                    diameter=diam, **kwargs)
+            masks.append(maski)
+            flows.append(flowi)
+            styles.append(stylei)
+        models_logger.info(f"reused size model network outputs for {nreuse} of {len(xs)} images")
+        if not isinstance(x, list):
+            return masks[0], flows[0], styles[0]
+        return masks, flows, styles
+
 
 class CellposeModel():
     """
@@ -233,7 +299,8 @@ class CellposeModel():
     """
 
     def __init__(self, gpu=False, pretrained_model=False, model_type=None,
-                 diam_mean=30., device=None, nchan=2, backbone="default"):
+                 diam_mean=30., device=None, nchan=2, backbone="default",
+                 backend="torch", quantize=None):
         """
         Initialize the CellposeModel.
 
@@ -244,7 +311,19 @@ class CellposeModel():
             diam_mean (float, optional): Mean "diameter", 30. is built-in value for "cyto" model; 17. is built-in value for "nuclei" model; if saved in custom model file (cellpose>=2.0) then it will be loaded automatically and overwrite this value.
             device (torch device, optional): Device used for model running / training (torch.device("cuda") or torch.device("cpu")), overrides gpu input, recommended if you want to use a specific GPU (e.g. torch.device("cuda:1")).
             nchan (int, optional): Number of channels to use as input to network, default is 2 (cyto + nuclei) or (nuclei + zeros).
+            backend (str, optional): "torch", or "onnx" to run the network exported to ONNX with onnxruntime on the CPU 
+                (requires onnxruntime, see core.get_onnx_net). Defaults to "torch".
+            quantize (str, optional): "int8" to run a post-training int8 quantized network on the CPU with onnxruntime, 
+                calibrated with calibrate() or else on the images of the first call to eval 
+                (see core.quantize_onnx and quantization_report). Defaults to None.
         """
+        if backend not in ["torch", "onnx"]:
+            raise ValueError(f"backend must be 'torch' or 'onnx', not {backend}")
+        if quantize not in [None, "int8"]:
+            raise ValueError(f"quantize must be None or 'int8', not {quantize}")
+        self.backend = backend
+        self.quantize = quantize
+        self.net_int8 = None
         self.diam_mean = diam_mean
 
         ### set model path
@@ -331,18 +410,165 @@ class CellposeModel():
 
         self.net_type = f"cellpose_{backbone}"
 
+    def eval_style(self, x, batch_size=8, channels=None, channel_axis=None, z_axis=None,
+                   normalize=True, invert=False, rescale=None, diameter=None, augment=False,
+                   tile=True, tile_overlap=0.1, bsize=224, memory_budget=None):
+        """ style vectors of images x, running only the downsampling half of the network 
+        (see core.run_style); same styles as eval(x, compute_masks=False) but faster 
+
+        Args:
+            x (list, np.ndarray): list of 2D images or stacks of 2D images, or a 2D image or stack.
+            other args: see eval.
+
+        Returns:
+            styles (list, np.ndarray): style vector of size 256 of each image, or 
+                [nplanes x 256] for stacks.
+        """
+        xs = x if isinstance(x, list) else [x]
+        xs = [
+            transforms.convert_image(xi, channels, channel_axis=channel_axis,
+                                     z_axis=z_axis, do_3D=False, nchan=self.nchan)
+            for xi in xs
+        ]
+        xs = [xi[np.newaxis] if xi.ndim < 4 else xi for xi in xs]
+        if diameter is not None and diameter > 0:
+            rescale = self.diam_mean / diameter
+        elif rescale is None:
+            rescale = self.diam_mean / self.diam_labels
+        if isinstance(normalize, dict):
+            normalize_params = {**normalize_default, **normalize}
+        else:
+            normalize_params = {**normalize_default, "normalize": normalize}
+        normalize_params["invert"] = invert
+
+        imgs = []
+        for xi in xs:
+            for img in xi:
+                img = np.asarray(img)
+                if normalize_params["normalize"]:
+                    img = transforms.normalize_img(img, **normalize_params)
+                if rescale != 1.0:
+                    img = transforms.resize_image(img, rsz=rescale)
+                imgs.append(img)
+        style = run_style(self.net, imgs, batch_size=batch_size, augment=augment,
+                          tile=tile, tile_overlap=tile_overlap, bsize=bsize,
+                          memory_budget=memory_budget, backend=self.backend)
+        styles, k = [], 0
+        for xi in xs:
+            styles.append(np.array(style[k:k + len(xi)]).squeeze())
+            k += len(xi)
+        return styles if isinstance(x, list) else styles[0]
+
+    def calibrate(self, x, channels=None, channel_axis=None, z_axis=None, normalize=True,
+                  invert=False, rescale=None, diameter=None, bsize=224, ntiles=32,
+                  filename=None):
+        """ calibrate and quantize the network to int8 on images x (used if quantize="int8")
+
+        Args:
+            x (list, np.ndarray): images to calibrate on, a few images representative of the data.
+            ntiles (int, optional): maximum number of tiles to calibrate on. Defaults to 32.
+            filename (str, optional): file to save the quantized ONNX network to. Defaults to None.
+            other args: see eval.
+        """
+        x = x if isinstance(x, list) else [x]
+        x = [
+            transforms.convert_image(xi, channels, channel_axis=channel_axis,
+                                     z_axis=z_axis, do_3D=False, nchan=self.nchan)
+            for xi in x
+        ]
+        x = [xi[np.newaxis] if xi.ndim < 4 else xi for xi in x]
+        if diameter is not None and diameter > 0:
+            rescale = self.diam_mean / diameter
+        elif rescale is None:
+            rescale = self.diam_mean / self.diam_labels
+        if isinstance(normalize, dict):
+            normalize_params = {**normalize_default, **normalize}
+        else:
+            normalize_params = {**normalize_default, "normalize": normalize}
+        normalize_params["invert"] = invert
+        self._calibrate([xi for xs in x for xi in xs], normalize_params, rescale,
+                        bsize=bsize, ntiles=ntiles, filename=filename)
+
+    def _calibrate(self, x, normalize_params, rescale, bsize=224, ntiles=32, filename=None):
+        """ quantize the network, calibrated on the planes of x [nimg x Ly x Lx x nchan] """
+        imgs = []
+        for img in x:
+            img = np.asarray(img)
+            if normalize_params["normalize"]:
+                img = transforms.normalize_img(img, **normalize_params)
+            if rescale != 1.0:
+                img = transforms.resize_image(img, rsz=rescale)
+            imgs.append(img)
+        tiles = make_calibration_tiles(imgs, bsize=bsize, ntiles=ntiles)
+        self.net_int8 = quantize_onnx(self.net, tiles, filename=filename)
+
+    def quantization_report(self, x, **kwargs):
+        """ compare the int8 quantized network to the float32 network on images x
+
+        The masks of the quantized network are scored against the masks of the float32 network 
+        with metrics.average_precision. The network is quantized first if not calibrated yet.
+
+        Args:
+            x (list, np.ndarray): list of images.
+            kwargs: arguments passed to eval (e.g. channels, diameter).
+
+        Returns:
+            dict: "ap" (average precision at IoU thresholds 0.5, 0.75 and 0.9 for each image [nimg x 3]), 
+                "time_fp32" and "time_int8" (time of eval in seconds), "speedup" (time_fp32 / time_int8).
+        """
+        x = x if isinstance(x, list) else [x]
+        quantize = self.quantize
+        times, masks = {}, {}
+        try:
+            for mode in [None, "int8"]:
+                self.quantize = mode
+                # warm-up (first run benchmarks / quantizes the network)
+                self.eval(x[0], compute_masks=False, **kwargs)
+                tic = time.time()
+                masks[mode] = self.eval(x, **kwargs)[0]
+                times[mode] = time.time() - tic
+        finally:
+            self.quantize = quantize
+        ap = metrics.average_precision(masks[None], masks["int8"])[0]
+        # images without masks in both
+        ap[np.isnan(ap)] = 1.
+        report = {
+            "ap": ap,
+            "time_fp32": times[None],
+            "time_int8": times["int8"],
+            "speedup": times[None] / times["int8"]
+        }
+        models_logger.info(
+            f"int8 quantization: AP@0.5 vs float32 masks = {ap[:, 0].mean():0.3f}, "
+            f"AP@0.75 = {ap[:, 1].mean():0.3f}, AP@0.9 = {ap[:, 2].mean():0.3f}; "
+            f"eval time {times[None]:0.2f}s (float32) vs {times['int8']:0.2f}s (int8), "
+            f"speedup {report['speedup']:0.2f}x")
+        return report
+
+    def export_onnx(self, filename, opset_version=17):
+        """ export the network (outputs and style) to ONNX with dynamic batch and spatial axes,
+        to run with onnxruntime (see core.export_onnx and core.OnnxNet) 
+
+        Args:
+            filename (str): file to save the ONNX network to.
+            opset_version (int, optional): ONNX opset version. Defaults to 17.
+        """
+        export_onnx(self.net, filename, opset_version=opset_version)
+
     def eval(self, x, batch_size=8, resample=True, channels=None, channel_axis=None,
              z_axis=None, normalize=True, invert=False, rescale=None, diameter=None,
              flow_threshold=0.4, cellprob_threshold=0.0, do_3D=False, anisotropy=None,
              stitch_threshold=0.0, min_size=15, niter=None, augment=False, tile=True,
              tile_overlap=0.1, bsize=224, interp=True, compute_masks=True,
-             progress=None):
+             progress=None, converge_tol=0., sparse=False, partition=False,
+             memory_budget=None, batch_images=True, skip_background=None):
         """ segment list of images x, or 4D array - Z x nchan x Y x X
 
         Args:
             x (list, np.ndarry): can be list of 2D/3D/4D images, or array of 2D/3D/4D images
-            batch_size (int, optional): number of 224x224 patches to run simultaneously on the GPU
-                (can make smaller or bigger depending on GPU memory usage). Defaults to 8.
+            batch_size (int or str, optional): number of 224x224 patches to run simultaneously on the GPU
+                (can make smaller or bigger depending on GPU memory usage), or "auto" to use the largest
+                batch that fits in memory_budget. Defaults to 8.
             resample (bool, optional): run dynamics at original image size (will be slower but create more accurate boundaries). Defaults to True.
             channels (list, optional): list of channels, either of length 2 or of length number of images by 2.
                 First element of list is the channel to segment (0=grayscale, 1=red, 2=green, 3=blue).
@@ -383,6 +609,23 @@ class CellposeModel():
             interp (bool, optional): interpolate during 2D dynamics (not available in 3D) . Defaults to True.
             compute_masks (bool, optional): Whether or not to compute dynamics and return masks. This is set to False when retrieving the styles for the size model. Defaults to True.
             progress (QProgressBar, optional): pyqt progress bar. Defaults to None.
+            converge_tol (float, optional): if > 0, pixels which move less than converge_tol pixels over 10 iterations
+                stop running dynamics, and dynamics end early once nearly all pixels have converged. Defaults to 0.
+            sparse (bool, optional): if do_3D, run dynamics and make masks only on the voxels above cellprob_threshold, 
+                with memory scaling with the number of these voxels instead of the volume; 
+                flows[3] then holds the final locations of these voxels [3 x nvoxels]. Defaults to False.
+            partition (bool, optional): run dynamics and make masks in parallel (thread pool) over groups of 
+                connected components of the cellprob mask; faster on images with many separate cells. Defaults to False.
+            memory_budget (float, optional): memory budget in GB for batch_size="auto", if None half of the 
+                free GPU memory (or available RAM on CPU) is used. Defaults to None.
+            batch_images (bool, optional): if x is a list of 2D images (and not do_3D or stitching), 
+                run the tiles of small images of the same size through the network together, in groups of 
+                at most batch_size tiles, instead of one image at a time; faster for many small images. 
+                Images with at least batch_size tiles are segmented one at a time. Defaults to True.
+            skip_background (float, optional): if not None, tiles whose normalized intensity is below this 
+                threshold are not run through the network and get zero flows and a very negative cell 
+                probability; faster on sparse images and slide margins (e.g. 0.1). The number of 
+                skipped tiles is logged. Defaults to None.
 
         Returns:
             A tuple containing:
@@ -396,6 +639,21 @@ class CellposeModel():
             masks, styles, flows = [], [], []
             tqdm_out = utils.TqdmToLogger(models_logger, level=logging.INFO)
             nimg = len(x)
+            if (batch_images and nimg > 1 and not do_3D and stitch_threshold == 0 and
+                    not (channels is not None and len(channels) == nimg and
+                         isinstance(channels[0], (list, np.ndarray))) and
+                    not isinstance(rescale, (list, np.ndarray)) and
+                    not isinstance(diameter, (list, np.ndarray))):
+                return self._eval_batch(
+                    x, batch_size=batch_size, channels=channels,
+                    channel_axis=channel_axis, z_axis=z_axis, normalize=normalize,
+                    invert=invert, rescale=rescale, diameter=diameter, augment=augment,
+                    tile=tile, tile_overlap=tile_overlap, bsize=bsize, resample=resample,
+                    interp=interp, flow_threshold=flow_threshold,
+                    cellprob_threshold=cellprob_threshold, compute_masks=compute_masks,
+                    min_size=min_size, niter=niter, converge_tol=converge_tol,
+                    partition=partition, memory_budget=memory_budget,
+                    skip_background=skip_background)
             iterator = trange(nimg, file=tqdm_out,
                               mininterval=30) if nimg > 1 else range(nimg)
             for i in iterator:
@@ -417,7 +675,9 @@ class CellposeModel():
                     interp=interp, flow_threshold=flow_threshold,
                     cellprob_threshold=cellprob_threshold, compute_masks=compute_masks,
                     min_size=min_size, stitch_threshold=stitch_threshold,
-                    progress=progress, niter=niter)
+                    progress=progress, niter=niter, converge_tol=converge_tol,
+                    sparse=sparse, partition=partition, memory_budget=memory_budget,
+                    skip_background=skip_background)
                 masks.append(maski)
                 flows.append(flowi)
                 styles.append(stylei)
@@ -432,6 +692,8 @@ class CellposeModel():
                                          nchan=self.nchan)
             if x.ndim < 4:
                 x = x[np.newaxis, ...]
+            elif x.shape[0] > 1 and not do_3D and stitch_threshold == 0:
+                models_logger.warning("3D stack used, but stitch_threshold=0 and do_3D=False, so masks are made per plane only")
             self.batch_size = batch_size
 
             if diameter is not None and diameter > 0:
@@ -446,23 +708,120 @@ class CellposeModel():
                 tile_overlap=tile_overlap, bsize=bsize, flow_threshold=flow_threshold,
                 cellprob_threshold=cellprob_threshold, interp=interp, min_size=min_size,
                 do_3D=do_3D, anisotropy=anisotropy, niter=niter,
-                stitch_threshold=stitch_threshold)
+                stitch_threshold=stitch_threshold, converge_tol=converge_tol,
+                sparse=sparse, partition=partition, batch_size=batch_size,
+                memory_budget=memory_budget, skip_background=skip_background)
 
             flows = [plot.dx_to_circ(dP), dP, cellprob, p]
             return masks, flows, styles
 
+    def _eval_batch(self, x, batch_size=8, channels=None, channel_axis=None, z_axis=None,
+                    normalize=True, invert=False, rescale=None, diameter=None,
+                    compute_masks=True, **kwargs):
+        """ segment list of 2D images x, running the tiles of small images of the same size 
+        together so that they fill the network batches (see eval for args); 
+        images with at least batch_size tiles are segmented one at a time """
+        tic = time.time()
+        nimg = len(x)
+        self.batch_size = batch_size
+        if diameter is not None and diameter > 0:
+            rescale = self.diam_mean / diameter
+        elif rescale is None:
+            rescale = self.diam_mean / self.diam_labels
+        bsize = kwargs.get("bsize", 224)
+        nbatch = (batch_size if batch_size != "auto" else get_batch_size(
+            self.net, bsize=bsize, memory_budget=kwargs.get("memory_budget")))
+
+        def ntiles(shape):
+            Ly, Lx = int(shape[0] * rescale), int(shape[1] * rescale)
+            if kwargs.get("tile", True) or kwargs.get("augment", False):
+                return transforms.tile_count(Ly, Lx, bsize=bsize,
+                                             augment=kwargs.get("augment", False),
+                                             tile_overlap=kwargs.get("tile_overlap", 0.1))
+            return int(np.ceil(Ly * Lx / bsize**2))
+
+        masks, flows, styles = [None] * nimg, [None] * nimg, [None] * nimg
+        xc, groups = {}, {}
+        for i in range(nimg):
+            xi = transforms.convert_image(x[i], channels, channel_axis=channel_axis,
+                                          z_axis=z_axis, do_3D=False, nchan=self.nchan)
+            if xi.ndim == 3 and ntiles(xi.shape) < nbatch:
+                xc[i] = xi
+                groups.setdefault(xi.shape, []).append(i)
+            else:
+                # large image or stack of planes, segmented on its own
+                del xi
+                masks[i], flows[i], styles[i] = self.eval(
+                    x[i], batch_size=batch_size, channels=channels,
+                    channel_axis=channel_axis, z_axis=z_axis, normalize=normalize,
+                    invert=invert, rescale=rescale, compute_masks=compute_masks, **kwargs)
+        # groups of images with at most nbatch tiles in total
+        chunks = []
+        for shape, inds in groups.items():
+            nchunk = max(1, nbatch // ntiles(shape))
+            chunks.extend([inds[k:k + nchunk] for k in range(0, len(inds), nchunk)])
+        for inds in chunks:
+            n = len(inds)
+            xg = np.stack([xc.pop(i) for i in inds], axis=0)
+            maskg, styleg, dPg, cellprobg, pg = self._run_cp(
+                xg, normalize=normalize, invert=invert, rescale=rescale,
+                batch_size=batch_size, compute_masks=compute_masks, **kwargs)
+            # undo squeeze of image axis
+            styleg = styleg.reshape(n, -1)
+            dPg = dPg.reshape(2, n, *dPg.shape[-2:])
+            cellprobg = cellprobg.reshape(n, *cellprobg.shape[-2:])
+            if compute_masks:
+                maskg = maskg.reshape(n, *maskg.shape[-2:])
+                pg = pg.reshape(n, 2, *pg.shape[-2:])
+            for j, i in enumerate(inds):
+                styles[i] = styleg[j]
+                if compute_masks:
+                    masks[i], dP, cellprob, p = maskg[j], dPg[:, j], cellprobg[j], pg[j]
+                else:
+                    masks[i], dP, cellprob, p = maskg, dPg[:, j:j + 1], cellprobg[j:j + 1], pg
+                flows[i] = [plot.dx_to_circ(dP), dP, cellprob, p]
+        self.timing = [(time.time() - tic) / nimg] * nimg
+        return masks, flows, styles
+
     def _run_cp(self, x, compute_masks=True, normalize=True, invert=False, niter=None,
                 rescale=1.0, resample=True, augment=False, tile=True, tile_overlap=0.1,
                 cellprob_threshold=0.0, bsize=224, flow_threshold=0.4, min_size=15,
-                interp=True, anisotropy=1.0, do_3D=False, stitch_threshold=0.0):
+                interp=True, anisotropy=1.0, do_3D=False, stitch_threshold=0.0,
+                converge_tol=0., sparse=False, partition=False, batch_size=8,
+                memory_budget=None, skip_background=None):
+
+        styles, dP, cellprob = self._run_net(
+            x, normalize=normalize, invert=invert, rescale=rescale, resample=resample,
+            augment=augment, tile=tile, tile_overlap=tile_overlap, bsize=bsize,
+            anisotropy=anisotropy, do_3D=do_3D, stitch_threshold=stitch_threshold,
+            batch_size=batch_size, memory_budget=memory_budget,
+            skip_background=skip_background)
+        if compute_masks:
+            masks, dP, cellprob, p = self._compute_masks(
+                x.shape, dP, cellprob, niter=niter, rescale=rescale, resample=resample,
+                cellprob_threshold=cellprob_threshold, flow_threshold=flow_threshold,
+                min_size=min_size, interp=interp, do_3D=do_3D,
+                stitch_threshold=stitch_threshold, converge_tol=converge_tol,
+                sparse=sparse, partition=partition)
+        else:
+            masks, p = np.zeros(0), np.zeros(0)  #pass back zeros if not compute_masks
+        return masks, styles, dP, cellprob, p
 
+    def _run_net(self, x, normalize=True, invert=False, rescale=1.0, resample=True,
+                 augment=False, tile=True, tile_overlap=0.1, bsize=224, anisotropy=1.0,
+                 do_3D=False, stitch_threshold=0.0, batch_size=8, memory_budget=None,
+                 skip_background=None):
+        """ run network on stack of images x [nimg x Ly x Lx x nchan] (see eval for args)
+
+        Returns:
+            styles, dP [2 x nimg x Ly x Lx] or [3 x Lz x Ly x Lx] and cellprob [nimg x Ly x Lx]
+        """
         if isinstance(normalize, dict):
             normalize_params = {**normalize_default, **normalize}
         elif not isinstance(normalize, bool):
             raise ValueError("normalize parameter must be a bool or a dict")
         else:
-            normalize_params = normalize_default
-            normalize_params["normalize"] = normalize
+            normalize_params = {**normalize_default, "normalize": normalize}
         normalize_params["invert"] = invert
 
         tic = time.time()
@@ -481,10 +840,20 @@ class CellposeModel():
             # do not normalize again
             do_normalization = False
 
+        net, backend = self.net, self.backend
+        if self.quantize == "int8":
+            if self.net_int8 is None:
+                models_logger.info("calibrating int8 quantization on input images")
+                self._calibrate(x, {**normalize_params, "normalize": do_normalization},
+                                rescale if not do_3D else 1.0, bsize=bsize)
+            net = self.net_int8
+
         if do_3D:
             img = np.asarray(x)
-            yf, styles = run_3D(self.net, img, rsz=rescale, anisotropy=anisotropy,
-                                augment=augment, tile=tile, tile_overlap=tile_overlap)
+            yf, styles = run_3D(net, img, batch_size=batch_size, rsz=rescale,
+                                anisotropy=anisotropy, augment=augment, tile=tile,
+                                tile_overlap=tile_overlap, memory_budget=memory_budget,
+                                backend=backend, skip_background=skip_background)
             cellprob = yf[0][-1] + yf[1][-1] + yf[2][-1]
             dP = np.stack(
                 (yf[1][0] + yf[2][0], yf[0][0] + yf[2][1], yf[0][1] + yf[1][1]),
@@ -492,8 +861,6 @@ class CellposeModel():
             del yf
         else:
             tqdm_out = utils.TqdmToLogger(models_logger, level=logging.INFO)
-            iterator = trange(nimg, file=tqdm_out,
-                              mininterval=30) if nimg > 1 else range(nimg)
             styles = np.zeros((nimg, self.nbase[-1]), np.float32)
             if resample:
                 dP = np.zeros((2, nimg, shape[1], shape[2]), np.float32)
@@ -505,84 +872,124 @@ class CellposeModel():
                 cellprob = np.zeros(
                     (nimg, int(shape[1] * rescale), int(shape[2] * rescale)),
                     np.float32)
-            for i in iterator:
-                img = np.asarray(x[i])
-                if do_normalization:
-                    img = transforms.normalize_img(img, **normalize_params)
-                if rescale != 1.0:
-                    img = transforms.resize_image(img, rsz=rescale)
-                yf, style = run_net(self.net, img, bsize=bsize, augment=augment,
-                                        tile=tile, tile_overlap=tile_overlap)
-                if resample:
-                    yf = transforms.resize_image(yf, shape[1], shape[2])
-
-                cellprob[i] = yf[:, :, 2]
-                dP[:, i] = yf[:, :, :2].transpose((2, 0, 1))
-                if self.nclasses == 4:
-                    if i == 0:
-                        bd = np.zeros_like(cellprob)
-                    bd[i] = yf[:, :, 3]
-                styles[i][:len(style)] = style
-            del yf, style
+            # run tiles of several planes through the network together, 
+            # in chunks of about 4 batches of tiles
+            nbatch = (batch_size if batch_size != "auto" else
+                      get_batch_size(net, bsize=bsize, memory_budget=memory_budget))
+            nchunk = max(1, int(4 * nbatch * bsize**2 //
+                                (shape[1] * shape[2] * rescale**2)))
+            iterator = trange(0, nimg, nchunk, file=tqdm_out,
+                              mininterval=30) if nimg > nchunk else range(0, nimg, nchunk)
+            for k in iterator:
+                imgs = []
+                for i in range(k, min(nimg, k + nchunk)):
+                    img = np.asarray(x[i])
+                    if do_normalization:
+                        img = transforms.normalize_img(img, **normalize_params)
+                    if rescale != 1.0:
+                        img = transforms.resize_image(img, rsz=rescale)
+                    imgs.append(img)
+                yfs, style = run_net_batch(net, imgs, batch_size=batch_size,
+                                           bsize=bsize, augment=augment, tile=tile,
+                                           tile_overlap=tile_overlap,
+                                           memory_budget=memory_budget, backend=backend,
+                                           skip_background=skip_background)
+                del imgs
+                for i, yf in zip(range(k, min(nimg, k + nchunk)), yfs):
+                    if resample:
+                        yf = transforms.resize_image(yf, shape[1], shape[2])
+
+                    cellprob[i] = yf[:, :, 2]
+                    dP[:, i] = yf[:, :, :2].transpose((2, 0, 1))
+                    if self.nclasses == 4:
+                        if i == 0:
+                            bd = np.zeros_like(cellprob)
+                        bd[i] = yf[:, :, 3]
+                    styles[i][:len(style[i - k])] = style[i - k]
+            del yfs, yf, style
         styles = styles.squeeze()
 
         net_time = time.time() - tic
         if nimg > 1:
             models_logger.info("network run in %2.2fs" % (net_time))
+        return styles, dP, cellprob
 
-        if compute_masks:
-            tic = time.time()
-            niter0 = 200 if (do_3D and not resample) else (1 / rescale * 200)
-            niter = niter0 if niter is None or niter==0 else niter
-            if do_3D:
-                masks, p = dynamics.resize_and_compute_masks(
-                    dP, cellprob, niter=niter, cellprob_threshold=cellprob_threshold,
-                    flow_threshold=flow_threshold, interp=interp, do_3D=do_3D,
-                    min_size=min_size, resize=None,
-                    device=self.device if self.gpu else None)
-            else:
-                masks, p = [], []
-                resize = [shape[1], shape[2]] if (not resample and
-                                                  rescale != 1) else None
-                iterator = trange(nimg, file=tqdm_out,
-                                  mininterval=30) if nimg > 1 else range(nimg)
-                for i in iterator:
-                    outputs = dynamics.resize_and_compute_masks(
-                        dP[:, i],
-                        cellprob[i],
-                        niter=niter,
-                        cellprob_threshold=cellprob_threshold,
-                        flow_threshold=flow_threshold,
-                        interp=interp,
-                        resize=resize,
-                        min_size=min_size if stitch_threshold == 0 or nimg == 1 else
-                        -1,  # turn off for 3D stitching
-                        device=self.device if self.gpu else None)
-                    masks.append(outputs[0])
-                    p.append(outputs[1])
-
-                masks = np.array(masks)
-                p = np.array(p)
-                if stitch_threshold > 0 and nimg > 1:
-                    models_logger.info(
-                        f"stitching {nimg} planes using stitch_threshold={stitch_threshold:0.3f} to make 3D masks"
-                    )
-                    masks = utils.stitch3D(masks, stitch_threshold=stitch_threshold)
-                    masks = utils.fill_holes_and_remove_small_masks(
-                        masks, min_size=min_size)
-                elif nimg > 1:
-                    models_logger.warning("3D stack used, but stitch_threshold=0 and do_3D=False, so masks are made per plane only")
-
-
-            flow_time = time.time() - tic
-            if nimg > 1:
-                models_logger.info("masks created in %2.2fs" % (flow_time))
-            masks, dP, cellprob, p = masks.squeeze(), dP.squeeze(), cellprob.squeeze(
-            ), p.squeeze()
+    def _resize_net_outputs(self, dP, cellprob, shape, rescale=1.0, resample=True):
+        """ resize the network outputs dP [2 x ly x lx] and cellprob [ly x lx] of a 2D image of 
+        size shape [1 x Ly x Lx x nchan], computed at another rescale, to the size returned by 
+        _run_net at rescale
 
+        Returns:
+            dP [2 x 1 x Ly x Lx] and cellprob [1 x Ly x Lx] (Ly, Lx rescaled if not resample)
+        """
+        if resample:
+            Ly, Lx = shape[1], shape[2]
         else:
-            masks, p = np.zeros(0), np.zeros(0)  #pass back zeros if not compute_masks
-        return masks, styles, dP, cellprob, p
+            Ly, Lx = int(shape[1] * rescale), int(shape[2] * rescale)
+        yf = np.concatenate((dP.transpose(1, 2, 0), cellprob[..., np.newaxis]), axis=-1)
+        yf = transforms.resize_image(yf, Ly, Lx)
+        return yf[:, :, :2].transpose((2, 0, 1))[:, np.newaxis], yf[np.newaxis, :, :, 2]
+
+    def _compute_masks(self, shape, dP, cellprob, niter=None, rescale=1.0, resample=True,
+                       cellprob_threshold=0.0, flow_threshold=0.4, min_size=15,
+                       interp=True, do_3D=False, stitch_threshold=0.0, converge_tol=0.,
+                       sparse=False, partition=False):
+        """ compute masks from the network output of _run_net for images of size shape 
+        (see eval for args)
+
+        Returns:
+            masks, dP, cellprob and p (squeezed)
+        """
+        nimg = shape[0]
+        tqdm_out = utils.TqdmToLogger(models_logger, level=logging.INFO)
+        tic = time.time()
+        niter0 = 200 if (do_3D and not resample) else (1 / rescale * 200)
+        niter = niter0 if niter is None or niter==0 else niter
+        if do_3D:
+            masks, p = dynamics.resize_and_compute_masks(
+                dP, cellprob, niter=niter, cellprob_threshold=cellprob_threshold,
+                flow_threshold=flow_threshold, interp=interp, do_3D=do_3D,
+                min_size=min_size, resize=None,
+                device=self.device if self.gpu else None, converge_tol=converge_tol,
+                sparse=sparse, partition=partition)
+        else:
+            masks, p = [], []
+            resize = [shape[1], shape[2]] if (not resample and
+                                              rescale != 1) else None
+            iterator = trange(nimg, file=tqdm_out,
+                              mininterval=30) if nimg > 1 else range(nimg)
+            for i in iterator:
+                outputs = dynamics.resize_and_compute_masks(
+                    dP[:, i],
+                    cellprob[i],
+                    niter=niter,
+                    cellprob_threshold=cellprob_threshold,
+                    flow_threshold=flow_threshold,
+                    interp=interp,
+                    resize=resize,
+                    min_size=min_size if stitch_threshold == 0 or nimg == 1 else
+                    -1,  # turn off for 3D stitching
+                    device=self.device if self.gpu else None,
+                    converge_tol=converge_tol, partition=partition)
+                masks.append(outputs[0])
+                p.append(outputs[1])
+
+            masks = np.array(masks)
+            p = np.array(p)
+            if stitch_threshold > 0 and nimg > 1:
+                models_logger.info(
+                    f"stitching {nimg} planes using stitch_threshold={stitch_threshold:0.3f} to make 3D masks"
+                )
+                masks = utils.stitch3D(masks, stitch_threshold=stitch_threshold)
+                masks = utils.fill_holes_and_remove_small_masks(
+                    masks, min_size=min_size)
+
+        flow_time = time.time() - tic
+        if nimg > 1:
+            models_logger.info("masks created in %2.2fs" % (flow_time))
+        masks, dP, cellprob, p = masks.squeeze(), dP.squeeze(), cellprob.squeeze(
+        ), p.squeeze()
+        return masks, dP, cellprob, p
 
 class SizeModel():
     """ 
@@ -621,6 +1028,7 @@ class SizeModel():
         """
 
         self.pretrained_size = pretrained_size
+        self.outputs = None
         self.cp = cp_model
         self.device = self.cp.device
         self.diam_mean = self.cp.diam_mean
@@ -633,7 +1041,8 @@ class SizeModel():
             raise ValueError(error_message)
 
     def eval(self, x, channels=None, channel_axis=None, normalize=True, invert=False,
-             augment=False, tile=True, batch_size=8, progress=None):
+             augment=False, tile=True, batch_size=8, progress=None, style_rsz=1.0,
+             keep_outputs=False):
         """Use images x to produce style or use style input to predict size of objects in image.
 
         Object size estimation is done in two steps:
@@ -667,7 +1076,12 @@ class SizeModel():
             batch_size (int, optional): number of 224x224 patches to run simultaneously on the GPU
                 (can make smaller or bigger depending on GPU memory usage). Defaults to 8.
             progress (QProgressBar, optional): pyqt progress bar. Defaults to None.
-
+            style_rsz (float, optional): resize factor of the images for the style, e.g. 0.5 to compute the style 
+                faster on images downsampled by 2 (approximate, the diameter estimated from the style is divided 
+                by style_rsz). Defaults to 1.0 (same style as CellposeModel.eval).
+            keep_outputs (bool, optional): keep the network outputs of step 2 of each image in self.outputs, 
+                as dicts with "rescale", "dP", "cellprob" (at the rescaled size) and "styles", 
+                to reuse them for segmentation (None for images that are not 2D). Defaults to False.
 
         Returns:
             A tuple containing:
@@ -676,50 +1090,68 @@ class SizeModel():
         """
         if isinstance(x, list):
             self.timing = []
-            diams, diams_style = [], []
+            diams, diams_style, outputs = [], [], []
             nimg = len(x)
             tqdm_out = utils.TqdmToLogger(models_logger, level=logging.INFO)
             iterator = trange(nimg, file=tqdm_out,
                               mininterval=30) if nimg > 1 else range(nimg)
             for i in iterator:
                 tic = time.time()
-                diam, diam_style = self.eval(
+                diam, diam_style, out = self._eval(
                     x[i], channels=channels[i] if
                     (channels is not None and len(channels) == len(x) and
                      (isinstance(channels[i], list) or
                       isinstance(channels[i], np.ndarray)) and
                      len(channels[i]) == 2) else channels, channel_axis=channel_axis,
                     normalize=normalize, invert=invert, augment=augment, tile=tile,
-                    batch_size=batch_size, progress=progress)
+                    batch_size=batch_size, style_rsz=style_rsz)
                 diams.append(diam)
                 diams_style.append(diam_style)
+                outputs.append(out)
                 self.timing.append(time.time() - tic)
-
+            self.outputs = outputs if keep_outputs else None
             return diams, diams_style
 
+        diam, diam_style, out = self._eval(x, channels=channels, channel_axis=channel_axis,
+                                           normalize=normalize, invert=invert,
+                                           augment=augment, tile=tile,
+                                           batch_size=batch_size, style_rsz=style_rsz)
+        self.outputs = [out] if keep_outputs else None
+        return diam, diam_style
+
+    def _eval(self, x, channels=None, channel_axis=None, normalize=True, invert=False,
+              augment=False, tile=True, batch_size=8, style_rsz=1.0):
+        """ estimate the size of objects in image x (see eval for args)
+
+        Returns:
+            diam, diam_style and the network outputs of the mask pass (dict with "rescale", 
+            "dP", "cellprob" and "styles", None if x is not 2D)
+        """
         if x.squeeze().ndim > 3:
             models_logger.warning("image is not 2D cannot compute diameter")
-            return self.diam_mean, self.diam_mean
+            return self.diam_mean, self.diam_mean, None
 
-        styles = self.cp.eval(x, channels=channels, channel_axis=channel_axis,
-                              normalize=normalize, invert=invert, augment=augment,
-                              tile=tile, batch_size=batch_size, resample=False,
-                              compute_masks=False)[-1]
+        # style from the downsampling half of the network only
+        styles = self.cp.eval_style(
+            x, channels=channels, channel_axis=channel_axis, normalize=normalize,
+            invert=invert, augment=augment, tile=tile, batch_size=batch_size,
+            rescale=style_rsz * self.cp.diam_mean / self.cp.diam_labels)
 
-        diam_style = self._size_estimation(np.array(styles))
+        diam_style = self._size_estimation(np.array(styles)) / style_rsz
         diam_style = self.diam_mean if (diam_style == 0 or
                                         np.isnan(diam_style)) else diam_style
 
-        masks = self.cp.eval(
+        rescale = self.diam_mean / diam_style if self.diam_mean > 0 else 1
+        masks, flows, styles = self.cp.eval(
             x, compute_masks=True, channels=channels, channel_axis=channel_axis,
             normalize=normalize, invert=invert, augment=augment, tile=tile,
-            batch_size=batch_size, resample=False,
-            rescale=self.diam_mean / diam_style if self.diam_mean > 0 else 1,
-            diameter=None, interp=False)[0]
+            batch_size=batch_size, resample=False, rescale=rescale, diameter=None,
+            interp=False)
 
         diam = utils.diameters(masks)[0]
         diam = self.diam_mean if (diam == 0 or np.isnan(diam)) else diam
-        return diam, diam_style
+        out = {"rescale": rescale, "dP": flows[1], "cellprob": flows[2], "styles": styles}
+        return diam, diam_style, out
 
     def _size_estimation(self, style):
         """ linear regression from style to size 
@@ -732,3 +1164,46 @@ class SizeModel():
                        np.log(self.diam_mean) + self.params["ymean"])
         szest = np.maximum(5., szest)
         return szest
+
+
+def warmup(model=None):
+    """Compile the numba kernels of cellpose, or load them from the on-disk cache, and prepare 
+    the network of model, so that the first image processed afterwards runs at full speed.
+
+    The numba kernels are cached on disk (in the __pycache__ folder of cellpose, or in 
+    NUMBA_CACHE_DIR if set), so they are compiled only in the first process and then loaded 
+    in the next ones. The kernels are run on small synthetic masks in 2D and 3D, through the 
+    flow, mask and metric functions.
+
+    Args:
+        model (CellposeModel, Cellpose or CellposeDenoiseModel, optional): model run on a small 
+            image to prepare its network (see core.get_runtime). Defaults to None.
+
+    Returns:
+        float: time taken (s).
+    """
+    tic = time.time()
+    # two disks, one of them with a hole, and a mask smaller than min_size
+    yy, xx = np.meshgrid(np.arange(64), np.arange(64), indexing="ij")
+    masks = np.zeros((64, 64), np.uint16)
+    masks[(yy - 20)**2 + (xx - 20)**2 < 144] = 1
+    masks[(yy - 40)**2 + (xx - 44)**2 < 144] = 2
+    masks[20, 20] = 0
+    masks[60:62, 2:4] = 3
+    for M in [masks, np.tile(masks, (8, 1, 1))]:
+        dP = 5. * dynamics.masks_to_flows(M).astype(np.float32)
+        cellprob = np.where(M > 0, 5., -5.).astype(np.float32)
+        for interp in [True, False]:
+            dynamics.compute_masks(dP, cellprob, niter=50, interp=interp,
+                                   do_3D=M.ndim == 3)
+        if M.ndim == 3:
+            dynamics.compute_masks(dP, cellprob, niter=50, do_3D=True, sparse=True)
+        utils.fill_holes_and_remove_small_masks(M.astype(np.uint32), min_size=15)
+        metrics.average_precision(M, M)
+    dynamics.masks_to_flows_gpu(masks, device=torch.device("cpu"))
+    if model is not None:
+        model.eval(np.random.default_rng(0).random((128, 128)).astype(np.float32),
+                   channels=[0, 0])
+    toc = time.time() - tic
+    models_logger.info(f"warmup done in {toc:0.2f}s")
+    return toc
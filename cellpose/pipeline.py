@@ -0,0 +1,380 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+
+import os, time, threading, queue
+import multiprocessing
+import logging, logging.handlers
+import numpy as np
+import torch, torch.multiprocessing
+import numba
+
+from . import io, transforms, plot, dynamics
+from .models import Cellpose, normalize_default
+
+pipeline_logger = logging.getLogger(__name__)
+
+STAGES = ["read", "net", "masks", "write"]
+
+_DONE = object()
+
+
+class _Stage():
+    """ pool of worker threads running func on the items of queue_in and putting the results
+    in queue_out, with the time spent in func recorded per worker """
+
+    def __init__(self, name, func, nworkers, queue_in, queue_out=None, nworkers_next=0,
+                 failed=None):
+        self.name = name
+        self.func = func
+        self.nworkers = nworkers
+        self.queue_in = queue_in
+        self.queue_out = queue_out
+        self.nworkers_next = nworkers_next
+        self.failed = failed if failed is not None else threading.Event()
+        self.busy = np.zeros(nworkers)
+        self.nitems = 0
+        self.errors = []
+        self._nrunning = nworkers
+        self._lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._work, args=(i,), name=f"cellpose-{name}-{i}",
+                             daemon=True) for i in range(nworkers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self, iworker):
+        while True:
+            item = self.queue_in.get()
+            if item is _DONE:
+                break
+            if self.failed.is_set():
+                # drain queue so that upstream stages do not block
+                continue
+            tic = time.time()
+            try:
+                item = self.func(item)
+            except Exception as error:
+                pipeline_logger.error(f"{self.name} stage failed on image {item[0]}: {error}")
+                self.errors.append(error)
+                self.failed.set()
+                continue
+            finally:
+                self.busy[iworker] += time.time() - tic
+            with self._lock:
+                self.nitems += 1
+            if self.queue_out is not None:
+                self.queue_out.put(item)
+        with self._lock:
+            self._nrunning -= 1
+            last = self._nrunning == 0
+        if last and self.queue_out is not None:
+            for _ in range(self.nworkers_next):
+                self.queue_out.put(_DONE)
+
+
+def run_pipeline(model, files, save=None, channels=None, channel_axis=None, z_axis=None,
+                 normalize=True, invert=False, diameter=None, rescale=None,
+                 batch_size=8, resample=True, augment=False, tile=True, tile_overlap=0.1,
+                 bsize=224, flow_threshold=0.4, cellprob_threshold=0.0, min_size=15,
+                 niter=None, interp=True, converge_tol=0., partition=False,
+                 skip_background=None, reuse_tol=0.05, nworkers=(2, 1, 2, 1),
+                 queue_size=4):
+    """Segment a list of 2D images with the reading, network, mask and writing stages running
+    at the same time in pools of threads connected by bounded queues.
+
+    Reading includes image conversion and normalization. The network and the dynamics release the
+    GIL (torch, numba), so the stages overlap: the network runs on the next image while the masks of
+    the previous images are computed on the CPU. Outputs are the same as with model.eval.
+    Use the utilization of each stage in the returned stats to size the pools: a stage with
+    utilization close to 1 is the bottleneck.
+
+    Args:
+        model (CellposeModel or Cellpose): model to run, if Cellpose and diameter is None or 0
+            the diameter of each image is estimated with the size model in the network stage.
+        files (list): list of image file names or of 2D images.
+        save (callable, optional): called in the writing stage as save(image, masks, flows, styles, diam, file)
+            with the outputs of each image, which are then not kept. Defaults to None (outputs returned).
+        reuse_tol (float, optional): if the diameter is estimated, reuse the network outputs of the size model 
+            when the rescale is within this relative tolerance (see Cellpose.eval). Defaults to 0.05.
+        nworkers (tuple of 4 ints, optional): number of threads for the reading, network, mask and writing
+            stages. Defaults to (2, 1, 2, 1).
+        queue_size (int, optional): maximum number of images waiting between two stages. Defaults to 4.
+        other args: see CellposeModel.eval (images are segmented in 2D).
+
+    Returns:
+        A tuple containing:
+            - masks (list): labelled images (None if save is not None)
+            - flows (list): flows of each image as returned by eval (None if save is not None)
+            - styles (list): style vector of each image (None if save is not None)
+            - stats (dict): for each stage, number of "workers", number of "images", "busy" time (s)
+              summed over workers and "utilization" (busy time / (workers x wall time)), and total "time" (s).
+    """
+    if len(nworkers) != len(STAGES) or min(nworkers) < 1:
+        raise ValueError("nworkers must be 4 integers >= 1 (read, net, masks, write)")
+    size_model = None
+    if isinstance(model, Cellpose):
+        if diameter is None or diameter == 0:
+            size_model = model.sz if model.pretrained_size is not None else None
+            diameter = None if size_model is not None else model.diam_mean
+        model = model.cp
+    if isinstance(normalize, dict):
+        normalize_params = {**normalize_default, **normalize}
+    else:
+        normalize_params = {**normalize_default, "normalize": normalize}
+    normalize_params["invert"] = invert
+    nimg = len(files)
+    # size model outputs are computed with the default tiling
+    reuse = (reuse_tol > 0 and not augment and tile and tile_overlap == 0.1 and
+             bsize == 224 and skip_background is None)
+    # parallel numba kernels (dynamics) cannot always run from several threads at once
+    masks_lock = (threading.Lock() if nworkers[2] > 1 and
+                  not dynamics.parallel_kernels_threadsafe() else None)
+
+    def read_image(item):
+        i, file = item
+        image = io.imread(file) if isinstance(file, (str, bytes)) or hasattr(
+            file, "__fspath__") else file
+        x = transforms.convert_image(image, channels, channel_axis=channel_axis,
+                                     z_axis=z_axis, do_3D=False, nchan=model.nchan)
+        if x.ndim < 4:
+            x = x[np.newaxis, ...]
+        if normalize_params["normalize"]:
+            x = np.stack([transforms.normalize_img(xi, **normalize_params) for xi in x],
+                         axis=0)
+        return i, file, image, x
+
+    def run_net(item):
+        i, file, image, x = item
+        diam, out = diameter, None
+        if size_model is not None:
+            diam, _, out = size_model._eval(image, channels=channels,
+                                            channel_axis=channel_axis, normalize=normalize,
+                                            invert=invert, batch_size=batch_size)
+        if diam is not None and diam > 0:
+            rsc = model.diam_mean / diam
+        elif rescale is None:
+            rsc = model.diam_mean / model.diam_labels
+            diam = model.diam_labels
+        else:
+            rsc = rescale
+        if (reuse and out is not None and x.shape[0] == 1 and out["dP"].ndim == 3 and
+                abs(rsc / out["rescale"] - 1) <= reuse_tol):
+            styles = out["styles"]
+            dP, cellprob = model._resize_net_outputs(out["dP"], out["cellprob"], x.shape,
+                                                     rescale=rsc, resample=resample)
+        else:
+            styles, dP, cellprob = model._run_net(x, normalize=False, rescale=rsc,
+                                                  resample=resample, augment=augment,
+                                                  tile=tile, tile_overlap=tile_overlap,
+                                                  bsize=bsize, batch_size=batch_size,
+                                                  skip_background=skip_background)
+        return i, file, image, x.shape, diam, rsc, styles, dP, cellprob
+
+    def compute_masks(item):
+        i, file, image, shape, diam, rsc, styles, dP, cellprob = item
+        kwargs = dict(niter=niter, rescale=rsc, resample=resample,
+                      cellprob_threshold=cellprob_threshold,
+                      flow_threshold=flow_threshold, min_size=min_size, interp=interp,
+                      converge_tol=converge_tol, partition=partition)
+        if masks_lock is not None:
+            with masks_lock:
+                maski, dP, cellprob, p = model._compute_masks(shape, dP, cellprob, **kwargs)
+        else:
+            maski, dP, cellprob, p = model._compute_masks(shape, dP, cellprob, **kwargs)
+        flows = [plot.dx_to_circ(dP), dP, cellprob, p]
+        return i, file, image, diam, maski, flows, styles
+
+    outputs = [None] * nimg
+
+    def write_output(item):
+        i, file, image, diam, maski, flows, styles = item
+        if save is not None:
+            save(image, maski, flows, styles, diam, file)
+        else:
+            outputs[i] = (maski, flows, styles)
+        return item
+
+    failed = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in STAGES]
+    funcs = [read_image, run_net, compute_masks, write_output]
+    stages = [
+        _Stage(name, funcs[k], nworkers[k], queues[k],
+               queue_out=queues[k + 1] if k < len(STAGES) - 1 else None,
+               nworkers_next=nworkers[k + 1] if k < len(STAGES) - 1 else 0,
+               failed=failed) for k, name in enumerate(STAGES)
+    ]
+
+    tic = time.time()
+    for stage in stages:
+        stage.start()
+    for i, file in enumerate(files):
+        if failed.is_set():
+            break
+        queues[0].put((i, file))
+    for _ in range(nworkers[0]):
+        queues[0].put(_DONE)
+    for stage in stages:
+        for thread in stage.threads:
+            thread.join()
+    wall = time.time() - tic
+
+    stats = {"time": wall}
+    for stage in stages:
+        stats[stage.name] = {
+            "workers": stage.nworkers,
+            "images": stage.nitems,
+            "busy": float(stage.busy.sum()),
+            "utilization": float(stage.busy.sum() / (stage.nworkers * wall)) if wall > 0 else 0.
+        }
+    pipeline_logger.info(
+        f"pipeline ran on {nimg} images in {wall:0.2f}s, stage utilization: " +
+        ", ".join([f"{name} {stats[name]['utilization']:0.2f} "
+                   f"({stats[name]['workers']} workers)" for name in STAGES]))
+
+    for stage in stages:
+        if stage.errors:
+            raise stage.errors[0]
+
+    if save is not None:
+        return None, None, None, stats
+    masks, flows, styles = [list(out) for out in zip(*outputs)] if nimg > 0 else ([], [], [])
+    return masks, flows, styles, stats
+
+
+
+class _WorkerFilter(logging.Filter):
+    """ prefixes the messages of a worker process with its number """
+
+    def __init__(self, iworker):
+        super().__init__()
+        self.prefix = f"[worker {iworker}] "
+
+    def filter(self, record):
+        record.msg = self.prefix + str(record.msg)
+        return True
+
+
+def _worker(iworker, func, nthreads, items, results, log_queue, log_level, failed):
+    """ runs func on the items of the queue in a worker process of run_workers """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(_WorkerFilter(iworker))
+    root.addHandler(handler)
+    root.setLevel(log_level)
+
+    torch.set_num_threads(nthreads)
+    numba.set_num_threads(min(nthreads, numba.config.NUMBA_NUM_THREADS))
+
+    nitems, busy, error = 0, 0., None
+    while True:
+        item = items.get()
+        if item is None:
+            break
+        if failed.is_set():
+            # drain queue so that the other workers stop
+            continue
+        tic = time.time()
+        try:
+            func(item)
+            nitems += 1
+        except Exception as err:
+            pipeline_logger.error(f"failed on {item}: {err}")
+            error = f"{item}: {err}"
+            failed.set()
+        busy += time.time() - tic
+    results.put((iworker, nitems, busy, error))
+
+
+def run_workers(func, items, nworkers=2, nthreads=None):
+    """Run func on each item in nworkers processes pulling the items from a queue.
+
+    On many-core CPUs, several processes each using a few threads are faster than one
+    process using all the threads, as the network runs on small tiles. The worker processes
+    are started with the spawn method (forking after the parallel numba kernels are compiled
+    is not safe), so func must be picklable, e.g. a module-level function with its arguments 
+    bound with functools.partial. The torch tensors in func (e.g. the weights of the networks 
+    of a model bound to func) are moved to shared memory instead of being copied to each worker. 
+    The network runtime of each worker (see core.get_runtime) still benchmarks the modes and 
+    converts its own copy of the weights, unless the runtime_mode of the network is set: 
+    with "float32" the workers run the shared weights as is, the other modes make one 
+    converted copy of the weights per worker.
+    The log messages of the workers are sent to the handlers of the calling process, prefixed 
+    with the worker number.
+
+    Args:
+        func (callable): picklable function called as func(item) in the worker processes, 
+            its output is discarded.
+        items (list): picklable items to process, e.g. image file names.
+        nworkers (int, optional): number of worker processes. Defaults to 2.
+        nthreads (int, optional): number of torch and numba threads in each worker. 
+            Defaults to None (number of CPUs divided by nworkers).
+
+    Returns:
+        dict: for each worker, number of "images", "busy" time (s) spent in func and 
+            "images_per_sec" (images / busy time), and total "time" (s) including the 
+            start of the workers.
+    
+    Raises:
+        RuntimeError: If func failed on an item or a worker process exited with an error.
+    """
+    if nworkers < 1:
+        raise ValueError("nworkers must be >= 1")
+    nthreads = nthreads or max(1, (os.cpu_count() or 1) // nworkers)
+
+    # torch.multiprocessing shares the tensors of the process arguments
+    ctx = torch.multiprocessing.get_context("spawn")
+    item_queue, results, log_queue = ctx.Queue(), ctx.Queue(), ctx.Queue()
+    failed = ctx.Event()
+    listener = logging.handlers.QueueListener(log_queue, *logging.getLogger().handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    tic = time.time()
+    procs = [
+        ctx.Process(target=_worker, name=f"cellpose-worker-{i}",
+                    args=(i, func, nthreads, item_queue, results, log_queue,
+                          logging.getLogger().getEffectiveLevel(), failed))
+        for i in range(nworkers)
+    ]
+    try:
+        for proc in procs:
+            proc.start()
+        for item in items:
+            item_queue.put(item)
+        for _ in range(nworkers):
+            item_queue.put(None)
+        for proc in procs:
+            proc.join()
+    finally:
+        listener.stop()
+    wall = time.time() - tic
+    outputs = []
+    while not results.empty():
+        outputs.append(results.get())
+
+    stats = {"time": wall}
+    errors = []
+    for iworker, nitems, busy, error in sorted(outputs):
+        stats[iworker] = {
+            "images": nitems,
+            "busy": busy,
+            "images_per_sec": nitems / busy if busy > 0 else 0.
+        }
+        if error is not None:
+            errors.append(error)
+    pipeline_logger.info(
+        f"{nworkers} workers ({nthreads} threads each) ran on {len(items)} images in {wall:0.2f}s, " +
+        ", ".join([f"worker {i}: {stats[i]['images']} images "
+                   f"({stats[i]['images_per_sec']:0.2f} images/sec)"
+                   for i in range(nworkers) if i in stats]))
+    if errors:
+        raise RuntimeError(f"worker failed on {errors[0]}")
+    exitcodes = [proc.exitcode for proc in procs]
+    if len(outputs) < nworkers or any(code != 0 for code in exitcodes):
+        raise RuntimeError(f"worker processes exited with codes {exitcodes}")
+    return stats
@@ -9,9 +9,12 @@ import torch.nn as nn
 from torch import optim
 import torch.nn.functional as F
 import datetime
+import copy, logging
 
 from . import transforms, io, dynamics, utils
 
+resnet_logger = logging.getLogger(__name__)
+
 
 def batchconv(in_channels, out_channels, sz, conv_3D=False):
     conv_layer = nn.Conv3d if conv_3D else nn.Conv2d
@@ -138,7 +141,11 @@ class make_style(nn.Module):
         self.avg_pool = F.avg_pool3d if conv_3D else F.avg_pool2d
 
     def forward(self, x0):
-        style = self.avg_pool(x0, kernel_size=x0.shape[2:])
+        if torch.onnx.is_in_onnx_export():
+            # kernel size must be static in ONNX, average over the (dynamic) spatial axes
+            style = x0.mean(dim=tuple(range(2, x0.ndim)), keepdim=True)
+        else:
+            style = self.avg_pool(x0, kernel_size=x0.shape[2:])
         style = self.flatten(style)
         style = style / torch.sum(style**2, axis=1, keepdim=True)**.5
         return style
@@ -187,6 +194,8 @@ class CPnet(nn.Module):
         concatenation (bool): Whether to use concatenation.
         conv_3D (bool): Whether to use 3D convolution.
         mkldnn (bool): Whether to use MKL-DNN acceleration.
+        bf16 (bool): Whether bfloat16 autocast may be used for inference on the CPU (see core.InferenceRuntime).
+        runtime_mode (str): Mode of core.InferenceRuntime used for inference, None to choose it by benchmark.
         downsample (nn.Module): Downsample blocks of the network.
         upsample (nn.Module): Upsample blocks of the network.
         make_style (nn.Module): Style module, avgpool's over all spatial positions.
@@ -207,6 +216,8 @@ class CPnet(nn.Module):
         self.concatenation = False
         self.conv_3D = conv_3D
         self.mkldnn = mkldnn if mkldnn is not None else False
+        self.bf16 = False
+        self.runtime_mode = None
         self.downsample = downsample(nbase, sz, conv_3D=conv_3D, max_pool=max_pool)
         nbaseup = nbase[1:]
         nbaseup.append(nbaseup[-1])
@@ -255,6 +266,83 @@ class CPnet(nn.Module):
             T1 = T1.to_dense()
         return T1, style0, T0
 
+    def forward_style(self, data):
+        """
+        Style of the data, running only the downsample blocks and the style module 
+        (without the upsample pass and the output layer).
+
+        Args:
+            data (torch.Tensor): Input data.
+
+        Returns:
+            torch.Tensor: The style tensor, same as the style returned by forward.
+        """
+        if self.mkldnn:
+            data = data.to_mkldnn()
+        T0 = self.downsample(data)
+        if self.mkldnn:
+            return self.make_style(T0[-1].to_dense())
+        else:
+            return self.make_style(T0[-1])
+
+    def fuse_for_inference(self, verify=True, benchmark=False, bsize=224):
+        """
+        Make an eval-only copy of the model with the batchnorms folded.
+
+        The batchnorms of the network come before the convolutions (batchnorm, ReLU, conv), 
+        so they are folded where the op order allows it: into the preceding conv when it only 
+        takes the output of a conv, and into the 1x1 projection convs (no padding). The other 
+        batchnorms become precomputed scale and shift constants, and the style add of the 
+        upsample blocks is merged with them into a per-image bias (the style linear layer 
+        is scaled by the batchnorm), so that batchnorm, style add and ReLU run as one op.
+        The weights are not shared with the model, the copy must be made again after training.
+
+        Args:
+            verify (bool, optional): Check that the outputs of the copy match the outputs of 
+                the model on a random input. Defaults to True.
+            benchmark (bool, optional): Time the model and the copy on a tile of size bsize, 
+                the times are logged and stored in the latency attribute of the copy. 
+                Defaults to False.
+            bsize (int, optional): Size of the tile used for the benchmark. Defaults to 224.
+
+        Returns:
+            FusedCPnet: The fused copy of the model.
+
+        Raises:
+            RuntimeError: If verify and the outputs do not match.
+        """
+        net = copy.deepcopy(self).eval()
+        net.mkldnn = False
+        fused = FusedCPnet(copy.deepcopy(net))
+        ndim = 3 if self.conv_3D else 2
+        if verify:
+            X = torch.randn(2, self.nbase[0], *[64 if ndim == 2 else 32] * ndim,
+                            device=self.device)
+            with torch.inference_mode():
+                y0, style0 = net(X)[:2]
+                y1, style1 = fused(X)[:2]
+            err = max((y0 - y1).abs().max().item(), (style0 - style1).abs().max().item())
+            tol = 1e-4 * max(1., y0.abs().max().item())
+            if not err < tol:
+                raise RuntimeError(
+                    f"outputs of fused network do not match network (max error {err:0.2e})")
+        if benchmark:
+            X = torch.randn(1, self.nbase[0], *[bsize] * ndim, device=self.device)
+            fused.latency = {}
+            for name, model in zip(["original", "fused"], [net, fused]):
+                with torch.inference_mode():
+                    model(X)
+                    tic = time.time()
+                    for _ in range(3):
+                        model(X)
+                    if X.device.type == "cuda":
+                        torch.cuda.synchronize()
+                    fused.latency[name] = (time.time() - tic) / 3
+            resnet_logger.info(
+                f"latency per tile of size {bsize}: {fused.latency['original']*1000:0.1f}ms, "
+                f"fused {fused.latency['fused']*1000:0.1f}ms")
+        return fused
+
     def save_model(self, filename):
         """
         Save the model to a file.
@@ -287,3 +375,177 @@ class CPnet(nn.Module):
             self.load_state_dict(
                 dict([(name, param) for name, param in state_dict.items()]),
                 strict=False)
+
+
+def _bn_constants(bn):
+    """ scale and shift of the batchnorm in eval mode: bn(x) = scale * x + shift """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    return scale, shift
+
+
+def _fold_bn_after(conv, bn):
+    """ conv followed by bn, folded into conv """
+    scale, shift = _bn_constants(bn)
+    conv.weight.mul_(scale.reshape(-1, *[1] * (conv.weight.ndim - 1)))
+    conv.bias.mul_(scale).add_(shift)
+    return conv
+
+
+def _fold_bn_before(bn, conv):
+    """ bn followed by a conv without padding (1x1), folded into conv """
+    scale, shift = _bn_constants(bn)
+    w = conv.weight
+    conv.bias.add_((w.sum(dim=tuple(range(2, w.ndim))) * shift).sum(dim=1))
+    w.mul_(scale.reshape(1, -1, *[1] * (w.ndim - 2)))
+    return conv
+
+
+class _affine(nn.Module):
+    """ precomputed scale and shift of a batchnorm, applied before ReLU """
+
+    def __init__(self, bn, conv_3D=False):
+        super().__init__()
+        scale, shift = _bn_constants(bn)
+        shape = (-1, 1, 1, 1) if conv_3D else (-1, 1, 1)
+        self.register_buffer("scale", scale.reshape(shape))
+        self.register_buffer("shift", shift.reshape(shape))
+
+    def forward(self, x):
+        return F.relu(torch.addcmul(self.shift, x, self.scale), inplace=True)
+
+
+class _style_bias(nn.Module):
+    """ style linear layer merged with the following batchnorm: 
+    relu(scale * (x + full(style)) + shift) = relu(scale * x + full'(style)), 
+    if shift_folded the scale and the shift of the batchnorm are already applied to x """
+
+    def __init__(self, full, bn, conv_3D=False, shift_folded=False):
+        super().__init__()
+        scale, shift = _bn_constants(bn)
+        self.ndim = 3 if conv_3D else 2
+        self.shift_folded = shift_folded
+        self.full = nn.Linear(full.in_features, full.out_features).to(full.weight.device)
+        self.full.weight.copy_(full.weight * scale[:, None])
+        if shift_folded:
+            self.full.bias.copy_(full.bias * scale)
+        else:
+            self.full.bias.copy_(full.bias * scale + shift)
+            self.register_buffer("scale", scale.reshape(-1, *[1] * self.ndim))
+
+    def forward(self, style, x):
+        feat = self.full(style)
+        feat = feat.reshape(*feat.shape, *[1] * self.ndim)
+        if self.shift_folded:
+            return F.relu(x + feat, inplace=True)
+        else:
+            return F.relu(torch.addcmul(feat, x, self.scale), inplace=True)
+
+
+class _fused_resdown(nn.Module):
+
+    def __init__(self, block, conv_3D=False):
+        super().__init__()
+        conv = block.conv
+        self.proj = _fold_bn_before(block.proj[0], block.proj[1])
+        self.affine0 = _affine(conv[0][0], conv_3D)
+        self.conv0 = _fold_bn_after(conv[0][2], conv[1][0])
+        self.conv1 = conv[1][2]
+        self.affine2 = _affine(conv[2][0], conv_3D)
+        self.conv2 = _fold_bn_after(conv[2][2], conv[3][0])
+        self.conv3 = conv[3][2]
+
+    def forward(self, x):
+        x = self.proj(x) + self.conv1(F.relu(self.conv0(self.affine0(x)), inplace=True))
+        x = x + self.conv3(F.relu(self.conv2(self.affine2(x)), inplace=True))
+        return x
+
+
+class _fused_resup(nn.Module):
+
+    def __init__(self, block, conv_3D=False):
+        super().__init__()
+        conv = block.conv
+        self.proj = _fold_bn_before(block.proj[0], block.proj[1])
+        self.affine0 = _affine(conv[0][0], conv_3D)
+        self.conv0 = conv[0][2]
+        self.style1 = _style_bias(conv[1].full, conv[1].conv[0], conv_3D)
+        self.conv1 = conv[1].conv[2]
+        self.style2 = _style_bias(conv[2].full, conv[2].conv[0], conv_3D)
+        # conv_3 only takes the output of conv_2 (+ style), its batchnorm is folded in conv_2
+        self.conv2 = _fold_bn_after(conv[2].conv[2], conv[3].conv[0])
+        self.style3 = _style_bias(conv[3].full, conv[3].conv[0], conv_3D,
+                                  shift_folded=True)
+        self.conv3 = conv[3].conv[2]
+
+    def forward(self, x, y, style):
+        x = self.proj(x) + self.conv1(self.style1(style, self.conv0(self.affine0(x)) + y))
+        x = x + self.conv3(self.style3(style, self.conv2(self.style2(style, x))))
+        return x
+
+
+class FusedCPnet(nn.Module):
+    """
+    Eval-only CPnet with the batchnorms folded into the convolutions or into precomputed 
+    constants, made with CPnet.fuse_for_inference. Its outputs are the same as the 
+    outputs of the CPnet in eval mode (up to float rounding).
+
+    Args:
+        net (CPnet): The network to fuse, in eval mode and not converted to mkldnn 
+            (its modules are reused and modified in place, so pass a copy).
+
+    Attributes:
+        latency (dict): Time per tile of the original and of the fused network, if benchmarked.
+    """
+
+    def __init__(self, net):
+        super().__init__()
+        self.nbase = net.nbase
+        self.nout = net.nout
+        self.sz = net.sz
+        self.style_on = net.style_on
+        self.conv_3D = net.conv_3D
+        self.mkldnn = False
+        self.bf16 = net.bf16
+        self.latency = None
+        with torch.no_grad():
+            self.down = nn.ModuleList(
+                [_fused_resdown(block, net.conv_3D) for block in net.downsample.down])
+            self.maxpool = net.downsample.maxpool
+            self.make_style = net.make_style
+            self.up = nn.ModuleList(
+                [_fused_resup(block, net.conv_3D) for block in net.upsample.up])
+            self.upsampling = net.upsample.upsampling
+            self.output = nn.Sequential(_affine(net.output[0], net.conv_3D), net.output[2])
+        self.diam_mean = net.diam_mean
+        self.diam_labels = net.diam_labels
+        self.eval()
+
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
+    def train(self, mode=True):
+        if mode:
+            raise RuntimeError("FusedCPnet is eval-only, train the CPnet instead")
+        return super().train(False)
+
+    def _downsample(self, data):
+        T0 = []
+        x = data
+        for n, block in enumerate(self.down):
+            x = block(x if n == 0 else self.maxpool(x))
+            T0.append(x)
+        return T0
+
+    def forward_style(self, data):
+        return self.make_style(self._downsample(data)[-1])
+
+    def forward(self, data):
+        T0 = self._downsample(data)
+        style0 = self.make_style(T0[-1])
+        style = style0 if self.style_on else style0 * 0
+        x = self.up[-1](T0[-1], T0[-1], style)
+        for n in range(len(self.up) - 2, -1, -1):
+            x = self.up[n](self.upsampling(x), T0[n], style)
+        return self.output(x), style0, T0
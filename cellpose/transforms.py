@@ -4,6 +4,8 @@ Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer a
 
 import numpy as np
 import warnings
+import functools
+from numpy.lib.stride_tricks import sliding_window_view
 import cv2
 import torch
 from torch.fft import fft2, ifft2, fftshift
@@ -16,9 +18,10 @@ transforms_logger = logging.getLogger(__name__)
 from . import dynamics, utils
 
 
+@functools.lru_cache(maxsize=32)
 def _taper_mask(ly=224, lx=224, sig=7.5):
     """
-    Generate a taper mask.
+    Generate a taper mask (cached, the returned array is read-only).
 
     Args:
         ly (int): The height of the mask. Default is 224.
@@ -26,7 +29,7 @@ def _taper_mask(ly=224, lx=224, sig=7.5):
         sig (float): The sigma value for the tapering function. Default is 7.5.
 
     Returns:
-        numpy.ndarray: The taper mask.
+        numpy.ndarray: The taper mask (float32).
 
     """
     bsize = max(224, max(ly, lx))
@@ -36,8 +39,57 @@ def _taper_mask(ly=224, lx=224, sig=7.5):
     mask = mask * mask[:, np.newaxis]
     mask = mask[bsize // 2 - ly // 2:bsize // 2 + ly // 2 + ly % 2,
                 bsize // 2 - lx // 2:bsize // 2 + lx // 2 + lx % 2]
+    mask = mask.astype(np.float32)
+    mask.flags.writeable = False
     return mask
 
+
+def tile_weights(ysub, xsub, Ly, Lx):
+    """
+    Sum over tiles of the taper masks used in average_tiles.
+
+    Args:
+        ysub (list): List of arrays with start and end of tiles in Y of length ntiles
+        xsub (list): List of arrays with start and end of tiles in X of length ntiles
+        Ly (int): Size of pre-tiled image in Y
+        Lx (int): Size of pre-tiled image in X
+
+    Returns:
+        Navg (float32): Sum of the taper masks. Shape: [Ly x Lx]
+    """
+    # only the taper mask of a tile is cached, Navg is as large as the image
+    mask = _taper_mask(ly=int(ysub[0][1] - ysub[0][0]), lx=int(xsub[0][1] - xsub[0][0]))
+    Navg = np.zeros((Ly, Lx), np.float32)
+    for j in range(len(ysub)):
+        Navg[ysub[j][0]:ysub[j][1], xsub[j][0]:xsub[j][1]] += mask
+    return Navg
+
+
+def unaugment_tile(y, j, i):
+    """Reverse the flips of tile (j, i) of the tile grid made with make_tiles(augment=True), in place 
+    (includes flipping of flowsY and flowsX).
+
+    Args:
+        y (float32): Array of shape (chan, Ly, Lx) where chan = (flowsY, flowsX, cell prob).
+        j (int): Position of the tile in Y in the grid of tiles.
+        i (int): Position of the tile in X in the grid of tiles.
+
+    Returns:
+        float32: Array of shape (chan, Ly, Lx).
+    """
+    if j % 2 == 0 and i % 2 == 1:
+        y[:] = y[:, ::-1, :]
+        y[0] *= -1
+    elif j % 2 == 1 and i % 2 == 0:
+        y[:] = y[:, :, ::-1]
+        y[1] *= -1
+    elif j % 2 == 1 and i % 2 == 1:
+        y[:] = y[:, ::-1, ::-1]
+        y[0] *= -1
+        y[1] *= -1
+    return y
+
+
 def unaugment_tiles(y):
     """Reverse test-time augmentations for averaging (includes flipping of flowsY and flowsX).
 
@@ -50,19 +102,33 @@ def unaugment_tiles(y):
     """
     for j in range(y.shape[0]):
         for i in range(y.shape[1]):
-            if j % 2 == 0 and i % 2 == 1:
-                y[j, i] = y[j, i, :, ::-1, :]
-                y[j, i, 0] *= -1
-            elif j % 2 == 1 and i % 2 == 0:
-                y[j, i] = y[j, i, :, :, ::-1]
-                y[j, i, 1] *= -1
-            elif j % 2 == 1 and i % 2 == 1:
-                y[j, i] = y[j, i, :, ::-1, ::-1]
-                y[j, i, 0] *= -1
-                y[j, i, 1] *= -1
+            unaugment_tile(y[j, i], j, i)
     return y
 
 
+def accumulate_tiles(yf, y, ysub, xsub):
+    """
+    Add the results of the network on tiles, tapered at the tile edges, to yf (in place).
+
+    Used to average tiles batch by batch: divide yf by tile_weights once all tiles are added.
+
+    Args:
+        yf (float32): Sum of tapered tiles. Shape: [nclasses x Ly x Lx]
+        y (float): Output of cellpose network for each tile. Shape: [ntiles x nclasses x bsize x bsize]
+        ysub (list): List of arrays with start and end of tiles in Y of length ntiles
+        xsub (list): List of arrays with start and end of tiles in X of length ntiles
+
+    Returns:
+        yf (float32): Sum of tapered tiles. Shape: [nclasses x Ly x Lx]
+    """
+    # taper edges of tiles
+    mask = _taper_mask(ly=y.shape[-2], lx=y.shape[-1])
+    y = np.multiply(y, mask, dtype=np.float32)
+    for j in range(len(ysub)):
+        yf[:, ysub[j][0]:ysub[j][1], xsub[j][0]:xsub[j][1]] += y[j]
+    return yf
+
+
 def average_tiles(y, ysub, xsub, Ly, Lx):
     """
     Average the results of the network over tiles.
@@ -77,17 +143,61 @@ def average_tiles(y, ysub, xsub, Ly, Lx):
     Returns:
         yf (float32): Network output averaged over tiles. Shape: [nclasses x Ly x Lx]
     """
-    Navg = np.zeros((Ly, Lx))
     yf = np.zeros((y.shape[1], Ly, Lx), np.float32)
-    # taper edges of tiles
-    mask = _taper_mask(ly=y.shape[-2], lx=y.shape[-1])
-    for j in range(len(ysub)):
-        yf[:, ysub[j][0]:ysub[j][1], xsub[j][0]:xsub[j][1]] += y[j] * mask
-        Navg[ysub[j][0]:ysub[j][1], xsub[j][0]:xsub[j][1]] += mask
-    yf /= Navg
+    accumulate_tiles(yf, y, ysub, xsub)
+    yf /= tile_weights(ysub, xsub, Ly, Lx)
     return yf
 
 
+def background_tiles(IMG, threshold=0.1, binsize=4):
+    """
+    Find the tiles without foreground from intensity statistics of the normalized tiles.
+
+    A tile is background if, in every channel, the mean intensity in each block of 
+    [binsize x binsize] pixels is below threshold (normalized intensities: 0 = 1st and 
+    1 = 99th percentile of the image). Averaging in blocks discards isolated noisy pixels, 
+    any object covering a block keeps the tile.
+
+    Args:
+        IMG (np.ndarray): Normalized tiles of shape [ntiles x nchan x ly x lx].
+        threshold (float, optional): Intensity threshold. Defaults to 0.1.
+        binsize (int, optional): Size of the blocks averaged. Defaults to 4.
+
+    Returns:
+        np.ndarray: Boolean array of length ntiles, True for background tiles.
+    """
+    ntiles, nchan, ly, lx = IMG.shape
+    ly, lx = ly - ly % binsize, lx - lx % binsize
+    bins = IMG[:, :, :ly, :lx].reshape(ntiles, nchan, ly // binsize, binsize,
+                                       lx // binsize, binsize)
+    score = bins.mean(axis=(3, 5), dtype=np.float32).max(axis=(1, 2, 3))
+    return score < threshold
+
+
+def tile_count(Ly, Lx, bsize=224, augment=False, tile_overlap=0.1):
+    """Number of tiles made by make_tiles for an image of size [Ly x Lx].
+
+    Args:
+        Ly (int): Height of the image.
+        Lx (int): Width of the image.
+        bsize (int, optional): Size of tiles. Defaults to 224.
+        augment (bool, optional): Whether tiles overlap by half (see make_tiles). Defaults to False.
+        tile_overlap (float, optional): Fraction of overlap of tiles. Defaults to 0.1.
+
+    Returns:
+        int: Number of tiles.
+    """
+    if augment:
+        Ly, Lx = max(Ly, bsize), max(Lx, bsize)
+        ny = max(2, int(np.ceil(2. * Ly / bsize)))
+        nx = max(2, int(np.ceil(2. * Lx / bsize)))
+    else:
+        tile_overlap = min(0.5, max(0.05, tile_overlap))
+        ny = 1 if Ly <= bsize else int(np.ceil((1. + 2 * tile_overlap) * Ly / bsize))
+        nx = 1 if Lx <= bsize else int(np.ceil((1. + 2 * tile_overlap) * Lx / bsize))
+    return ny * nx
+
+
 def make_tiles(imgi, bsize=224, augment=False, tile_overlap=0.1):
     """Make tiles of image to run at test-time.
 
@@ -120,24 +230,7 @@ def make_tiles(imgi, bsize=224, augment=False, tile_overlap=0.1):
         nx = max(2, int(np.ceil(2. * Lx / bsize)))
         ystart = np.linspace(0, Ly - bsize, ny).astype(int)
         xstart = np.linspace(0, Lx - bsize, nx).astype(int)
-
-        ysub = []
-        xsub = []
-
-        # flip tiles so that overlapping segments are processed in rotation
-        IMG = np.zeros((len(ystart), len(xstart), nchan, bsize, bsize), np.float32)
-        for j in range(len(ystart)):
-            for i in range(len(xstart)):
-                ysub.append([ystart[j], ystart[j] + bsize])
-                xsub.append([xstart[i], xstart[i] + bsize])
-                IMG[j, i] = imgi[:, ysub[-1][0]:ysub[-1][1], xsub[-1][0]:xsub[-1][1]]
-                # flip tiles to allow for augmentation of overlapping segments
-                if j % 2 == 0 and i % 2 == 1:
-                    IMG[j, i] = IMG[j, i, :, ::-1, :]
-                elif j % 2 == 1 and i % 2 == 0:
-                    IMG[j, i] = IMG[j, i, :, :, ::-1]
-                elif j % 2 == 1 and i % 2 == 1:
-                    IMG[j, i] = IMG[j, i, :, ::-1, ::-1]
+        bsizeY, bsizeX = bsize, bsize
     else:
         tile_overlap = min(0.5, max(0.05, tile_overlap))
         bsizeY, bsizeX = min(bsize, Ly), min(bsize, Lx)
@@ -149,14 +242,18 @@ def make_tiles(imgi, bsize=224, augment=False, tile_overlap=0.1):
         ystart = np.linspace(0, Ly - bsizeY, ny).astype(int)
         xstart = np.linspace(0, Lx - bsizeX, nx).astype(int)
 
-        ysub = []
-        xsub = []
-        IMG = np.zeros((len(ystart), len(xstart), nchan, bsizeY, bsizeX), np.float32)
-        for j in range(len(ystart)):
-            for i in range(len(xstart)):
-                ysub.append([ystart[j], ystart[j] + bsizeY])
-                xsub.append([xstart[i], xstart[i] + bsizeX])
-                IMG[j, i] = imgi[:, ysub[-1][0]:ysub[-1][1], xsub[-1][0]:xsub[-1][1]]
+    ysub = [[ys, ys + bsizeY] for ys in ystart for xs in xstart]
+    xsub = [[xs, xs + bsizeX] for ys in ystart for xs in xstart]
+    # gather the tiles from a strided view of the image (single copy into IMG)
+    windows = sliding_window_view(imgi, (bsizeY, bsizeX), axis=(1, 2))
+    windows = np.moveaxis(windows, 0, 2)
+    IMG = windows[ystart[:, np.newaxis], xstart].astype(np.float32, copy=False)
+
+    if augment:
+        # flip tiles to allow for augmentation of overlapping segments
+        IMG[::2, 1::2] = IMG[::2, 1::2, :, ::-1, :].copy()
+        IMG[1::2, ::2] = IMG[1::2, ::2, :, :, ::-1].copy()
+        IMG[1::2, 1::2] = IMG[1::2, 1::2, :, ::-1, ::-1].copy()
 
     return IMG, ysub, xsub, Ly, Lx
 
@@ -12,6 +12,7 @@ import numpy as np
 import colorsys
 import fastremap
 from multiprocessing import Pool, cpu_count
+from numba import njit, prange
 
 from . import metrics
 
@@ -611,12 +612,74 @@ def size_distribution(masks):
     counts = np.unique(masks, return_counts=True)[1][1:]
     return np.percentile(counts, 25) / np.percentile(counts, 75)
 
+@njit(nogil=True, parallel=True, cache=True)
+def _fill_holes_objects(masks, bbox, labels, fill, conflict):
+    """Find (and fill) the holes of masks in their bounding boxes, for all masks in parallel.
+
+    A hole of mask i is a pixel in its bounding box which is not in mask i and is not 
+    4-connected to the edge of the bounding box through pixels not in mask i, as in 
+    binary_fill_holes. In 3D, holes are found in each z-plane.
+
+    Args:
+        masks (numpy.ndarray): Masks of shape (Lz, Ly, Lx) (Lz = 1 for 2D masks).
+        bbox (numpy.ndarray): Array of shape (nmasks, 6) with zmin, zmax, ymin, ymax, xmin, xmax
+            of each mask (max exclusive).
+        labels (numpy.ndarray): Label of each mask.
+        fill (bool): If True, set the holes of each mask to its label.
+        conflict (numpy.ndarray): Output boolean array of length nmasks, set to True if 
+            a hole of the mask contains another mask.
+
+    Returns:
+        None
+    """
+    for c in prange(len(labels)):
+        z0, z1, y0, y1, x0, x1 = bbox[c]
+        lab = labels[c]
+        ly, lx = y1 - y0, x1 - x0
+        seen = np.zeros((ly, lx), np.bool_)
+        stack = np.empty(ly * lx, np.int64)
+        for z in range(z0, z1):
+            seen[:] = False
+            # flood fill from the pixels on the edge of the bounding box
+            n = 0
+            for y in range(ly):
+                for x in range(lx):
+                    if ((y == 0 or y == ly - 1 or x == 0 or x == lx - 1) and
+                            masks[z, y0 + y, x0 + x] != lab):
+                        seen[y, x] = True
+                        stack[n] = y * lx + x
+                        n += 1
+            while n > 0:
+                n -= 1
+                y, x = divmod(stack[n], lx)
+                for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                    yn, xn = y + dy, x + dx
+                    if (yn >= 0 and yn < ly and xn >= 0 and xn < lx and not seen[yn, xn]
+                            and masks[z, y0 + yn, x0 + xn] != lab):
+                        seen[yn, xn] = True
+                        stack[n] = yn * lx + xn
+                        n += 1
+            # remaining pixels not in the mask are holes
+            for y in range(ly):
+                for x in range(lx):
+                    if not seen[y, x] and masks[z, y0 + y, x0 + x] != lab:
+                        if fill:
+                            masks[z, y0 + y, x0 + x] = lab
+                        elif masks[z, y0 + y, x0 + x] != 0:
+                            conflict[c] = True
+
+
 def fill_holes_and_remove_small_masks(masks, min_size=15):
     """ Fills holes in masks (2D/3D) and discards masks smaller than min_size.
 
     This function fills holes in each mask using scipy.ndimage.morphology.binary_fill_holes.
     It also removes masks that are smaller than the specified min_size.
 
+    Mask sizes are counted at once with fastremap, small masks are removed and masks are 
+    renumbered with one lookup table, and holes are filled in the bounding box of each 
+    mask in parallel (numba prange). If a hole contains another mask, masks are processed 
+    one by one in order of their labels instead, which gives the same result.
+
     Parameters:
     masks (ndarray): Int, 2D or 3D array of labelled masks.
         0 represents no mask, while positive integers represent mask labels.
@@ -635,6 +698,41 @@ def fill_holes_and_remove_small_masks(masks, min_size=15):
         raise ValueError("masks_to_outlines takes 2D or 3D array, not %dD array" %
                          masks.ndim)
 
+    slices = find_objects(masks)
+    if len(slices) == 0:
+        return masks
+
+    # number of pixels in each mask
+    uniq, counts = fastremap.unique(masks, return_counts=True)
+    npix = np.zeros(len(slices) + 1, np.int64)
+    npix[uniq] = counts
+    npix = npix[1:]
+    ikeep = np.nonzero((npix >= min_size) if min_size > 0 else (npix > 0))[0]
+
+    # bounding boxes of masks which are kept
+    bbox = np.zeros((len(ikeep), 6), np.int64)
+    for j, i in enumerate(ikeep):
+        slc = ((slice(0, 1),) if masks.ndim == 2 else ()) + slices[i]
+        bbox[j] = [b for sl in slc for b in (sl.start, sl.stop)]
+    masks3D = masks[np.newaxis] if masks.ndim == 2 else masks
+
+    # holes which contain other masks change the masks processed later
+    conflict = np.zeros(len(ikeep), bool)
+    _fill_holes_objects(masks3D, bbox, (ikeep + 1).astype(masks.dtype), False, conflict)
+    if conflict.any():
+        return _fill_holes_and_remove_small_masks_loop(masks, min_size=min_size)
+
+    # remove small masks and renumber
+    lut = np.zeros(len(slices) + 1, masks.dtype)
+    lut[ikeep + 1] = np.arange(1, len(ikeep) + 1)
+    masks[...] = lut[masks]
+
+    _fill_holes_objects(masks3D, bbox, lut[ikeep + 1], True, conflict)
+    return masks
+
+
+def _fill_holes_and_remove_small_masks_loop(masks, min_size=15):
+    """Fill holes and remove small masks one mask at a time (see fill_holes_and_remove_small_masks)."""
     slices = find_objects(masks)
     j = 0
     for i, slc in enumerate(slices):
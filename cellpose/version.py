@@ -3,9 +3,26 @@ Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer a
 """
 
 from importlib.metadata import PackageNotFoundError, version
-import sys
+import importlib.util
+import os, sys
 from platform import python_version
-import torch
+
+
+def _torch_version():
+    """ version of torch (with the CUDA tag) read from torch/version.py, 
+    without importing torch which takes seconds """
+    try:
+        spec = importlib.util.find_spec("torch")
+        path = os.path.join(spec.submodule_search_locations[0], "version.py")
+        spec = importlib.util.spec_from_file_location("_cellpose_torch_version", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.__version__
+    except Exception:
+        return "unknown"
+
+
+torch_version = _torch_version()
 
 try:
     version = version("cellpose")
@@ -16,4 +33,4 @@ version_str = f"""
 cellpose version: \t{version} 
 platform:       \t{sys.platform} 
 python version: \t{python_version()} 
-torch version:  \t{torch.__version__}"""
+torch version:  \t{torch_version}"""
@@ -45,6 +45,8 @@ test_deps = [
     'pytest',
 ]
 
+onnx_deps = ['onnx', 'onnxruntime']
+
 try:
     import torch
     a = torch.ones(2, 3)
@@ -102,6 +104,7 @@ setup(name="cellpose",
           'docs': docs_deps,
           'gui': gui_deps,
           'distributed': distributed_deps,
+          'onnx': onnx_deps,
           'dev': gui_deps + lint_deps,
           'all': gui_deps + distributed_deps + image_deps + lint_deps + test_deps,
       },
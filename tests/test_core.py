@@ -0,0 +1,163 @@
+from cellpose import core, resnet_torch, transforms
+import numpy as np
+import pytest
+import torch
+
+
+@pytest.fixture()
+def net():
+    torch.manual_seed(0)
+    return resnet_torch.CPnet([2, 32, 64, 128, 256], nout=3, sz=3).eval()
+
+
+def test_run_net_batch_size(net, monkeypatch):
+    img = np.random.default_rng(0).random((300, 340, 2)).astype(np.float32)
+    y, style = core.run_net(net, img, batch_size=8)
+    y1, style1 = core.run_net(net, img, batch_size=1)
+    assert np.allclose(y, y1, atol=1e-5)
+    assert np.allclose(style, style1, atol=1e-5)
+
+    # batches larger than 2 tiles run out of memory, "auto" backs off
+    forward = core._forward
+
+    def _forward(net, x):
+        if len(x) > 2:
+            raise RuntimeError("CUDA out of memory")
+        return forward(net, x)
+
+    monkeypatch.setattr(core, "_forward", _forward)
+    with pytest.raises(RuntimeError):
+        core.run_net(net, img, batch_size=8)
+    y2, style2 = core.run_net(net, img, batch_size="auto", memory_budget=1.)
+    assert np.allclose(y, y2, atol=1e-5)
+    assert np.allclose(style, style2, atol=1e-5)
+
+
+def test_get_batch_size(net):
+    assert core.get_batch_size(net, bsize=224, memory_budget=1e-3) == 1
+    small = core.get_batch_size(net, bsize=224, memory_budget=1.)
+    large = core.get_batch_size(net, bsize=224, memory_budget=4.)
+    assert large >= 4 * small - 3
+    assert core.get_batch_size(net) >= 1
+
+
+def test_run_net_batch(net):
+    rng = np.random.default_rng(0)
+    imgs = [rng.random((150, 180, 2)).astype(np.float32),
+            rng.random((250, 120, 2)).astype(np.float32),
+            rng.random((150, 180, 2)).astype(np.float32)]
+    ys, styles = core.run_net_batch(net, imgs, batch_size=4)
+    for img, y, style in zip(imgs, ys, styles):
+        y0, style0 = core.run_net(net, img, batch_size=4)
+        assert y.shape == y0.shape
+        assert np.allclose(y, y0, atol=1e-5)
+        assert np.allclose(style, style0, atol=1e-5)
+
+
+def test_skip_background(net):
+    img = np.random.default_rng(0).random((500, 500, 2)).astype(np.float32) * 0.05
+    img[100:180, 120:200] = 1.
+    IMG = transforms.make_tiles(img.transpose(2, 0, 1), bsize=224)[0]
+    background = transforms.background_tiles(IMG.reshape(-1, *IMG.shape[2:]), threshold=0.1)
+    assert 0 < background.sum() < len(background)
+
+    y, style = core.run_net(net, img, skip_background=0.1)
+    y0, style0 = core.run_net(net, img)
+    assert np.allclose(y[:200, :200], y0[:200, :200], atol=1e-5)
+    assert np.allclose(y[-100:, -100:, 2], core.BACKGROUND_CELLPROB)
+    assert np.allclose(y[-100:, -100:, :2], 0)
+
+    # all tiles background
+    y, style = core.run_net(net, np.zeros((300, 300, 2), np.float32), skip_background=0.1)
+    assert np.allclose(y[..., 2], core.BACKGROUND_CELLPROB)
+    assert not np.isnan(style).any()
+
+
+def test_run_style(net):
+    rng = np.random.default_rng(0)
+    imgs = [rng.random((300, 340, 2)).astype(np.float32) for _ in range(2)]
+    imgs.append(rng.random((100, 120, 2)).astype(np.float32))
+    style = core.run_style(net, imgs, batch_size=4)
+    style0 = core.run_net_batch(net, imgs, batch_size=4)[1]
+    for s, s0 in zip(style, style0):
+        assert np.allclose(s, s0, atol=1e-5)
+
+
+def test_inference_runtime(net):
+    x = np.random.default_rng(0).random((2, 2, 64, 64)).astype(np.float32)
+    with torch.no_grad():
+        y0 = net(torch.from_numpy(x))[0].numpy()
+    runtime = core.get_runtime(net)
+    assert core.get_runtime(net) is runtime
+    for mode in ["float32", "mkldnn", "channels_last", "fused"]:
+        runtime._prepare(mode)
+        y, style = core._forward(net, x)
+        assert np.allclose(y, y0, atol=1e-4)
+    # float32 runs the original network, fused only when asked for
+    runtime._prepare("float32")
+    assert runtime.net is None
+    net.runtime_mode = "fused"
+    runtime = core.get_runtime(net)
+    assert runtime.mode == "fused"
+    assert isinstance(runtime.net, resnet_torch.FusedCPnet)
+    net.runtime_mode = None
+    assert core.get_runtime(net).mode != "fused"
+    with pytest.raises(ValueError):
+        core.InferenceRuntime(net, mode="int8")
+
+    # runtime is recreated when the weights change
+    with torch.no_grad():
+        net.output[-1].bias += 1
+    assert core.get_runtime(net) is not runtime
+    y, style = core._forward(net, x)
+    assert np.allclose(y, y0 + 1, atol=1e-4)
+
+
+def test_fuse_for_inference(net):
+    torch.manual_seed(1)
+    for module in net.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-1, 1)
+            module.running_var.uniform_(0.5, 2)
+            module.bias.data.uniform_(-0.5, 0.5)
+    fused = net.fuse_for_inference(verify=True, benchmark=True, bsize=64)
+    assert set(fused.latency) == {"original", "fused"}
+    x = torch.randn(3, 2, 48, 80)
+    with torch.no_grad():
+        y0, style0, T0 = net(x)
+        y, style, T = fused(x)
+    assert np.allclose(y, y0, atol=1e-4)
+    assert np.allclose(style, style0, atol=1e-5)
+    assert all(np.allclose(t, t0, atol=1e-4) for t, t0 in zip(T, T0))
+    with pytest.raises(RuntimeError):
+        fused.train()
+
+
+def test_onnx_backend(net, tmp_path):
+    pytest.importorskip("onnxruntime")
+    img = np.random.default_rng(0).random((150, 260, 2)).astype(np.float32)
+    y, style = core.run_net(net, img, batch_size=4)
+    y1, style1 = core.run_net(net, img, batch_size=4, backend="onnx")
+    assert np.allclose(y, y1, atol=1e-4)
+    assert np.allclose(style, style1, atol=1e-4)
+
+    core.export_onnx(net, tmp_path / "net.onnx")
+    onnx_net = core.OnnxNet(str(tmp_path / "net.onnx"))
+    y2, style2 = core.run_net(onnx_net, img, batch_size=4)
+    assert np.allclose(y, y2, atol=1e-4)
+
+    with pytest.raises(ValueError):
+        core.run_net(net, img, backend="tensorrt")
+
+
+def test_quantize_onnx(net):
+    pytest.importorskip("onnxruntime")
+    rng = np.random.default_rng(0)
+    imgs = [rng.random((100, 120, 2)).astype(np.float32) for _ in range(3)]
+    tiles = core.make_calibration_tiles(imgs, bsize=64, ntiles=8)
+    assert tiles.shape == (8, 2, 64, 64)
+    net_int8 = core.quantize_onnx(net, tiles)
+    y, style = core.run_net(net, imgs[0], bsize=64)
+    y8, style8 = core.run_net(net_int8, imgs[0], bsize=64)
+    assert y8.shape == y.shape
+    assert np.abs(y8 - y).max() < 0.1 * np.abs(y).max()
@@ -12,3 +12,222 @@ def test__masks_to_flows_gpu__single_object():
     masks = np.zeros((32, 32), dtype=int)
     masks[16:18, 16:18] = 1
     masks_to_flows_gpu(masks, device=torch.device('cuda'))
+
+
+def test_steps2D_interp_cpu_matches_map_coordinates():
+    from cellpose.dynamics import steps2D_interp, map_coordinates
+    rng = np.random.default_rng(0)
+    dP = rng.standard_normal((2, 64, 48)).astype(np.float32)
+    p0 = np.stack((rng.uniform(0, 63, 500), rng.uniform(0, 47, 500))).astype(np.float32)
+
+    # reference: one map_coordinates call per Euler step
+    p_ref = p0.copy()
+    dPt = np.zeros(p_ref.shape, np.float32)
+    for t in range(50):
+        map_coordinates(dP, p_ref[0], p_ref[1], dPt)
+        for k in range(2):
+            p_ref[k] = np.minimum(dP.shape[k + 1] - 1, np.maximum(0, p_ref[k] + dPt[k]))
+
+    p = steps2D_interp(p0.copy(), dP, 50)
+    assert np.allclose(p, p_ref, atol=1e-4)
+
+
+def _synthetic_masks(shape, ncells, radius, seed=0):
+    rng = np.random.default_rng(seed)
+    masks = np.zeros(shape, np.int32)
+    grid = np.indices(shape)
+    n = 0
+    for _ in range(ncells * 10):
+        center = [rng.integers(radius + 1, L - radius - 1) for L in shape]
+        d = sum((g - c)**2 for g, c in zip(grid, center)) <= radius**2
+        if masks[d].max() == 0:
+            n += 1
+            masks[d] = n
+        if n == ncells:
+            break
+    return masks
+
+
+@pytest.mark.parametrize("interp", [True, False])
+def test_compute_masks_converge_tol(interp):
+    from cellpose.dynamics import masks_to_flows, compute_masks
+    from cellpose.metrics import average_precision
+    masks = _synthetic_masks((256, 256), 60, 8)
+    dP = 5 * masks_to_flows(masks).astype(np.float32)
+    cellprob = 10 * (masks > 0).astype(np.float32) - 5
+    masks0 = compute_masks(dP, cellprob, interp=interp)[0]
+    masks1 = compute_masks(dP, cellprob, interp=interp, converge_tol=0.1)[0]
+    assert masks1.max() == masks.max()
+    assert average_precision(masks0, masks1)[0][0] > 0.99
+
+
+def test_follow_flows_3D_converge_tol():
+    from cellpose.dynamics import masks_to_flows, follow_flows
+    masks = _synthetic_masks((24, 48, 48), 6, 5)
+    dP = masks_to_flows(masks).astype(np.float32) * (masks > 0)
+    p0, inds0 = follow_flows(dP, niter=100)
+    p1, inds1 = follow_flows(dP, niter=100, converge_tol=0.1)
+    assert (inds0 == inds1).all()
+    assert np.abs(p0 - p1).max() < 2
+
+
+def test_get_masks_3D():
+    from cellpose.dynamics import masks_to_flows, follow_flows, get_masks
+    from cellpose.metrics import average_precision
+    masks = _synthetic_masks((24, 48, 48), 6, 5)
+    dP = masks_to_flows(masks).astype(np.float32) * (masks > 0)
+    p = follow_flows(dP, niter=100)[0]
+    masks_pred = get_masks(p, iscell=masks > 0)
+    assert average_precision(masks, masks_pred)[0][0] == 1.0
+
+
+def _masks_to_flows_reference(masks):
+    # diffusion of each mask on its own with _extend_centers, as before masks_to_flows_cpu 
+    # diffused all masks in one kernel
+    from scipy.ndimage import find_objects
+    from cellpose.dynamics import _extend_centers
+    mu = np.zeros((2, *masks.shape), np.float64)
+    meds = []
+    for i, si in enumerate(find_objects(masks)):
+        if si is not None:
+            sr, sc = si
+            ly, lx = sr.stop - sr.start + 2, sc.stop - sc.start + 2
+            y, x = np.nonzero(masks[sr, sc] == (i + 1))
+            y = y.astype(np.int32) + 1
+            x = x.astype(np.int32) + 1
+            imin = ((x - x.mean())**2 + (y - y.mean())**2).argmin()
+            ymed, xmed = y[imin], x[imin]
+            T = np.zeros(ly * lx, np.float64)
+            T = _extend_centers(T, y, x, ymed, xmed, np.int32(lx), np.int32(2 * (ly + lx)))
+            dy = T[(y + 1) * lx + x] - T[(y - 1) * lx + x]
+            dx = T[y * lx + x + 1] - T[y * lx + x - 1]
+            mu[:, sr.start + y - 1, sc.start + x - 1] = np.stack((dy, dx))
+            meds.append([ymed - 1, xmed - 1])
+    mu /= (1e-60 + (mu**2).sum(axis=0)**0.5)
+    return mu, np.array(meds)
+
+
+def test_masks_to_flows_cpu_matches_reference():
+    from cellpose.dynamics import masks_to_flows_cpu
+    masks = np.zeros((60, 70), np.int32)
+    # touching rectangles
+    masks[5:20, 5:20] = 1
+    masks[5:20, 20:32] = 2
+    masks[20:28, 8:30] = 4
+    # non-convex masks: a U shape and a ring around a mask (labels 3 and 6 are missing)
+    masks[35:55, 5:10] = 5
+    masks[50:55, 5:25] = 5
+    masks[35:55, 20:25] = 5
+    masks[30:50, 40:65] = 7
+    masks[35:45, 45:60] = 0
+    masks[38:42, 50:54] = 8
+    mu, meds = masks_to_flows_cpu(masks)
+    mu0, meds0 = _masks_to_flows_reference(masks)
+    assert np.array_equal(mu, mu0)
+    assert np.array_equal(meds, meds0)
+
+
+def test_masks_to_flows_direct():
+    from cellpose.dynamics import masks_to_flows
+    masks = _synthetic_masks((128, 128), 20, 8)
+    mu = masks_to_flows(masks)
+    mu_direct = masks_to_flows(masks, method="direct")
+    fg = masks > 0
+    assert mu_direct.shape == mu.shape
+    assert np.all(mu_direct[:, ~fg] == 0)
+    angle = np.degrees(np.arccos((mu * mu_direct).sum(axis=0)[fg].clip(-1, 1)))
+    assert np.median(angle) < 1.0
+
+    with pytest.raises(ValueError):
+        masks_to_flows(masks, method="cg")
+
+
+def test_masks_to_flows_cpu_3d():
+    from cellpose.dynamics import masks_to_flows
+    masks = _synthetic_masks((32, 48, 48), 1, 10, seed=1)
+    mu = masks_to_flows(masks)
+    assert mu.shape == (3, *masks.shape)
+    fg = masks > 0
+    assert np.allclose((mu[:, fg]**2).sum(axis=0), 1, atol=1e-5)
+    # flows point towards the center of the mask
+    coords = np.array(np.nonzero(fg))
+    center = coords.mean(axis=1, keepdims=True)
+    inward = (mu[:, fg] * (center - coords)).sum(axis=0)
+    dist = ((center - coords)**2).sum(axis=0)**0.5
+    assert np.all(inward[dist > 2] > 0)
+
+
+def test_masks_to_flows_3d_methods(monkeypatch):
+    from cellpose import dynamics
+    masks = _synthetic_masks((24, 40, 40), 3, 8, seed=2)
+    fg = masks > 0
+    mu = dynamics.masks_to_flows(masks)
+    mu_direct = dynamics.masks_to_flows(masks, method="direct")
+    # per-plane flows of the GPU, computed here with the CPU 2D flows
+    monkeypatch.setattr(dynamics, "masks_to_flows_gpu", dynamics.masks_to_flows_cpu)
+    mu_planes = dynamics.masks_to_flows(masks, device=torch.device("cuda"))
+    for m in [mu, mu_direct, mu_planes]:
+        assert m.shape == mu.shape
+        assert np.all(m[:, ~fg] == 0)
+        # unit flows, except at the center of symmetric masks
+        norm = (m[:, fg]**2).sum(axis=0)
+        assert np.allclose(norm[norm > 0], 1, atol=1e-5)
+        assert (norm == 0).sum() <= masks.max()
+    angle = np.degrees(np.arccos((mu * mu_direct).sum(axis=0)[fg].clip(-1, 1)))
+    assert np.median(angle) < 5.0
+
+
+def test_compute_masks_sparse_3D():
+    from cellpose.dynamics import masks_to_flows, compute_masks
+    from cellpose.metrics import average_precision
+    masks = _synthetic_masks((24, 64, 64), 8, 6)
+    dP = 5 * masks_to_flows(masks).astype(np.float32)
+    cellprob = np.where(masks > 0, 5., -5.).astype(np.float32)
+
+    # without interpolation, sparse dynamics match the dense meshgrid dynamics
+    m_dense, p_dense = compute_masks(dP, cellprob, do_3D=True, interp=False)
+    m_sparse, p_sparse = compute_masks(dP, cellprob, do_3D=True, interp=False,
+                                       sparse=True)
+    assert np.array_equal(m_dense, m_sparse)
+    assert np.array_equal(p_dense[:, masks > 0], p_sparse)
+
+    m_interp, _ = compute_masks(dP, cellprob, do_3D=True, interp=True, sparse=True)
+    assert average_precision(masks, m_interp)[0][0] == 1.0
+
+
+@pytest.mark.parametrize("interp", [True, False])
+def test_compute_masks_partition(interp):
+    from cellpose.dynamics import masks_to_flows, compute_masks
+    masks = _synthetic_masks((256, 256), 60, 8)
+    dP = 5 * masks_to_flows(masks).astype(np.float32)
+    cellprob = np.where(masks > 0, 5., -5.).astype(np.float32)
+    m_full, p_full = compute_masks(dP, cellprob, interp=interp)
+    m_part, p_part = compute_masks(dP, cellprob, interp=interp, partition=True)
+    assert np.array_equal(m_full, m_part)
+    assert np.allclose(p_full, p_part, atol=1e-3)
+
+
+def test_flow_error_local():
+    from cellpose.dynamics import masks_to_flows
+    from cellpose.metrics import flow_error, flow_error_local
+    masks = _synthetic_masks((128, 128), 20, 8)
+    masks[masks == 3] = 0  # missing label
+    rng = np.random.default_rng(0)
+    dP = (5 * masks_to_flows(masks) + rng.standard_normal((2, 128, 128))).astype(np.float32)
+    errors, _ = flow_error(masks, dP)
+    errors_local = flow_error_local(masks, dP, max_unit_pixels=500)
+    assert errors_local.shape == errors.shape
+    ok = np.isfinite(errors)
+    assert np.allclose(errors[ok], errors_local[ok])
+    with pytest.raises(ValueError):
+        flow_error_local(masks, dP[:, :64])
+
+
+def test_warmup():
+    import cellpose
+    from cellpose import dynamics, utils, metrics
+    assert cellpose.warmup() > 0
+    for kernel in [dynamics.get_centers, dynamics._extend_centers_cells,
+                   dynamics._extend_centers_cells_3d, utils._fill_holes_objects,
+                   metrics._label_overlap]:
+        assert len(kernel.signatures) > 0
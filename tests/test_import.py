@@ -14,6 +14,20 @@ def test_gui_imports_without_error():
     from cellpose import gui
 
 
+def test_import_time():
+    # import cellpose and the --version of the CLI do not import the heavy dependencies
+    import subprocess, sys
+    code = ("import sys, time; tic = time.time(); import cellpose; print(time.time() - tic); "
+            "print(sorted(set(sys.modules) & {'torch', 'numba', 'cv2', 'scipy', 'tifffile'}))")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                         check=True).stdout.split("\n")
+    print(f"import cellpose: {float(out[0]):0.3f}s")
+    assert out[1] == "[]"
+    out = subprocess.run([sys.executable, "-m", "cellpose", "--version"], capture_output=True,
+                         text=True, check=True).stdout
+    assert "cellpose version" in out and "torch version" in out
+
+
 def test_gpu_check():
     #     from cellpose import models
     #     models.use_gpu()
@@ -0,0 +1,109 @@
+from cellpose import models, pipeline, core
+import numpy as np
+import functools
+import pytest
+
+
+def test_run_pipeline():
+    model = models.CellposeModel(pretrained_model=False, model_type=None)
+    rng = np.random.default_rng(0)
+    imgs = [rng.random((150, 200)).astype(np.float32) for _ in range(3)]
+    imgs.append(rng.random((120, 90)).astype(np.float32))
+    masks, flows, styles = model.eval(imgs, channels=[0, 0], diameter=30.,
+                                      batch_images=False)
+    masks_p, flows_p, styles_p, stats = pipeline.run_pipeline(
+        model, imgs, channels=[0, 0], diameter=30., nworkers=(2, 1, 2, 1))
+    for i in range(len(imgs)):
+        assert np.array_equal(masks[i], masks_p[i])
+        for k in range(4):
+            assert np.array_equal(flows[i][k], flows_p[i][k])
+        assert np.allclose(styles[i], styles_p[i])
+    for stage in pipeline.STAGES:
+        assert stats[stage]["images"] == len(imgs)
+        assert 0 <= stats[stage]["utilization"] <= 1
+
+    saved = []
+    out = pipeline.run_pipeline(
+        model, imgs, channels=[0, 0], diameter=30.,
+        save=lambda image, masks, flows, styles, diam, file: saved.append(file is image))
+    assert out[0] is None and len(saved) == len(imgs) and all(saved)
+
+    with pytest.raises(ValueError):
+        pipeline.run_pipeline(model, imgs, nworkers=(1, 1, 0, 1))
+
+
+
+def test_eval_batch_groups(monkeypatch):
+    model = models.CellposeModel(pretrained_model=False, model_type=None)
+    rng = np.random.default_rng(0)
+    # 5 small images of 1 tile each and a large image of 16 tiles
+    imgs = [rng.random((100, 120)).astype(np.float32) for _ in range(5)]
+    imgs.insert(2, rng.random((600, 600)).astype(np.float32))
+    masks, flows, styles = model.eval(imgs, channels=[0, 0], diameter=30.,
+                                      batch_images=False)
+    nimgs = []
+    run_cp = model._run_cp
+    monkeypatch.setattr(model, "_run_cp",
+                        lambda x, **kwargs: nimgs.append(x.shape[0]) or run_cp(x, **kwargs))
+    masks_b, flows_b, styles_b = model.eval(imgs, channels=[0, 0], diameter=30.,
+                                            batch_size=4)
+    # the large image runs alone, the small ones in groups of at most batch_size tiles
+    assert sorted(nimgs) == [1, 1, 4]
+    for i in range(len(imgs)):
+        assert np.array_equal(masks[i], masks_b[i])
+        assert np.allclose(flows[i][1], flows_b[i][1], atol=1e-5)
+
+
+def test_size_model_reuse(tmp_path):
+    # Cellpose with a random network and a size model predicting diam_mean (no downloads)
+    model = models.Cellpose.__new__(models.Cellpose)
+    # (diam_mean 32 so that the size model rescale is exactly 1)
+    model.cp = models.CellposeModel(pretrained_model=False, model_type=None, diam_mean=32.)
+    model.diam_mean = model.cp.diam_mean
+    model.pretrained_size = str(tmp_path / "size.npy")
+    np.save(model.pretrained_size, {"A": np.zeros(256), "smean": np.zeros(256),
+                                    "ymean": 0., "diam_mean": model.diam_mean})
+    model.sz = models.SizeModel(model.cp, pretrained_size=model.pretrained_size)
+    rng = np.random.default_rng(0)
+    imgs = [rng.random((150, 200)).astype(np.float32) for _ in range(2)]
+
+    masks, flows, styles, diams = model.eval(imgs, channels=[0, 0], diameter=None)
+    masks0, flows0, styles0, diams0 = model.eval(imgs, channels=[0, 0], diameter=None,
+                                                 reuse_tol=0)
+    masks_p, flows_p, styles_p, stats = pipeline.run_pipeline(
+        model, imgs, channels=[0, 0], diameter=None)
+    assert np.allclose(diams, diams0)
+    for i in range(len(imgs)):
+        assert np.array_equal(masks[i], masks0[i])
+        assert np.allclose(flows[i][1], flows0[i][1], atol=1e-5)
+        assert np.allclose(styles[i], styles0[i], atol=1e-5)
+        assert np.array_equal(flows[i][1], flows_p[i][1])
+
+
+def _segment(i, model, imgs, save_dir):
+    masks = model.eval(imgs[i], channels=[0, 0], diameter=30.)[0]
+    # the worker runs the weights shared with the main process
+    net = core.get_runtime(model.net).net or model.net
+    assert all(p.is_shared() for p in net.parameters())
+    np.save(save_dir / f"{i}.npy", masks)
+
+
+def _fail(i):
+    raise ValueError("failed")
+
+
+def test_run_workers(tmp_path):
+    model = models.CellposeModel(pretrained_model=False, model_type=None)
+    rng = np.random.default_rng(0)
+    imgs = [rng.random((150, 200)).astype(np.float32) for _ in range(3)]
+    masks = model.eval(imgs, channels=[0, 0], diameter=30., batch_images=False)[0]
+
+    model.net.runtime_mode = "float32"
+    func = functools.partial(_segment, model=model, imgs=imgs, save_dir=tmp_path)
+    stats = pipeline.run_workers(func, list(range(len(imgs))), nworkers=2, nthreads=1)
+    assert sum(stats[i]["images"] for i in range(2)) == len(imgs)
+    for i in range(len(imgs)):
+        assert np.array_equal(masks[i], np.load(tmp_path / f"{i}.npy"))
+
+    with pytest.raises(RuntimeError):
+        pipeline.run_workers(_fail, [0], nworkers=1)
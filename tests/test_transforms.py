@@ -21,3 +21,26 @@ def test_normalize_img(data_dir):
 
     img_norm = normalize_img(img, norm3D=False, sharpen_radius=8)
     assert img_norm.shape == img.shape
+
+
+def test_make_tiles_average_tiles():
+    img = np.random.rand(2, 300, 500).astype("float32")
+    for augment in [False, True]:
+        IMG, ysub, xsub, Ly, Lx = make_tiles(img, bsize=224, augment=augment)
+        ny, nx = IMG.shape[:2]
+        assert len(ysub) == ny * nx
+        for j in range(ny):
+            for i in range(nx):
+                tile = img[:, ysub[j * nx + i][0]:ysub[j * nx + i][1],
+                           xsub[j * nx + i][0]:xsub[j * nx + i][1]]
+                if augment and j % 2 == 0 and i % 2 == 1:
+                    tile = tile[:, ::-1]
+                elif augment and j % 2 == 1 and i % 2 == 0:
+                    tile = tile[:, :, ::-1]
+                elif augment and j % 2 == 1 and i % 2 == 1:
+                    tile = tile[:, ::-1, ::-1]
+                assert np.array_equal(IMG[j, i], tile)
+        if not augment:
+            # averaging the tiles of an image gives back the image
+            yf = average_tiles(IMG.reshape(-1, *IMG.shape[2:]), ysub, xsub, Ly, Lx)
+            assert np.allclose(yf, img, atol=1e-5)
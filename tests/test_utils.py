@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from cellpose.utils import (fill_holes_and_remove_small_masks,
+                            _fill_holes_and_remove_small_masks_loop)
+
+
+def _ring_masks(ndim):
+    masks = np.zeros((4,) * (ndim - 2) + (64, 64), np.uint16)
+    masks[..., 2:12, 2:12] = 1
+    masks[..., 5:8, 5:8] = 0  # hole
+    masks[..., 20:21, 20:23] = 2  # small mask
+    masks[..., 30:50, 30:50] = 3
+    masks[..., 35:45, 35:45] = 0  # hole at image edge of bbox
+    masks[..., 40:60, 2:10] = 5
+    masks[..., 45, 2:10] = 0  # cut through mask, not a hole
+    return masks
+
+
+@pytest.mark.parametrize("ndim", [2, 3])
+def test_fill_holes_and_remove_small_masks(ndim):
+    masks = _ring_masks(ndim)
+    out = fill_holes_and_remove_small_masks(masks.copy(), min_size=15)
+    assert np.array_equal(out, _fill_holes_and_remove_small_masks_loop(masks.copy(), 15))
+    assert out.max() == 3
+    assert (out[..., 5:8, 5:8] == 1).all()
+    assert (out[..., 20:21, 20:23] == 0).all()
+
+    # hole containing another mask
+    masks[..., 38:42, 38:42] = 4
+    out = fill_holes_and_remove_small_masks(masks.copy(), min_size=-1)
+    assert np.array_equal(out, _fill_holes_and_remove_small_masks_loop(masks.copy(), -1))